@@ -7,6 +7,7 @@ import argparse
 
 import narf
 import wremnants
+wremnants.declare_headers()
 import hist
 import lz4.frame, pickle
 from wremnants import histselections as sel
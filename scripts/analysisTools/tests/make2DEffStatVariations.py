@@ -16,6 +16,7 @@ sys.path.append(os.getcwd() + "/plotUtils/")
 from utility import *
 
 import wremnants
+wremnants.declare_headers()
 
 def effStatVariations(outdir, covHisto, parHisto, nbins_pt, ptmin, ptmax,
                       smoothFunction="pol3", suffix=None,
@@ -15,6 +15,7 @@ import argparse
 import narf
 import narf.fitutils
 import wremnants
+wremnants.declare_headers()
 import hist
 import lz4.frame, pickle
 from wremnants.datasets.datagroups import Datagroups
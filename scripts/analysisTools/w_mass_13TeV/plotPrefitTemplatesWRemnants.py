@@ -23,6 +23,7 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from copy import *
 import wremnants
+wremnants.declare_headers()
 
 from scripts.analysisTools.plotUtils.utility import *
 
@@ -33,6 +33,7 @@ data_dir = common.data_dir
 from scripts.analysisTools.plotUtils.utility import *
 
 import wremnants
+wremnants.declare_headers()
 logger = logging.setup_logger(__file__, 3, False)
 
 # TODO: might move this function to a common efficiency_util.py script
@@ -53,6 +53,7 @@ from scripts.analysisTools.plotUtils.utility import *
 from scripts.analysisTools.w_mass_13TeV.run2Dsmoothing import makeAntiSFfromSFandEffi
 
 import wremnants
+wremnants.declare_headers()
 
 # for a quick summary at the end
 badFitsID_data = {}
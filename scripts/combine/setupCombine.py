@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 from wremnants import CardTool,combine_helpers,combine_theory_helper, HDF5Writer
 from wremnants.syst_tools import massWeightNames
-from wremnants.datasets.datagroups import Datagroups
+from wremnants.datasets.datagroups import Datagroups, histCache
 from utilities import common, logging, boostHistHelpers as hh
 from utilities.io_tools import input_tools
 import argparse
@@ -18,8 +18,14 @@ def make_parser(parser=None):
     parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4],
                         help="Set verbosity level with logging, the larger the more verbose")
     parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
+    parser.add_argument("--histCacheSize", type=float, default=2., help="Maximum size in GB of the cache for histograms read from the input file(s), 0 to disable the cache")
     parser.add_argument("--hdf5", action="store_true", help="Write out datacard in hdf5")
     parser.add_argument("--sparse", action="store_true", help="Write out datacard in sparse mode (only for when using hdf5)")
+    parser.add_argument("--streaming", action="store_true", help="Keep the logk arrays of the systematics on disk and write the output tensors in blocks of bounded size (only for when using hdf5)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to compute the shape systematics in parallel (only for when using hdf5), note that each worker holds its own copy of the loaded histograms")
+    parser.add_argument("--channelJobs", type=int, default=1, help="Number of worker processes to prepare the channels (e.g. from multiple input files) in parallel (only for when using hdf5), can be combined with --jobs for the shape systematics within each channel")
+    parser.add_argument("--maxMemory", type=float, default=2., help="Maximum memory in GB for the blocks of the output tensors in --streaming mode")
+    parser.add_argument("--logkCacheDir", type=str, default=None, help="Directory to cache the logk arrays of the shape systematics for each channel, process and systematic (only for when using hdf5), unchanged entries are reused in subsequent runs. The cache key only includes the code of the systematic actions and the plain functions they call directly, the cache has to be cleared after changing helper functions called through modules or methods (e.g. hh.*, theory_tools.*)")
     parser.add_argument("--excludeProcGroups", type=str, nargs="*", help="Don't run over processes belonging to these groups (only accepts exact group names)", default=["QCD"])
     parser.add_argument("--filterProcGroups", type=str, nargs="*", help="Only run over processes belonging to these groups", default=[])
     parser.add_argument("-x", "--excludeNuisances", type=str, default="", help="Regular expression to exclude some systematics from the datacard")
@@ -75,7 +81,7 @@ def make_parser(parser=None):
     parser.add_argument("--genAxes", type=str, default=None, nargs="+", help="Specify which gen axis should be used in unfolding, if 'None', use all (inferred from metadata).")
     parser.add_argument("--theoryAgnostic", action='store_true', help="Prepare datacard for theory agnostic analysis, similar to unfolding but different axis and possibly other differences")
     parser.add_argument("--poiAsNoi", action='store_true', help="Experimental option only with --theoryAgnostic or --unfolding, to treat POIs ad NOIs, with a single signal histogram")
-    parser.add_argument("--priorNormXsec", type=float, default=1, help="Prior for shape uncertainties on cross sections for theory agnostic or unfolding analysis with POIs as NOIs (1 means 100\%). If negative, it will use shapeNoConstraint in the fit")
+    parser.add_argument("--priorNormXsec", type=float, default=1, help="Prior for shape uncertainties on cross sections for theory agnostic or unfolding analysis with POIs as NOIs (1 means 100%%). If negative, it will use shapeNoConstraint in the fit")
     parser.add_argument("--scaleNormXsecHistYields", type=float, default=None, help="Scale yields of histogram with cross sections variations for theory agnostic analysis with POIs as NOIs. Can be used together with --priorNormXsec")
     parser.add_argument("--theoryAgnosticBandSize", type=float, default=1., help="Multiplier for theory-motivated band in theory agnostic analysis with POIs as NOIs.")
     parser.add_argument("--addTauToSignal", action='store_true', help="Events from the same process but from tau final states are added to the signal")
@@ -942,6 +948,8 @@ if __name__ == "__main__":
     
     logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
+    histCache.set_max_bytes(int(args.histCacheSize*1024**3))
+
     if args.poiAsNoi and args.theoryAgnostic == args.unfolding:
         raise ValueError("Option --poiAsNoi requires either --theoryAgnostic or --unfolding but not both")    
     if args.noHist and args.noStatUncFakes:
@@ -994,4 +1002,5 @@ if __name__ == "__main__":
             # in case of unfolding and hdf5, the xnorm histograms are directly written into the hdf5
             main(args, xnorm=True)
 
+    histCache.print_info()
     logging.summary()
@@ -8,6 +8,7 @@ import tensorflow_probability as tfp
 import matplotlib.pyplot as plt
 import narf.tfutils
 import math
+from utilities.h5pyutils import bindRawHists
 
 import matplotlib as mpl
 mpl.rcParams['figure.dpi'] = 300
@@ -29,7 +30,7 @@ procs.append("WminustaunuPostVFP")
 
 
 with h5py.File(infile, 'r') as f:
-    results = narf.ioutils.pickle_load_h5py(f["results"])
+    results = bindRawHists(narf.ioutils.pickle_load_h5py(f["results"]), f)
     for proc in procs:
         hist_response_proc = results[proc]["output"]["hist_qopr"].get()
         hist_response_scaled_proc = results[proc]["output"]["hist_qopr_shifted"].get()
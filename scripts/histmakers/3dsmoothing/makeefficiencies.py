@@ -5,6 +5,7 @@ import hdf5plugin
 import h5py
 import narf
 import ROOT
+from utilities.h5pyutils import bindRawHists
 
 #FIRST STEP IN EFFICIENCY CREATION
 
@@ -41,7 +42,7 @@ histos = []
 counter = 0
 for idx,filename in enumerate(histlist) :
     h5file = h5py.File(filename, "r")
-    results = narf.ioutils.pickle_load_h5py(h5file["results"])
+    results = bindRawHists(narf.ioutils.pickle_load_h5py(h5file["results"]), h5file)
     plus = results["WplusmunuPostVFP"]["output"]
     minus = results["WminusmunuPostVFP"]["output"]
     for i in range(0,len(listoflists[idx])):
@@ -12,6 +12,7 @@ args = parser.parse_args()
 
 import narf
 import wremnants
+wremnants.declare_headers("lowpu_utils.h", "lowpu_efficiencies.h", "lowpu_prefire.h", "lowpu_rochester.h", "electron_selections.h")
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
@@ -31,6 +32,7 @@ else:
     base_group = "Wenu"
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="e" else ["singleelectron"])),
                         mode="lowpu")
@@ -103,7 +105,7 @@ cols_mT = ["lep_pt", "lep_eta", "lep_charge", "transverseMass",  "passIso"]
 down_up_axis = hist.axis.Regular(2, -2., 2., underflow=False, overflow=False, name = "downUpVar")
 axis_cutFlow = hist.axis.Regular(1, 0, 1, name = "cutFlow")
 
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 args.noRecoil = True
@@ -468,6 +470,8 @@ def build_graph_cutFlow(df, dataset):
 
 
 resultdict = narf.build_and_run(datasets, build_graph)
+if not args.noRecoil:
+    recoilHelper.add_sparse_hists(resultdict)
 
 if not args.noScaleToData:
     scale_to_data(resultdict)
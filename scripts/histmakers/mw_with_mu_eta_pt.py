@@ -5,12 +5,14 @@ from utilities.common import background_MCprocs as bkgMCprocs
 from wremnants.datasets.datagroups import Datagroups
 
 parser,initargs = common.common_parser(True)
+parser = common.add_shard_args(parser)
 
 import ROOT
 import narf
 import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+wremnants.declare_headers("muon_calibration.h")
+from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils, skim_tools, syst_registry, shard_tools
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, check_memory
 from wremnants.datasets.dataset_tools import getDatasets
 import hist
 import lz4.frame
@@ -19,6 +21,7 @@ import time
 from utilities import boostHistHelpers as hh
 import pathlib
 import os
+import sys
 import numpy as np
 
 data_dir = common.data_dir
@@ -33,6 +36,7 @@ parser.add_argument("--onlyTheorySyst", action="store_true", help="Keep only the
 parser.add_argument("--oneMCfileEveryN", type=int, default=None, help="Use 1 MC file every N, where N is given by this option. Mainly for tests")
 parser.add_argument("--noAuxiliaryHistograms", action="store_true", help="Remove auxiliary histograms to save memory (removed by default with --unfolding or --theoryAgnostic)")
 parser.add_argument("--mtCut", type=int, default=40, help="Value for the transverse mass cut in the event selection")
+parser.add_argument("--cacheSkim", type=str, default=None, help="Directory to cache skims with the events passing the selection (produced once per dataset and selection configuration), which are read instead of the full input in later runs")
 
 args = parser.parse_args()
 
@@ -43,6 +47,11 @@ if args.poiAsNoi and not (args.theoryAgnostic or args.unfolding):
     logger.warning(message)
     raise NotImplementedError(message)
 
+if args.cacheSkim and (args.checkpointDir is not None or (args.shardJobs or 1) > 1):
+    # the skims are produced in a multithreaded event loop in this process, after which the shard workers can not be forked safely,
+    #   and each skimmed dataset is a single file which can not be split into shards anyway
+    raise ValueError("Option --cacheSkim can not be combined with --shardJobs or --checkpointDir")
+
 if args.theoryAgnostic or args.unfolding:
     parser = common.set_parser_default(parser, "excludeFlow", True)
     if args.theoryAgnostic:
@@ -70,6 +79,7 @@ thisAnalysis = ROOT.wrem.AnalysisType.Wmass
 
 era = args.era
 datasets = getDatasets(maxFiles=args.maxFiles,
+                       filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9", base_path=args.dataPath, oneMCfileEveryN=args.oneMCfileEveryN,
@@ -176,7 +186,7 @@ smearing_helper, smearing_uncertainty_helper = (None, None) if args.noSmearing e
 
 bias_helper = muon_calibration.make_muon_bias_helpers(args) if args.biasCalibration else None
 
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 if not args.noRecoil:
@@ -210,16 +220,69 @@ def setTheoryAgnosticGraph(df, results, dataset, reco_sel_GF, era, nominal_axes_
 ######################################################
     
 smearing_weights_procs = []
+syst_registries = {}
+
+def define_weight(df, dataset):
+    if dataset.is_data:
+        df = df.DefinePerSample("weight", "1.0")
+    else:
+        df = df.Define("weight", "std::copysign(1.0, genWeight)")
+    return df
+
+# event selection, also used to produce the skims with --cacheSkim
+def define_selection(df, dataset):
+    isQCDMC = dataset.group == "QCD"
+
+    cvh_helper = data_calibration_helper if dataset.is_data else mc_calibration_helper
+    jpsi_helper = data_jpsi_crctn_helper if dataset.is_data else mc_jpsi_crctn_helper
+
+    if not args.makeMCefficiency:
+        # remove trigger, it will be part of the efficiency selection for passing trigger
+        hltString="HLT_IsoTkMu24 || HLT_IsoMu24" if era == "2016PostVFP" else "HLT_IsoMu24"
+        df = df.Filter(hltString)
+
+    if args.halfStat:
+        df = df.Filter("event % 2 == 1") # test with odd/even events
+
+    df = muon_calibration.define_corrected_muons(df, cvh_helper, jpsi_helper, args, dataset, smearing_helper, bias_helper)
+
+    df = muon_selections.select_veto_muons(df, nMuons=1)
+    df = muon_selections.select_good_muons(df, 24, 100, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
+
+    # the corrected RECO muon kinematics, which is intended to be used as the nominal
+    df = muon_calibration.define_corrected_reco_muon_kinematics(df)
+
+    df = muon_selections.select_standalone_muons(df, dataset, args.trackerMuons, "goodMuons")
+ 
+    df = muon_selections.veto_electrons(df)
+    df = muon_selections.apply_met_filters(df)
+    if args.makeMCefficiency:
+        if dataset.group in common.background_MCprocs:
+            df = df.Define("GoodTrigObjs", "wrem::goodMuonTriggerCandidate(TrigObj_id,TrigObj_pt,TrigObj_l1pt,TrigObj_l2pt,TrigObj_filterBits)")
+        else:
+            df = df.Define("GoodTrigObjs", "wrem::goodMuonTriggerCandidate(TrigObj_id,TrigObj_filterBits)")
+        df = df.Define("passTrigger","(HLT_IsoTkMu24 || HLT_IsoMu24) && wrem::hasTriggerMatch(goodMuons_eta0,goodMuons_phi0,TrigObj_eta[GoodTrigObjs],TrigObj_phi[GoodTrigObjs])")
+
+    else:
+        df = muon_selections.apply_triggermatching_muon(df, dataset, "goodMuons_eta0", "goodMuons_phi0")
+
+    # gen match to bare muons to select only prompt muons from MC processes, but also including tau decays
+    # status flags in NanoAOD: https://cms-nanoaod-integration.web.cern.ch/autoDoc/NanoAODv9/2016ULpostVFP/doc_TTToSemiLeptonic_TuneCP5_13TeV-powheg-pythia8_RunIISummer20UL16NanoAODv9-106X_mcRun2_asymptotic_v17-v1.html
+    postFSRmuonDef = "GenPart_status == 1 && (GenPart_statusFlags & 1 || GenPart_statusFlags & (5<<1)) && abs(GenPart_pdgId) == 13"
+    if not dataset.is_data and not isQCDMC and not args.noGenMatchMC:
+        df = df.Define("postFSRmuons", postFSRmuonDef)
+        df = df.Filter("wrem::hasMatchDR2(goodMuons_eta0,goodMuons_phi0,GenPart_eta[postFSRmuons],GenPart_phi[postFSRmuons],0.09)")
+
+    return df
 
 def build_graph(df, dataset):
     logger.info(f"build graph for dataset: {dataset.name}")
-    results = []
+    results = syst_registry.SystHistRegistry(args.excludeNuisances, args.keepNuisances, merge=args.mergeSystHists)
     isW = dataset.name in common.wprocs
     isWmunu = dataset.name in ["WplusmunuPostVFP", "WminusmunuPostVFP"]
     isZ = dataset.name in common.zprocs
     isWorZ = isW or isZ
     isTop = dataset.group == "Top"
-    isQCDMC = dataset.group == "QCD"
     require_prompt = "tau" not in dataset.name # for muon GEN-matching   
     
     # disable auxiliary histograms when unfolding to reduce memory consumptions
@@ -227,15 +290,9 @@ def build_graph(df, dataset):
 
     apply_theory_corr = args.theoryCorr and dataset.name in corr_helpers
 
-    cvh_helper = data_calibration_helper if dataset.is_data else mc_calibration_helper
-    jpsi_helper = data_jpsi_crctn_helper if dataset.is_data else mc_jpsi_crctn_helper
-
-    if dataset.is_data:
-        df = df.DefinePerSample("weight", "1.0")
-    else:
-        df = df.Define("weight", "std::copysign(1.0, genWeight)")
+    df = define_weight(df, dataset)
 
-    weightsum = df.SumAndCount("weight")
+    weightsum = skim_tools.sum_weights(df, dataset, define_weight)
 
     axes = nominal_axes
     cols = nominal_cols
@@ -269,42 +326,7 @@ def build_graph(df, dataset):
                 cols = [*nominal_cols, *theoryAgnostic_cols]
                 theoryAgnostic_tools.add_xnorm_histograms(results, df, args, dataset.name, corr_helpers, qcdScaleByHelicity_helper, theoryAgnostic_axes, theoryAgnostic_cols)
 
-    if not args.makeMCefficiency:
-        # remove trigger, it will be part of the efficiency selection for passing trigger
-        hltString="HLT_IsoTkMu24 || HLT_IsoMu24" if era == "2016PostVFP" else "HLT_IsoMu24"
-        df = df.Filter(hltString)
-
-    if args.halfStat:
-        df = df.Filter("event % 2 == 1") # test with odd/even events
-
-    df = muon_calibration.define_corrected_muons(df, cvh_helper, jpsi_helper, args, dataset, smearing_helper, bias_helper)
-
-    df = muon_selections.select_veto_muons(df, nMuons=1)
-    df = muon_selections.select_good_muons(df, 24, 100, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
-
-    # the corrected RECO muon kinematics, which is intended to be used as the nominal
-    df = muon_calibration.define_corrected_reco_muon_kinematics(df)
-
-    df = muon_selections.select_standalone_muons(df, dataset, args.trackerMuons, "goodMuons")
- 
-    df = muon_selections.veto_electrons(df)
-    df = muon_selections.apply_met_filters(df)
-    if args.makeMCefficiency:
-        if dataset.group in common.background_MCprocs:
-            df = df.Define("GoodTrigObjs", "wrem::goodMuonTriggerCandidate(TrigObj_id,TrigObj_pt,TrigObj_l1pt,TrigObj_l2pt,TrigObj_filterBits)")
-        else:
-            df = df.Define("GoodTrigObjs", "wrem::goodMuonTriggerCandidate(TrigObj_id,TrigObj_filterBits)")
-        df = df.Define("passTrigger","(HLT_IsoTkMu24 || HLT_IsoMu24) && wrem::hasTriggerMatch(goodMuons_eta0,goodMuons_phi0,TrigObj_eta[GoodTrigObjs],TrigObj_phi[GoodTrigObjs])")
-
-    else:
-        df = muon_selections.apply_triggermatching_muon(df, dataset, "goodMuons_eta0", "goodMuons_phi0")
-
-    # gen match to bare muons to select only prompt muons from MC processes, but also including tau decays
-    # status flags in NanoAOD: https://cms-nanoaod-integration.web.cern.ch/autoDoc/NanoAODv9/2016ULpostVFP/doc_TTToSemiLeptonic_TuneCP5_13TeV-powheg-pythia8_RunIISummer20UL16NanoAODv9-106X_mcRun2_asymptotic_v17-v1.html
-    postFSRmuonDef = "GenPart_status == 1 && (GenPart_statusFlags & 1 || GenPart_statusFlags & (5<<1)) && abs(GenPart_pdgId) == 13"
-    if not dataset.is_data and not isQCDMC and not args.noGenMatchMC:
-        df = df.Define("postFSRmuons", postFSRmuonDef)
-        df = df.Filter("wrem::hasMatchDR2(goodMuons_eta0,goodMuons_phi0,GenPart_eta[postFSRmuons],GenPart_phi[postFSRmuons],0.09)")
+    df = define_selection(df, dataset)
 
     if isWorZ:
         df = muon_validation.define_cvh_reco_muon_kinematics(df)
@@ -432,6 +454,7 @@ def build_graph(df, dataset):
     elif isWmunu and args.theoryAgnostic and not hasattr(dataset, "out_of_acceptance"):
         results.append(df.HistoBoost("nominal", axes, [*cols, "nominal_weight_helicity"], tensor_axes=[axis_helicity]))
         setTheoryAgnosticGraph(df, results, dataset, reco_sel_GF, era, axes, cols, args)
+        syst_registries[dataset.name] = results
         # End graph here only for standard theory agnostic analysis, otherwise use same loop as traditional analysis
         return results, weightsum
 
@@ -465,62 +488,63 @@ def build_graph(df, dataset):
                 muon_validation.make_reco_over_gen_hists(df, results)
 
     if not dataset.is_data and not args.onlyMainHistograms:
-
-        if not args.onlyTheorySyst:
-            if not args.noScaleFactors:
-                df = syst_tools.add_muon_efficiency_unc_hists(results, df, muon_efficiency_helper_stat, muon_efficiency_helper_syst, axes, cols, what_analysis=thisAnalysis, smooth3D=args.smooth3dsf)
-            df = syst_tools.add_L1Prefire_unc_hists(results, df, muon_prefiring_helper_stat, muon_prefiring_helper_syst, axes, cols)
-            # luminosity, as shape variation despite being a flat scaling to facilitate propagation to fakes
-            df = syst_tools.add_luminosity_unc_hists(results, df, args, axes, cols)
-
-        # n.b. this is the W analysis so mass weights shouldn't be propagated
-        # on the Z samples (but can still use it for dummy muon scale)
-
-        if isWorZ:
-
-            df = syst_tools.add_theory_hists(results, df, args, dataset.name, corr_helpers, qcdScaleByHelicity_helper, axes, cols, for_wmass=True)
-
-            # Don't think it makes sense to apply the mass weights to scale leptons from tau decays
-            if not args.onlyTheorySyst and not "tau" in dataset.name:
-                df = syst_tools.add_muonscale_hist(results, df, args.muonCorrEtaBins, args.muonCorrMag, isW, axes, cols)
-                if args.muonScaleVariation == 'smearingWeightsGaus':
-                    df = syst_tools.add_muonscale_smeared_hist(results, df, args.muonCorrEtaBins, args.muonCorrMag, isW, axes, cols_gen_smeared)
-
-            ####################################################
-            # nuisances from the muon momemtum scale calibration 
-            if (args.muonCorrData in ["massfit", "lbl_massfit"]):
-                if diff_weights_helper:
-                    df = df.Define(f'{reco_sel_GF}_response_weight', diff_weights_helper,
-                        [
-                            f"{reco_sel_GF}_recoPt",
-                            f"{reco_sel_GF}_recoEta",
-                            f"{reco_sel_GF}_recoCharge",
-                            f"{reco_sel_GF}_genPt",
-                            f"{reco_sel_GF}_genEta",
-                            f"{reco_sel_GF}_genCharge"
-                        ]
+        # the systematic histograms below are booked without further filters and can be merged
+        with syst_registry.merged_hists(results):
+            if not args.onlyTheorySyst:
+                if not args.noScaleFactors:
+                    df = syst_tools.add_muon_efficiency_unc_hists(results, df, muon_efficiency_helper_stat, muon_efficiency_helper_syst, axes, cols, what_analysis=thisAnalysis, smooth3D=args.smooth3dsf)
+                df = syst_tools.add_L1Prefire_unc_hists(results, df, muon_prefiring_helper_stat, muon_prefiring_helper_syst, axes, cols)
+                # luminosity, as shape variation despite being a flat scaling to facilitate propagation to fakes
+                df = syst_tools.add_luminosity_unc_hists(results, df, args, axes, cols)
+
+            # n.b. this is the W analysis so mass weights shouldn't be propagated
+            # on the Z samples (but can still use it for dummy muon scale)
+
+            if isWorZ:
+
+                df = syst_tools.add_theory_hists(results, df, args, dataset.name, corr_helpers, qcdScaleByHelicity_helper, axes, cols, for_wmass=True)
+
+                # Don't think it makes sense to apply the mass weights to scale leptons from tau decays
+                if not args.onlyTheorySyst and not "tau" in dataset.name:
+                    df = syst_tools.add_muonscale_hist(results, df, args.muonCorrEtaBins, args.muonCorrMag, isW, axes, cols)
+                    if args.muonScaleVariation == 'smearingWeightsGaus':
+                        df = syst_tools.add_muonscale_smeared_hist(results, df, args.muonCorrEtaBins, args.muonCorrMag, isW, axes, cols_gen_smeared)
+
+                ####################################################
+                # nuisances from the muon momemtum scale calibration 
+                if (args.muonCorrData in ["massfit", "lbl_massfit"]):
+                    if diff_weights_helper:
+                        df = df.Define(f'{reco_sel_GF}_response_weight', diff_weights_helper,
+                            [
+                                f"{reco_sel_GF}_recoPt",
+                                f"{reco_sel_GF}_recoEta",
+                                f"{reco_sel_GF}_recoCharge",
+                                f"{reco_sel_GF}_genPt",
+                                f"{reco_sel_GF}_genEta",
+                                f"{reco_sel_GF}_genCharge"
+                            ]
+                        )
+
+                    # muon scale variation from stats. uncertainty on the jpsi massfit
+                    df = muon_calibration.add_jpsi_crctn_stats_unc_hists(
+                        args, df, axes, results, cols, cols_gen_smeared,
+                        calib_filepaths, jpsi_crctn_data_unc_helper, smearing_weights_procs,
+                        reco_sel_GF, dataset.name, isW
                     )
-
-                # muon scale variation from stats. uncertainty on the jpsi massfit
-                df = muon_calibration.add_jpsi_crctn_stats_unc_hists(
-                    args, df, axes, results, cols, cols_gen_smeared,
-                    calib_filepaths, jpsi_crctn_data_unc_helper, smearing_weights_procs,
-                    reco_sel_GF, dataset.name, isW
-                )
-                # add the ad-hoc Z non-closure nuisances from the jpsi massfit to muon scale unc
-                df = muon_calibration.add_jpsi_crctn_Z_non_closure_hists(
-                    args, df, axes, results, cols, cols_gen_smeared,
-                    z_non_closure_parametrized_helper, z_non_closure_binned_helper, reco_sel_GF
-                )
-                # add nuisances from the data/MC resolution mismatch
-                df = muon_calibration.add_resolution_uncertainty(df, axes, results, cols, smearing_uncertainty_helper, reco_sel_GF)
-                if args.validationHists:
-                    df = muon_validation.make_hists_for_muon_scale_var_weights(
-                        df, axes, results, cols, cols_gen_smeared
+                    # add the ad-hoc Z non-closure nuisances from the jpsi massfit to muon scale unc
+                    df = muon_calibration.add_jpsi_crctn_Z_non_closure_hists(
+                        args, df, axes, results, cols, cols_gen_smeared,
+                        z_non_closure_parametrized_helper, z_non_closure_binned_helper, reco_sel_GF
                     )
-            ####################################################
+                    # add nuisances from the data/MC resolution mismatch
+                    df = muon_calibration.add_resolution_uncertainty(df, axes, results, cols, smearing_uncertainty_helper, reco_sel_GF)
+                    if args.validationHists:
+                        df = muon_validation.make_hists_for_muon_scale_var_weights(
+                            df, axes, results, cols, cols_gen_smeared
+                        )
+                ####################################################
 
-            df = df.Define("Muon_cvhMomCov", "wrem::splitNestedRVec(Muon_cvhMomCov_Vals, Muon_cvhMomCov_Counts)")
+                df = df.Define("Muon_cvhMomCov", "wrem::splitNestedRVec(Muon_cvhMomCov_Vals, Muon_cvhMomCov_Counts)")
 
     if hasattr(dataset, "out_of_acceptance"):
         # Rename dataset to not overwrite the original one
@@ -528,9 +552,34 @@ def build_graph(df, dataset):
             smearing_weights_procs[-1] = "Bkg"+dataset.name
         dataset.name = "Bkg"+dataset.name
 
+    syst_registries[dataset.name] = results
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+if args.dryRun or args.memoryBudget is not None:
+    # the event loop is sharded with a checkpoint directory or more than one job (see shard_tools.build_and_run)
+    njobs = max(args.shardJobs or 1, 1) if args.checkpointDir is not None or (args.shardJobs or 1) > 1 else None
+    args.nThreads = check_memory(datasets, build_graph, args.nThreads, args.memoryBudget, njobs=njobs)
+    if args.dryRun:
+        sys.exit(0)
+
+if args.cacheSkim:
+    # options that change the event selection (or the helpers used in it)
+    skim_config = {k: getattr(args, k) for k in ["era", "makeMCefficiency", "halfStat", "trackerMuons", "noGenMatchMC", 
+        "muonCorrMC", "muonCorrData", "biasCalibration", "noSmearing"]}
+    # histograms for the unfolding and theory agnostic analyses are filled before the selection
+    skip_skim = lambda dataset: (args.unfolding and dataset.name in common.wprocs) or (args.theoryAgnostic and dataset.name in ["WplusmunuPostVFP", "WminusmunuPostVFP"])
+    datasets = skim_tools.make_skims(datasets, define_selection, args.cacheSkim, skim_config, skip=skip_skim)
+
+def postprocess(resultdict):
+    syst_registry.split_merged_hists(resultdict, syst_registries)
+    if not args.noRecoil:
+        recoilHelper.add_sparse_hists(resultdict)
+
+resultdict = shard_tools.build_and_run(datasets, build_graph, njobs=args.shardJobs, nthreads=args.nThreads, 
+    shards_per_job=args.shardsPerJob, balance=args.shardBalance, 
+    postprocess=postprocess, 
+    state={"smearing_weights_procs" : smearing_weights_procs}, 
+    checkpoint_dir=args.checkpointDir, resume=args.resume, config=shard_tools.checkpoint_config(args))
 if not args.onlyMainHistograms and args.muonScaleVariation == 'smearingWeightsGaus' and not (args.theoryAgnostic and not args.poiAsNoi):
     logger.debug("Apply smearingWeights")
     muon_calibration.transport_smearing_weights_to_reco(
@@ -2,11 +2,13 @@ from utilities import boostHistHelpers as hh, common, logging, differential
 from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser(True)
+parser = common.add_shard_args(parser)
 
 import ROOT
 import narf
 import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
+wremnants.declare_headers()
+from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools, shard_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
 from wremnants.datasets.datagroups import Datagroups
@@ -35,6 +37,7 @@ thisAnalysis = ROOT.wrem.AnalysisType.Dilepton if args.useDileptonTriggerSelecti
 era = args.era
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=args.excludeProcs, 
                         nanoVersion="v9",
@@ -135,7 +138,7 @@ smearing_helper, smearing_uncertainty_helper = (None, None) if args.noSmearing e
 
 bias_helper = muon_calibration.make_muon_bias_helpers(args) 
 
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 def build_graph(df, dataset):
     logger.info(f"build graph for dataset: {dataset.name}")
@@ -396,7 +399,9 @@ def build_graph(df, dataset):
     
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+resultdict = shard_tools.build_and_run(datasets, build_graph, njobs=args.shardJobs, nthreads=args.nThreads, 
+    shards_per_job=args.shardsPerJob, balance=args.shardBalance, 
+    checkpoint_dir=args.checkpointDir, resume=args.resume, config=shard_tools.checkpoint_config(args))
 
 if not args.noScaleToData:
     scale_to_data(resultdict)
@@ -14,6 +14,7 @@ logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 import narf
 import wremnants
+wremnants.declare_headers("lowpu_utils.h", "lowpu_efficiencies.h", "lowpu_prefire.h", "lowpu_rochester.h", "electron_selections.h")
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
@@ -31,6 +32,7 @@ mass_min = 60
 mass_max = 120
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="ee" else ["singleelectron"])),
                         mode="lowpu"
@@ -84,7 +86,7 @@ axis_mt = hist.axis.Regular(200, 0., 200., name = "mt", underflow=False)
 axes_mT = [axis_mt]
 cols_mT = ["transverseMass"]
 
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 args.noRecoil = True
@@ -347,6 +349,8 @@ def build_graph(df, dataset):
     return results, weightsum
 
 resultdict = narf.build_and_run(datasets, build_graph)
+if not args.noRecoil:
+    recoilHelper.add_sparse_hists(resultdict)
 
 if not args.noScaleToData:
     scale_to_data(resultdict)
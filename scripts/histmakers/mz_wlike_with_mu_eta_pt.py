@@ -6,6 +6,7 @@ parser,initargs = common.common_parser(True)
 import ROOT
 import narf
 import wremnants
+wremnants.declare_headers()
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
@@ -35,6 +36,7 @@ thisAnalysis = ROOT.wrem.AnalysisType.Wlike
 era = args.era
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=args.excludeProcs, 
                         nanoVersion="v9", base_path=args.dataPath,
@@ -111,7 +113,7 @@ smearing_helper, smearing_uncertainty_helper = (None, None) if args.noSmearing e
 
 bias_helper = muon_calibration.make_muon_bias_helpers(args) if args.biasCalibration else None
 
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 if not args.noRecoil:
@@ -328,6 +330,8 @@ def build_graph(df, dataset):
     return results, weightsum
 
 resultdict = narf.build_and_run(datasets, build_graph)
+if not args.noRecoil:
+    recoilHelper.add_sparse_hists(resultdict)
 
 if not args.noScaleToData:
     scale_to_data(resultdict)
@@ -5,6 +5,7 @@ parser,initargs = common.common_parser()
 
 import narf
 import wremnants
+wremnants.declare_headers()
 from wremnants import theory_tools,syst_tools,theory_corrections
 from wremnants.datasets.dataset_tools import getDatasets
 import hist
@@ -31,6 +32,7 @@ args = parser.parse_args()
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=args.excludeProcs, 
                         nanoVersion="v9", base_path=args.dataPath, mode='gen')
@@ -84,7 +86,7 @@ axis_chargeZgen = hist.axis.Integer(
 axis_l_eta_gen = hist.axis.Regular(48, -2.4, 2.4, name = "eta")
 axis_l_pt_gen = hist.axis.Regular(29, 26., 55., name = "pt")
 
-corr_helpers = theory_corrections.load_corr_helpers(common.vprocs, args.theoryCorr)
+corr_helpers = theory_corrections.load_corr_helpers(common.vprocs, args.theoryCorr, cache_dir=args.theoryCorrCacheDir)
 
 def build_graph(df, dataset):
     logger.info("build graph")
@@ -6,6 +6,7 @@ parser,initargs = common.common_parser(True)
 
 import narf
 import wremnants
+wremnants.declare_headers("muon_calibration.h")
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools
 from wremnants.histmaker_tools import scale_to_data, aggregate_groups
 from wremnants.datasets.dataset_tools import getDatasets
@@ -27,6 +28,7 @@ args = parser.parse_args()
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 datasets = getDatasets(maxFiles=args.maxFiles,
+                        filelist_cache=args.fileListCacheDir, filelist_cache_ttl=args.fileListCacheTTL,
                         filt=args.filterProcs,
                         excl=args.excludeProcs,
                         nanoVersion="v9", base_path=args.dataPath)
@@ -0,0 +1,78 @@
+import argparse
+import os
+import pathlib
+import subprocess
+import sys
+import time
+import numpy as np
+
+from utilities import logging
+
+# Measure the startup time of typical imports and scripts, each in a fresh interpreter,
+#   e.g. to check that the postprocessing scripts do not initialize ROOT and declare the headers of the histmakers
+
+base_dir = f"{pathlib.Path(__file__).parent}/../.."
+
+benchmarks = {
+    "import wremnants" : ["-c", "import wremnants"],
+    "import datagroups" : ["-c", "from wremnants.datasets.datagroups import Datagroups"],
+    "import CardTool" : ["-c", "from wremnants import CardTool"],
+    "common_parser" : ["-c", "from utilities import common; common.common_parser(True)"],
+    "declare headers" : ["-c", "import wremnants; wremnants.declare_headers()"],
+    "setupCombine --help" : [f"{base_dir}/scripts/combine/setupCombine.py", "--help"],
+    "makeDataMCStackPlot --help" : [f"{base_dir}/scripts/plotting/makeDataMCStackPlot.py", "--help"],
+    "browse_hdf5 --help" : [f"{base_dir}/scripts/utilities/browse_hdf5.py", "--help"],
+    "mw_with_mu_eta_pt --help" : [f"{base_dir}/scripts/histmakers/mw_with_mu_eta_pt.py", "--help"],
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--nRepeat", type=int, default=3, help="Number of times each benchmark is run")
+parser.add_argument("-b", "--benchmarks", type=str, nargs="*", default=list(benchmarks.keys()), choices=list(benchmarks.keys()), help="Benchmarks to run")
+parser.add_argument("--importTime", action="store_true", help="Also print the slowest imports (from python -X importtime) of each benchmark")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
+parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
+args = parser.parse_args()
+
+logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
+
+def slowest_imports(stderr, n=5):
+    # cumulative times (in us) from the output of python -X importtime
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative), name.strip()))
+    return sorted(entries, reverse=True)[:n]
+
+def run(cmd, import_time=False):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([base_dir, env.get("PYTHONPATH", "")])
+    command = [sys.executable, *(["-X", "importtime"] if import_time else []), *cmd]
+    start = time.time()
+    proc = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.time()-start, proc
+
+results = {}
+for name in args.benchmarks:
+    times = []
+    for i in range(args.nRepeat):
+        elapsed, proc = run(benchmarks[name])
+        if proc.returncode != 0:
+            logger.warning(f"Benchmark '{name}' failed with exit code {proc.returncode}")
+            logger.debug(proc.stderr)
+            break
+        times.append(elapsed)
+    if not times:
+        continue
+    results[name] = times
+    logger.info(f"{name}: {np.median(times):.2f} s (min {min(times):.2f} s, max {max(times):.2f} s)")
+
+    if args.importTime:
+        _, proc = run(benchmarks[name], import_time=True)
+        for cumulative, module in slowest_imports(proc.stderr):
+            logger.info(f"    {module}: {cumulative/1e6:.2f} s")
+
+print(f"{'benchmark':<30} {'median [s]':>10} {'min [s]':>10}")
+for name, times in results.items():
+    print(f"{name:<30} {np.median(times):>10.2f} {min(times):>10.2f}")
@@ -13,6 +13,7 @@ import hdf5plugin
 import h5py
 import narf
 from narf import ioutils
+from utilities.h5pyutils import H5RawHist, bindRawHists
 import ROOT
 
 logger = logging.child_logger(__name__)
@@ -39,7 +40,7 @@ if __name__ == "__main__":
      args = parser.parse_args()
 
      h5file = h5py.File(args.inputfile[0], "r")
-     results = narf.ioutils.pickle_load_h5py(h5file["results"])
+     results = bindRawHists(narf.ioutils.pickle_load_h5py(h5file["results"]), h5file)
 
      if args.printMode == "all":
           print(results)
@@ -68,10 +69,15 @@ if __name__ == "__main__":
                      print(f"{space}{k}")                         
                      if not args.noAxes:
                           histObj = results[p]['output'][k]
-                          if isinstance(histObj, ioutils.H5PickleProxy):
-                               histObj = histObj.get()
-                          print(f"{space}  Axes = {histObj.axes.name}")
-                          for n in histObj.axes:
+                          if isinstance(histObj, H5RawHist):
+                               # only the axes metadata is read for histograms in raw layout
+                               histAxes = histObj.axes()
+                          else:
+                               if isinstance(histObj, ioutils.H5PickleProxy):
+                                    histObj = histObj.get()
+                               histAxes = histObj.axes
+                          print(f"{space}  Axes = {tuple(n.name for n in histAxes)}")
+                          for n in histAxes:
                                if args.axis and n.name != args.axis:
                                     continue
                                print(f"{space}{space} {n}")
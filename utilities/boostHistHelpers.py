@@ -6,81 +6,198 @@ from utilities import common, logging
 
 logger = logging.child_logger(__name__)
 
-def valsAndVariances(h1, h2, flow=True):
-    return h1.values(flow=flow),h2.values(flow=flow),h1.variances(flow=flow),h2.variances(flow=flow)
-
-# Broadcast h1 to match the shape of h2
-def broadcastSystHist(h1, h2, flow=True, by_ax_name=True):
-    if h1.ndim > h2.ndim or h1.shape == h2.shape:
-        return h1
-
-    s1 = h1.values(flow=flow).shape 
-    s2 = h2.values(flow=flow).shape
+# Kernel layer: operations on the value and variance arrays of histograms, 
+#   the inputs are views into the storage of the histograms (broadcasted with strides, i.e. without copies) 
+#   and the results are written into preallocated output arrays (out=), which may be the storage of one of the inputs
+
+def viewArrays(h, flow=True):
+    # values and variances of a histogram as views into its storage (for Weight storage the fields of the structured view)
+    if h.storage_type == hist.storage.Weight:
+        view = h.view(flow=flow)
+        return view.value, view.variance
+    return h.values(flow=flow), h.variances(flow=flow)
+
+def outputArrays(h, flow=True):
+    # arrays to write the values and variances of a histogram into (variances are None if the storage has none)
+    if h.storage_type == hist.storage.Weight:
+        view = h.view(flow=flow)
+        return view.value, view.variance
+    return h.values(flow=flow), None
+
+def axesShape(axes, flow=True):
+    return tuple(ax.extent if flow else ax.size for ax in axes)
+
+def needsBroadcast(h, axes):
+    return not (h.ndim > len(axes) or h.shape == axesShape(axes, flow=False))
+
+def broadcastArray(arr, axes_names, axes, flow=True, by_ax_name=True):
+    # broadcast an array with axes 'axes_names' to the shape of 'axes', as a read only view with zero strides along the new axes
+    s1 = arr.shape
+    s2 = axesShape(axes, flow)
 
     # the additional axes have to be broadcasted as leading
     # Either do this by name, or by broadcasting from the right (numpy default broadcasts from left)
     if by_ax_name:
-        moves = {i: e for i, (e, n2) in enumerate(zip(s2, h2.axes.name)) if n2 not in h1.axes.name}
+        moves = {i: e for i, (e, n2) in enumerate(zip(s2, axes.name)) if n2 not in axes_names}
     else:
-        moves = {h2.ndim-1-i: h2.values(flow=flow).shape[h2.ndim-1-i] for i in range(h2.ndim-h1.ndim)}
+        moves = {len(s2)-1-i: s2[len(s2)-1-i] for i in range(len(s2)-len(s1))}
 
     broadcast_shape = list(moves.values()) + list(s1)
 
     try:
-        new_vals = np.broadcast_to(h1.values(flow=flow), broadcast_shape)
+        new_arr = np.broadcast_to(arr, broadcast_shape)
     except ValueError as e:
         raise ValueError("Cannot broadcast hists with incompatible axes!\n" 
-                         f"    h1.shape {h1.shape}; h2.shape: {h2.shape}\n"
-                         f"    h1.axes: {h1.axes}\n"
-                         f"    h2.axes: {h2.axes}")
+                         f"    h1.shape {s1}; h2.shape: {s2}\n"
+                         f"    h1.axes: {axes_names}\n"
+                         f"    h2.axes: {axes.name}")
 
     # move back to original order
-    new_vals = np.moveaxis(new_vals, np.arange(len(moves)), list(moves.keys()))
-
-    if new_vals.shape != h2.values(flow=flow).shape:
-        raise ValueError(f"Broadcast shape {new_vals.shape} (from h1.shape={h1.values(flow=flow).shape}, axes={h1.axes.name}) " \
-                            f"does not match desired shape {h2.view(flow=flow).shape} (axes={h2.axes.name})")
+    new_arr = np.moveaxis(new_arr, np.arange(len(moves)), list(moves.keys()))
 
-    if h1.storage_type == hist.storage.Weight:
-        new_vars = np.broadcast_to(h1.variances(flow=flow), broadcast_shape)
-        new_vars = np.moveaxis(new_vars, np.arange(len(moves)), list(moves.keys()))
-        new_vals = np.stack((new_vals, new_vars), axis=-1)
+    if new_arr.shape != s2:
+        raise ValueError(f"Broadcast shape {new_arr.shape} (from h1.shape={s1}, axes={axes_names}) " \
+                            f"does not match desired shape {s2} (axes={axes.name})")
 
-    return hist.Hist(*h2.axes, data=new_vals, storage=h1.storage_type())
+    return new_arr
 
-# returns h1/h2
-def divideHists(h1, h2, cutoff=1e-5, allowBroadcast=True, rel_unc=False, cutoff_val=1., flow=True, createNew=True, by_ax_name=True):
-    if allowBroadcast:
-        h1 = broadcastSystHist(h1, h2, flow, by_ax_name)
-        h2 = broadcastSystHist(h2, h1, flow, by_ax_name)
+def broadcastArrays(h, axes, flow=True, by_ax_name=True):
+    # values and variances of h broadcasted to the shape of 'axes'
+    vals, varis = viewArrays(h, flow=flow)
+    vals = broadcastArray(vals, h.axes.name, axes, flow, by_ax_name)
+    if varis is not None:
+        varis = broadcastArray(varis, h.axes.name, axes, flow, by_ax_name)
+    return vals, varis
+
+def broadcastOperands(h1, h2, flow=True, by_ax_name=True, allowBroadcast=True):
+    # values and variances of two histograms, broadcasted to common axes in the same way as broadcastSystHist(h1, h2) and broadcastSystHist(h2, h1)
+    #   returns the common axes and the arrays of h1 and h2
+    axes = h1.axes
+    if allowBroadcast and needsBroadcast(h1, h2.axes):
+        axes = h2.axes
+        arrs1 = broadcastArrays(h1, axes, flow, by_ax_name)
+    else:
+        arrs1 = viewArrays(h1, flow)
 
-    storage = h1.storage_type() if h1.storage_type == h2.storage_type else hist.storage.Double()
-    outh = hist.Hist(*h1.axes, storage=storage) if createNew else h1
+    if allowBroadcast and needsBroadcast(h2, axes):
+        arrs2 = broadcastArrays(h2, axes, flow, by_ax_name)
+    else:
+        arrs2 = viewArrays(h2, flow)
 
-    h1vals,h2vals,h1vars,h2vars = valsAndVariances(h1, h2, flow=flow)
+    return axes, arrs1, arrs2
 
-    # Careful not to overwrite the values of h1
-    out = outh.values(flow=flow) if createNew else np.full(outh.values(flow=flow).shape, cutoff_val)
+def divideArrays(vals1, vals2, vars1=None, vars2=None, out=None, out_vars=None, cutoff=1e-5, rel_unc=False, cutoff_val=1., fill_val=0.):
+    # vals1/vals2 into out, with cutoff_val where both are below the cutoff and fill_val where only the denominator is below the cutoff
+    #   the variances are only computed if out_vars is given
+    if out is None:
+        out = np.empty(np.broadcast_shapes(vals1.shape, vals2.shape))
 
-    # Apply cutoff to both numerator and denominator
-    cutoff_criteria = np.abs(h2vals) > cutoff
+    # masks and relative variances before writing the output, which may share memory with the inputs
+    abs2 = np.abs(vals2)
+    cutoff_criteria = abs2 > cutoff
     # By the argument that 0/0 = 1
-    out[(np.abs(h2vals) < cutoff) & (np.abs(h1vals) < cutoff)] = cutoff_val
-    val = np.divide(h1vals, h2vals, out=out, where=cutoff_criteria)
+    both_small = (abs2 < cutoff) & (np.abs(vals1) < cutoff)
+    abs2 = None
 
-    if outh.storage_type == hist.storage.Weight:
-        relvars = relVariances(h1vals, h2vals, h1vars, h2vars, cutoff=cutoff)
-        val2 = np.multiply(val, val)
+    if out_vars is not None:
+        rel1 = relVariance(vals1, vars1, cutoff=cutoff)
+        rel2 = None if rel_unc else relVariance(vals2, vars2, cutoff=cutoff)
+
+    np.divide(vals1, vals2, out=out, where=cutoff_criteria)
+    np.copyto(out, fill_val, where=~cutoff_criteria)
+    out[both_small] = cutoff_val
+
+    if out_vars is not None:
         if rel_unc:
             # Treat the divisor as a constant
-            var = np.multiply(val2, relvars[0], out=val2)
+            relsum = rel1
         else:
-            relsum = np.add(*relvars)
-            var = np.multiply(relsum, val2, out=val2)
+            relsum = np.add(rel1, rel2, out=rel1)
+        np.multiply(out, out, out=out_vars)
+        np.multiply(out_vars, relsum, out=out_vars)
+
+    return out, out_vars
+
+def multiplyArrays(vals1, vals2, vars1=None, vars2=None, out=None, out_vars=None):
+    # vals1*vals2 into out, the variances are only computed if all variances are given
+    if out is None:
+        out = np.empty(np.broadcast_shapes(vals1.shape, vals2.shape))
+    with_variance = vars1 is not None and vars2 is not None
+    if with_variance:
+        if out_vars is None:
+            out_vars = np.empty(out.shape)
+        # relative variances before writing the output, which may share memory with the inputs
+        relvar1, relvar2 = relVariances(vals1, vals2, vars1, vars2)
+        np.add(relvar1, relvar2, out=relvar1)
 
-        outh.view(flow=flow)[...] = np.stack((val, var), axis=-1)
-    else:
-        outh.values(flow=flow)[...] = val
+    np.multiply(vals1, vals2, out=out)
+
+    if with_variance:
+        np.multiply(out, out, out=out_vars)
+        np.multiply(out_vars, relvar1, out=out_vars)
+
+    return out, out_vars if with_variance else None
+
+def scaleAndAdd(arr1, arr2, out, scale1=None, scale2=None):
+    # scale1*arr1 + scale2*arr2 into out, which may be arr1
+    if scale2 is not None:
+        arr2 = scale2 * arr2
+    if scale1 is not None:
+        np.multiply(scale1, arr1, out=out)
+        arr1 = out
+    return np.add(arr1, arr2, out=out)
+
+def addArrays(vals1, vals2, vars1=None, vars2=None, out=None, out_vars=None, scale1=None, scale2=None):
+    # scale1*vals1 + scale2*vals2 into out, the variances are only computed if out_vars is given
+    if out is None:
+        out = np.empty(np.broadcast_shapes(vals1.shape, vals2.shape))
+    scaleAndAdd(vals1, vals2, out, scale1, scale2)
+    if out_vars is not None:
+        scaleAndAdd(vars1, vars2, out_vars, 
+            None if scale1 is None else scale1*scale1, None if scale2 is None else scale2*scale2)
+    return out, out_vars
+
+def scaleArrays(vals, varis=None, scale=1., out=None, out_vars=None):
+    # scale*vals into out, and scale^2*varis into out_vars if given
+    out = np.multiply(scale, vals, out=out)
+    if out_vars is not None:
+        np.multiply(scale*scale, varis, out=out_vars)
+    return out, out_vars
+
+# Histogram operations
+
+def valsAndVariances(h1, h2, flow=True):
+    return h1.values(flow=flow),h2.values(flow=flow),h1.variances(flow=flow),h2.variances(flow=flow)
+
+# Broadcast h1 to match the shape of h2
+def broadcastSystHist(h1, h2, flow=True, by_ax_name=True):
+    if not needsBroadcast(h1, h2.axes):
+        return h1
+
+    vals, varis = broadcastArrays(h1, h2.axes, flow, by_ax_name)
+
+    hnew = hist.Hist(*h2.axes, storage=h1.storage_type())
+    out, out_vars = outputArrays(hnew, flow)
+    out[...] = vals
+    if out_vars is not None:
+        out_vars[...] = varis
+
+    return hnew
+
+# returns h1/h2
+def divideHists(h1, h2, cutoff=1e-5, allowBroadcast=True, rel_unc=False, cutoff_val=1., flow=True, createNew=True, by_ax_name=True):
+    if allowBroadcast and not createNew:
+        # the output is h1, which needs its full shape
+        h1 = broadcastSystHist(h1, h2, flow, by_ax_name)
+
+    axes, (h1vals, h1vars), (h2vals, h2vars) = broadcastOperands(h1, h2, flow, by_ax_name, allowBroadcast)
+
+    storage = h1.storage_type() if h1.storage_type == h2.storage_type else hist.storage.Double()
+    outh = hist.Hist(*axes, storage=storage) if createNew else h1
+
+    out, out_vars = outputArrays(outh, flow)
+    divideArrays(h1vals, h2vals, h1vars, h2vars, out=out, out_vars=out_vars, cutoff=cutoff, rel_unc=rel_unc, 
+        cutoff_val=cutoff_val, fill_val=0. if createNew else cutoff_val)
 
     return outh
 
@@ -115,72 +232,51 @@ def sqrtHist(h):
     return rooth
 
 def multiplyWithVariance(vals1, vals2, vars1=None, vars2=None):
-    outvals = np.empty(vals1.shape)
-    outvars = np.empty(vars1.shape) if (vars1 is not None and vars2 is not None) else None
-    np.multiply(vals1, vals2, out=outvals)
-    if outvars is not None:
-        np.multiply(outvals, outvals, out=outvars)
-        relvar1, relvar2 = relVariances(vals1, vals2, vars1, vars2)
-        np.add(relvar1, relvar2, out=relvar1)
-        np.multiply(outvars, relvar1, out=outvars)
-        
-    return outvals, outvars
+    return multiplyArrays(vals1, vals2, vars1, vars2)
 
 def multiplyHists(h1, h2, allowBroadcast=True, createNew=True, flow=True):
-    if allowBroadcast:
-        h1 = broadcastSystHist(h1, h2, flow=flow)
-        h2 = broadcastSystHist(h2, h1, flow=flow)
-
     if h1.storage_type == hist.storage.Double and h2.storage_type == hist.storage.Double:
+        if allowBroadcast:
+            h1 = broadcastSystHist(h1, h2, flow=flow)
+            h2 = broadcastSystHist(h2, h1, flow=flow)
         return h1*h2 
 
+    if allowBroadcast and not createNew:
+        # the output is h1, which needs its full shape
+        h1 = broadcastSystHist(h1, h2, flow=flow)
+
+    axes, (h1vals, h1vars), (h2vals, h2vars) = broadcastOperands(h1, h2, flow, allowBroadcast=allowBroadcast)
+
     with_variance = h1.storage_type == hist.storage.Weight and h2.storage_type == hist.storage.Weight
-    outh = h1
-    vals, varis = multiplyWithVariance(h1.values(flow=flow), h2.values(flow=flow), 
-                        h1.variances(flow=flow) if with_variance else None, h2.variances(flow=flow) if with_variance else None)
+    outh = hist.Hist(*axes, storage=h1.storage_type()) if createNew else h1
 
-    if createNew:
-        outh = hist.Hist(*outh.axes, storage=outh.storage_type())
-    outh.values(flow=flow)[...] = vals
-    if varis is not None:
-        outh.variances(flow=flow)[...] = varis
+    out, out_vars = outputArrays(outh, flow)
+    if with_variance:
+        multiplyArrays(h1vals, h2vals, h1vars, h2vars, out=out, out_vars=out_vars)
+    else:
+        multiplyArrays(h1vals, h2vals, out=out)
 
     return outh
 
 def addHists(h1, h2, allowBroadcast=True, createNew=True, scale1=None, scale2=None, flow=True, by_ax_name=True):
-    if allowBroadcast:
+    if allowBroadcast and not createNew:
+        # the output is h1, which needs its full shape
         h1 = broadcastSystHist(h1, h2, flow=flow, by_ax_name=by_ax_name)
-        h2 = broadcastSystHist(h2, h1, flow=flow, by_ax_name=by_ax_name)
 
-    h1vals,h2vals,h1vars,h2vars = valsAndVariances(h1, h2, flow=flow)
+    axes, (h1vals, h1vars), (h2vals, h2vars) = broadcastOperands(h1, h2, flow, by_ax_name, allowBroadcast)
+
     hasWeights = h1._storage_type() == hist.storage.Weight() and h2._storage_type() == hist.storage.Weight()
-    # avoid scaling the variance if not needed, to save some time
-    # I couldn't use hvals *= scale, otherwise I get this error: ValueError: output array is read-only
-    if scale1 is not None:
-        h1vals = scale1 * h1vals
-        if hasWeights:
-            h1vars = (scale1*scale1) * h1vars
-    if scale2 is not None:
-        h2vals = scale2 * h2vals
-        if hasWeights:
-            h2vars = (scale2*scale2) * h2vars
-                    
-    outh = h1
+
     if createNew:
-        if not hasWeights:
-            return hist.Hist(*outh.axes, data=h1vals+h2vals)
-        else:
-            return hist.Hist(*outh.axes, storage=hist.storage.Weight(),
-                            data=np.stack((h1vals+h2vals, h1vars+h2vars), axis=-1))            
+        outh = hist.Hist(*axes, storage=hist.storage.Weight() if hasWeights else hist.storage.Double())
     else:
-        outvals = h1vals if h1.shape == outh.shape else h2vals
-        np.add(h1vals, h2vals, out=outvals)
-        outh.values(flow=True)[...] = outvals
-        if hasWeights:
-            outvars = h1vars if h1.shape == outh.shape else h2vars
-            np.add(h1vars, h2vars, out=outvars)
-            outh.variances(flow=True)[...] = outvars
-        return outh
+        outh = h1
+
+    out, out_vars = outputArrays(outh, flow)
+    # avoid computing the variance if not needed, to save some time
+    addArrays(h1vals, h2vals, h1vars, h2vars, out=out, out_vars=out_vars if hasWeights else None, scale1=scale1, scale2=scale2)
+
+    return outh
 
 def sumHists(hists):
     return reduce(addHists, hists)
@@ -249,16 +345,14 @@ def scaleHist(h, scale, createNew=True, flow=True):
             hnew = hist.Hist(*h.axes)
         else:
             hnew = hist.Hist(*h.axes, storage=hist.storage.Weight())
-            hnew.variances(flow=flow)[...] = scale*scale * h.variances(flow=flow)
+    else:
+        hnew = h
 
-        hnew.values(flow=flow)[...] = scale * h.values(flow=flow)
+    vals, varis = viewArrays(h, flow)
+    out, out_vars = outputArrays(hnew, flow)
+    scaleArrays(vals, varis, scale, out=out, out_vars=out_vars)
 
-        return hnew
-    else:
-        h.values(flow=flow)[...] *= scale
-        if h.storage_type == hist.storage.Weight:
-            h.variances(flow=flow)[...] *= scale*scale
-        return h
+    return hnew
     
 def normalize(h, scale=1e6, createNew=True):
     scale = scale/h.sum(flow=True).value
@@ -440,17 +534,21 @@ def projectNoFlow(h, proj_ax, exclude=[]):
 
 def syst_min_and_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=[]):
     logger.debug(f"Taking the envelope of variation axis {syst_ax}, indices {indices}")
-    hup = syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=no_flow, do_min=False)
-    hdown = syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=no_flow, do_min=True)
+    hdown, hup = syst_env_hists(h, proj_ax, syst_ax, indices, no_flow=no_flow, do_min=[True, False])
     hnew = hist.Hist(*hup.axes, common.down_up_axis, storage=hup.storage_type())
     hnew[...,0] = hdown.view(flow=True)
     hnew[...,1] = hup.view(flow=True)
     return hnew
 
 def syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=[], do_min=True):
+    return syst_env_hists(h, proj_ax, syst_ax, indices, no_flow=no_flow, do_min=[do_min])[0]
+
+def syst_env_hists(h, proj_ax, syst_ax, indices, no_flow=[], do_min=[True, False]):
+    # min (do_min=True) and/or max envelopes of the variations, the variation is chosen on the projection on proj_ax, 
+    #   all envelopes are derived from a single projection and selection of the variations
     if syst_ax not in h.axes.name:
         logger.warning(f"Did not find syst axis {syst_ax} in histogram. Returning nominal!")
-        return h
+        return [h]*len(do_min)
 
     # Keep the order of the hist
     proj_ax = [ax for ax in h.axes.name if ax in proj_ax]
@@ -460,7 +558,7 @@ def syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=[], do_min=Tr
 
     if len(indices) < 2:
         logger.warning(f"Requires at least two histograms for envelope. Returning nominal!")
-        return h
+        return [h]*len(do_min)
 
     if type(indices[0]) == str:
         if all(x.isdigit() for x in indices):
@@ -470,7 +568,7 @@ def syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=[], do_min=Tr
 
     if max(indices) > h.axes[syst_ax].size:
         logger.warning(f"Range of indices exceeds length of syst axis '{syst_ax}.' Returning nominal!")
-        return h
+        return [h]*len(do_min)
 
     if syst_ax in proj_ax:
         proj_ax.pop(proj_ax.index(syst_ax))
@@ -491,21 +589,27 @@ def syst_min_or_max_env_hist(h, proj_ax, syst_ax, indices, no_flow=[], do_min=Tr
         names.insert(-1, names.pop(idx))
         # Moves axis to second to last position
         fullview = np.moveaxis(fullview, idx, -2)
-    
-    op = np.argmin if do_min else np.argmax
-    # Index of min/max values considering only the eventual projection  
-    idx = op(view.value if hasattr(view, "value") else view, axis=-1)
-    opview = fullview[(*np.indices(fullview.shape[:-1]), idx)]
-
-    hnew = h[{syst_ax : 0}]
-    # Now that the syst ax has been collapsed, project axes will be at last position
-    # Move the axes back to where they belong
-    names = list(h.axes.name)
-    for idx in reversed(initial_order):
-        opview = np.moveaxis(opview, -1, idx)
 
-    hnew[...] = opview
-    return hnew
+    view = view.value if hasattr(view, "value") else view
+    grid = np.indices(fullview.shape[:-1], sparse=True)
+
+    hists = []
+    for is_min in do_min:
+        op = np.argmin if is_min else np.argmax
+        # Index of min/max values considering only the eventual projection  
+        idx = op(view, axis=-1)
+        opview = fullview[(*grid, idx)]
+
+        # Now that the syst ax has been collapsed, project axes will be at last position
+        # Move the axes back to where they belong
+        for idx in reversed(initial_order):
+            opview = np.moveaxis(opview, -1, idx)
+
+        hnew = hist.Hist(*h.axes[:-1], storage=h.storage_type())
+        hnew.view(flow=True)[...] = opview
+        hists.append(hnew)
+
+    return hists
 
 def combineUpDownVarHists(down_hist, up_hist):
     if up_hist.axes != down_hist.axes:
@@ -0,0 +1,118 @@
+import hashlib
+import functools
+import os
+import pickle
+import re
+import types
+import numpy as np
+
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+def file_fingerprint(path):
+    # identify a file by its path, size and modification time (cheap compared to hashing the content of large files)
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+def hash_object(obj):
+    # deterministic hash of (nested) python objects, functions are hashed through their code, default arguments, closures
+    #   and the plain functions they reference, for objects captured in closures only the attributes used by the code are hashed
+    # objects that can not be hashed deterministically fall back to their repr, which may lead to different hashes for identical objects
+    #   (i.e. cache misses)
+    # the hash is NOT complete: modules and classes are only identified by their name, so functions reached through module attributes
+    #   (e.g. hh.scaleHist, theory_tools.*) and methods called on captured objects are not hashed,
+    #   changing their code gives the same hash (i.e. stale cache hits), caches keyed by this hash have to be cleared in that case
+    h = hashlib.sha256()
+    _update_hash(h, obj, set())
+    return h.hexdigest()
+
+def _update_hash(h, obj, visited, names=None):
+    def update(*items):
+        for item in items:
+            h.update(str(item).encode())
+            h.update(b"\0")
+
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, np.generic)):
+        update(type(obj).__name__, repr(obj))
+    elif isinstance(obj, bytes):
+        update("bytes", len(obj))
+        h.update(obj)
+    elif isinstance(obj, np.ndarray):
+        update("ndarray", obj.dtype.str, obj.shape)
+        if obj.dtype == object:
+            for x in obj.flat:
+                _update_hash(h, x, visited)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, re.Pattern):
+        update("re", obj.pattern, obj.flags)
+    elif isinstance(obj, (list, tuple)):
+        update(type(obj).__name__, len(obj))
+        for x in obj:
+            _update_hash(h, x, visited)
+    elif isinstance(obj, (set, frozenset)):
+        update(type(obj).__name__, len(obj))
+        for x in sorted(obj, key=repr):
+            _update_hash(h, x, visited)
+    elif isinstance(obj, dict):
+        update("dict", len(obj))
+        for k in sorted(obj.keys(), key=repr):
+            _update_hash(h, k, visited)
+            _update_hash(h, obj[k], visited)
+    elif isinstance(obj, types.CodeType):
+        update("code", obj.co_name, obj.co_names, obj.co_varnames)
+        h.update(obj.co_code)
+        for const in obj.co_consts:
+            _update_hash(h, const, visited)
+    elif isinstance(obj, types.FunctionType):
+        update("function", obj.__module__, obj.__qualname__)
+        if id(obj) in visited:
+            return
+        visited.add(id(obj))
+        code = obj.__code__
+        _update_hash(h, code, visited)
+        _update_hash(h, obj.__defaults__, visited)
+        _update_hash(h, obj.__kwdefaults__, visited)
+        for cell in obj.__closure__ or []:
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                # empty cell
+                continue
+            _update_hash(h, contents, visited, names=code.co_names)
+        # plain functions referenced as globals, e.g. helpers defined in the same script
+        for name in code.co_names:
+            glob = obj.__globals__.get(name, None)
+            if isinstance(glob, types.FunctionType):
+                _update_hash(h, glob, visited)
+    elif isinstance(obj, types.MethodType):
+        update("method")
+        _update_hash(h, obj.__func__, visited)
+        _update_hash(h, obj.__self__, visited, names=obj.__func__.__code__.co_names)
+    elif isinstance(obj, functools.partial):
+        update("partial")
+        _update_hash(h, obj.func, visited)
+        _update_hash(h, obj.args, visited)
+        _update_hash(h, obj.keywords, visited)
+    elif isinstance(obj, (types.BuiltinFunctionType, types.ModuleType, type)) or callable(obj) and hasattr(obj, "__qualname__"):
+        # builtins, numpy ufuncs, modules and classes are identified by their name
+        update(type(obj).__name__, getattr(obj, "__module__", ""), getattr(obj, "__qualname__", getattr(obj, "__name__", "")))
+    elif names is not None and hasattr(obj, "__dict__"):
+        # object captured by a function, only hash the attributes that are used
+        update("object", type(obj).__module__, type(obj).__qualname__)
+        if id(obj) in visited:
+            return
+        visited.add(id(obj))
+        for name in names:
+            if name in obj.__dict__:
+                update(name)
+                _update_hash(h, obj.__dict__[name], visited)
+    else:
+        try:
+            data = pickle.dumps(obj, protocol=4)
+            update("pickle", type(obj).__qualname__, len(data))
+            h.update(data)
+        except Exception:
+            logger.debug(f"Can not hash object of type {type(obj)} deterministically, use its repr")
+            update("repr", repr(obj))
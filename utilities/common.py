@@ -128,6 +128,15 @@ def set_parser_default(parser, argument, newDefault):
         logger.warning(f" Parser argument {argument} not found!")
     return parser
 
+def add_shard_args(parser):
+    # options of shard_tools.build_and_run, only for the histmakers running the event loop through it
+    parser.add_argument("--shardJobs", type=int, default=None, help="Split the datasets into shards of input files and run them in this number of worker processes (sharing the threads given by --nThreads)")
+    parser.add_argument("--shardsPerJob", type=int, default=4, help="Target number of shards per worker process, large datasets are split into shards of about equal size")
+    parser.add_argument("--shardBalance", type=str, default="size", choices=["size", "events"], help="Balance the shards by the size of the input files or by their number of events (requires to open all files)")
+    parser.add_argument("--checkpointDir", type=str, default=None, help="Run the event loop in shards (see --shardJobs) and keep the partial output of each shard in this directory")
+    parser.add_argument("--resume", action='store_true', help="Do not rerun shards with a partial output in --checkpointDir from a previous (interrupted) run with the same configuration. The configuration includes the code of build_graph and the plain functions it calls directly, but not helpers called through modules or methods, clear the directory after changing those")
+    return parser
+
 def common_parser(for_reco_highPU=False):
 
     parser = argparse.ArgumentParser()
@@ -146,8 +155,7 @@ def common_parser(for_reco_highPU=False):
         ROOT.ROOT.EnableImplicitMT()
     elif initargs.nThreads != 1:
         ROOT.ROOT.EnableImplicitMT(initargs.nThreads)
-    import narf
-    import wremnants
+    # only the lists of valid choices are needed here, the helper modules and headers are loaded by the histmakers
     from wremnants import theory_corrections,theory_tools
 
     class FilterAction(argparse.Action):
@@ -166,6 +174,7 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("--forceDefaultName", action='store_true', help="Don't modify the name of the output file with some default strings")
     parser.add_argument("--theoryCorr", nargs="*", default=["scetlib_dyturbo", "horacenloew"], choices=theory_corrections.valid_theory_corrections(),
         help="Apply corrections from indicated generator. First will be nominal correction.")
+    parser.add_argument("--theoryCorrCacheDir", type=str, default=None, help="Directory to cache the theory correction histograms extracted from the correction files, such that later runs do not need to decompress and unpickle the full files")
     parser.add_argument("--theoryCorrAltOnly", action='store_true', help="Save hist for correction hists but don't modify central weight")
     parser.add_argument("--widthVariations", action='store_true', help="Store variations of W and Z widths.")
     parser.add_argument("--skipHelicity", action='store_true', help="Skip the qcdScaleByHelicity histogram (it can be huge)")
@@ -174,13 +183,25 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("--noRecoil", action='store_true', help="Don't apply recoild correction")
     parser.add_argument("--recoilHists", action='store_true', help="Save all recoil related histograms for calibration and validation")
     parser.add_argument("--recoilUnc", action='store_true', help="Run the recoil calibration with uncertainties (slower)")
+    parser.add_argument("--recoilDenseHists", action='store_true', help="Fill the recoil histograms with fine resolution and run number axes as dense histograms in each thread, instead of storing only the filled bins")
     parser.add_argument("--highptscales", action='store_true', help="Apply highptscales option in MiNNLO for better description of data at high pT")
     parser.add_argument("--dataPath", type=str, default=None, help="Access samples from this path (default reads from local machine), for eos use 'root://eoscms.cern.ch//store/cmst3/group/wmass/w-mass-13TeV/NanoAOD/'")
+    parser.add_argument("--fileListCacheTTL", type=float, default=0, help="Cache the lists of input files on disk and reuse them for this number of hours (0 to disable the cache)")
+    parser.add_argument("--fileListCacheDir", type=str, default=None, help="Directory of the cache of the lists of input files (default is ~/.cache/wremnants/filelists)")
     parser.add_argument("--noVertexWeight", action='store_true', help="Do not apply reweighting of vertex z distribution in MC to match data")
     parser.add_argument("--validationHists", action='store_true', help="make histograms used only for validations")
     parser.add_argument("--onlyMainHistograms", action='store_true', help="Only produce some histograms, skipping (most) systematics to run faster when those are not needed")
+    parser.add_argument("--excludeNuisances", type=str, default="", help="Regular expression to skip histograms of systematics (matched to the histogram name without the leading 'nominal_'). Unlike the option of setupCombine.py, which is matched to the names of the individual nuisances, this is matched to the histogram name, histograms that are skipped are not available later for any of their nuisances")
+    parser.add_argument("--keepNuisances", type=str, default="", help="Regular expression to keep histograms of systematics, overriding --excludeNuisances. Matched to the histogram name, not to the nuisance names as in setupCombine.py, i.e. to keep only some nuisances of a histogram the expression has to match the histogram name as well")
+    parser.add_argument("--mergeSystHists", action='store_true', help="Fill systematic histograms with the same axes from a single concatenated weight tensor, they are split again after the event loop")
     parser.add_argument("--met", type=str, choices=["DeepMETReso", "RawPFMET"], help="MET (DeepMETReso or RawPFMET)", default="DeepMETReso")
     parser.add_argument("-o", "--outfolder", type=str, default="", help="Output folder")
+    parser.add_argument("--dryRun", action='store_true', help="Only build the graph (running over a single event per dataset) and print the memory used by the histograms, without running the event loop")
+    parser.add_argument("--memoryBudget", type=float, default=None, help="Memory budget for the histograms in GB, the number of threads is reduced if needed (each thread fills its own copy of the histograms, with --shardJobs each worker process holds the copies for its shard and the main process the merged output)")
+    parser.add_argument("--rawHistMinSize", type=float, default=None, help="Store histograms larger than this size (in MB) as raw datasets in the output file, such that single slices (e.g. one PDF member) can be read without loading the full histogram")
+    parser.add_argument("--compactSystHists", action='store_true', help="Store the histograms of systematic variations (tensors named {nominal}_{syst} with the axes of the nominal histogram followed by the systematic axes) in single precision in the output file, other histograms are kept in double precision. This only reduces the size of the output file and of the histograms read from it, not the memory used while filling the histograms")
+    parser.add_argument("--outputCompression", type=str, default=None, choices=["gzip", "lz4", "zstd", "blosc"], help="Write all histograms in the raw layout (see --rawHistMinSize) compressed with this codec (gzip and lz4 chunks are compressed in parallel threads)")
+    parser.add_argument("--outputCompressionLevel", type=int, default=None, help="Compression level for --outputCompression (default depends on the codec)")
     parser.add_argument("-e", "--era", type=str, choices=["2016PreVFP","2016PostVFP", "2017", "2018"], help="Data set to process", default="2016PostVFP")
     parser.add_argument("--nonClosureScheme", type=str, default = "A-only", choices=["none", "A-M-separated", "A-M-combined", "binned", "binned-plus-M", "A-only", "M-only"], help = "source of the Z non-closure nuisances")
     parser.add_argument("--correlatedNonClosureNP", action="store_false", help="disable the de-correlation of Z non-closure nuisance parameters after the jpsi massfit")
@@ -1,23 +1,38 @@
 import numpy as np
+import collections
+import itertools
 import math
+import pickle
+import struct
+import zlib
+import hist
+import hdf5plugin
+import lz4.block
 
-def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):    
-    arrflat = arr.reshape(-1)
-
-    esize = np.dtype(arrflat.dtype).itemsize
-    nbytes = arrflat.size*esize
+def createFlatDataset(h5group, outname, size, dtype, maxChunkBytes = 1024**2):
+    esize = np.dtype(dtype).itemsize
 
     #special handling for empty datasets, which should not use chunked storage or compression
-    if arrflat.size == 0:
+    if size == 0:
         chunksize = 1
         chunks = None
         compression = None
     else:
-        chunksize = int(min(arrflat.size,max(1,math.floor(maxChunkBytes/esize))))
+        chunksize = int(min(size,max(1,math.floor(maxChunkBytes/esize))))
         chunks = (chunksize,)
         compression = "gzip"
 
-    h5dset = h5group.create_dataset(outname, arrflat.shape, chunks=chunks, dtype=arrflat.dtype, compression=compression)
+    h5dset = h5group.create_dataset(outname, (size,), chunks=chunks, dtype=dtype, compression=compression)
+
+    return h5dset, chunksize
+
+def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):    
+    arrflat = arr.reshape(-1)
+
+    esize = np.dtype(arrflat.dtype).itemsize
+    nbytes = arrflat.size*esize
+
+    h5dset, chunksize = createFlatDataset(h5group, outname, arrflat.size, arrflat.dtype, maxChunkBytes)
 
     #write in chunks, preserving sparsity if relevant
     for ielem in range(0,arrflat.size,chunksize):
@@ -37,4 +52,243 @@ def writeSparse(indices, values, dense_shape, h5group, outname, maxChunkBytes =
     nbytes += writeFlatInChunks(values, outgroup, "values", maxChunkBytes)
     outgroup.attrs['dense_shape'] = np.array(dense_shape, dtype='int64')
 
-    return nbytes
\ No newline at end of file
+    return nbytes
+
+class FlatChunkedWriter(object):
+    # fill a flat dataset with the same layout as writeFlatInChunks from consecutive pieces of the flattened array, 
+    # such that the full array never needs to be in memory
+    # pieces are buffered such that only complete chunks are written (and compressed) once
+    def __init__(self, h5group, outname, shape, dtype, maxChunkBytes = 1024**2):
+        self.size = int(np.prod(shape))
+        self.nbytes = self.size*np.dtype(dtype).itemsize
+        self.h5dset, self.chunksize = createFlatDataset(h5group, outname, self.size, dtype, maxChunkBytes)
+        self.h5dset.attrs['original_shape'] = np.array(shape,dtype='int64')
+
+        self.buffer = np.zeros([self.chunksize], dtype=dtype)
+        self.nbuffer = 0
+        self.offset = 0
+
+    def write_chunk(self, aout):
+        #preserving sparsity if relevant
+        if np.count_nonzero(aout):
+            self.h5dset[self.offset:self.offset+aout.size] = aout
+        self.offset += aout.size
+
+    def append(self, arr):
+        arrflat = arr.reshape(-1)
+        if self.offset + self.nbuffer + arrflat.size > self.size:
+            raise RuntimeError(f"Trying to write {self.offset + self.nbuffer + arrflat.size} elements into dataset {self.h5dset.name} of size {self.size}")
+
+        ielem = 0
+        #first complete a partially filled chunk
+        if self.nbuffer > 0:
+            nfill = min(arrflat.size, self.chunksize - self.nbuffer)
+            self.buffer[self.nbuffer:self.nbuffer+nfill] = arrflat[:nfill]
+            self.nbuffer += nfill
+            ielem = nfill
+            if self.nbuffer == self.chunksize:
+                self.write_chunk(self.buffer)
+                self.nbuffer = 0
+
+        #write complete chunks directly
+        while arrflat.size - ielem >= self.chunksize:
+            self.write_chunk(arrflat[ielem:ielem+self.chunksize])
+            ielem += self.chunksize
+
+        #keep the remainder for the next call
+        nrest = arrflat.size - ielem
+        if nrest > 0:
+            self.buffer[:nrest] = arrflat[ielem:]
+            self.nbuffer = nrest
+
+    def close(self):
+        if self.nbuffer > 0:
+            self.write_chunk(self.buffer[:self.nbuffer])
+            self.nbuffer = 0
+        if self.offset != self.size:
+            raise RuntimeError(f"Dataset {self.h5dset.name} was filled with {self.offset} elements but expected {self.size}")
+        self.buffer = None
+
+        return self.nbytes
+
+def rawHistChunks(shape, itemsize, maxChunkBytes = 16*1024**2):
+    # chunk shape for a raw histogram, the trailing (e.g. systematic tensor) axes are split first 
+    #   such that single entries along those axes can be read efficiently
+    chunks = list(shape)
+    for i in reversed(range(len(shape))):
+        nbytes = itemsize*int(np.prod(chunks))
+        if nbytes <= maxChunkBytes:
+            break
+        chunks[i] = max(1, int(chunks[i]*maxChunkBytes // nbytes))
+    return tuple(max(1, c) for c in chunks)
+
+# codecs for the raw histograms, gzip and lz4 chunks are compressed in python threads (see writeRawChunks),
+#   the others by the hdf5 filter pipeline
+rawHistCodecs = ["gzip", "lz4", "zstd", "blosc"]
+
+def compressionArgs(codec, level = None):
+    # arguments of h5py create_dataset for the codec
+    if codec is None:
+        return {}
+    if codec == "gzip":
+        return {"compression" : "gzip", "compression_opts" : 4 if level is None else level}
+    if codec == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if codec == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    if codec == "blosc":
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5 if level is None else level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f"Unknown codec {codec}, choose from {rawHistCodecs}")
+
+def compressChunk(codec, arr, level = None):
+    # compressed chunk (contiguous array) in the format of the hdf5 filter, zlib and lz4 release the GIL
+    data = memoryview(arr.reshape(-1)).cast("B")
+    if codec == "gzip":
+        return zlib.compress(data, 4 if level is None else level)
+    if codec == "lz4":
+        # format of the hdf5 lz4 filter: original size (uint64), block size (uint32), then for each block its size (uint32) and the data,
+        #   a single block per chunk which is stored uncompressed if it does not get smaller
+        nbytes = len(data)
+        block = lz4.block.compress(data, store_size=False)
+        if len(block) >= nbytes:
+            block = bytes(data)
+        return struct.pack(">QI", nbytes, nbytes) + struct.pack(">I", len(block)) + block
+    return None
+
+def rawChunkSlices(shape, chunks):
+    # slices of all chunks of an array, in C order
+    ranges = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for offset in itertools.product(*ranges):
+        yield offset, tuple(slice(o, o+c) for o, c in zip(offset, chunks))
+
+def writeRawChunks(h5dset, arr, chunks, codec, executor, level = None, maxInFlight = 64):
+    # compress the chunks concurrently in the executor and write them in order with write_direct_chunk,
+    #   chunks with only zeros are not written (they are read as the fill value 0)
+    pending = collections.deque()
+
+    def compress(sl):
+        data = np.zeros(chunks, dtype=arr.dtype)
+        view = arr[sl]
+        data[tuple(slice(0, n) for n in view.shape)] = view
+        return compressChunk(codec, data, level)
+
+    def write_next():
+        offset, future = pending.popleft()
+        h5dset.id.write_direct_chunk(offset, future.result())
+
+    for offset, sl in rawChunkSlices(arr.shape, chunks):
+        if not np.any(arr[sl]):
+            continue
+        pending.append((offset, executor.submit(compress, sl)))
+        if len(pending) >= maxInFlight:
+            write_next()
+    while pending:
+        write_next()
+
+def writeRawHist(h, h5group, outname, maxChunkBytes = 16*1024**2, compression = None, dtype = None, level = None, executor = None):
+    # store a histogram as axes metadata plus raw (uncompressed by default) datasets of the values and variances including flow bins, 
+    #   which are read back directly into the histogram storage without unpickling
+    #   with dtype (e.g. np.float32) the arrays are stored with reduced precision, they are read back into a histogram with double precision
+    #   compression is one of rawHistCodecs, with an executor the chunks are compressed concurrently if supported by the codec
+    outgroup = h5group.create_group(outname)
+
+    view = h.view(flow=True)
+    if h.storage_type == hist.storage.Weight:
+        arrays = {"values" : view.value, "variances" : view.variance}
+    else:
+        arrays = {"values" : view}
+
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        chunks = rawHistChunks(arr.shape, arr.dtype.itemsize, maxChunkBytes) if arr.size else None
+        if compression is None or chunks is None:
+            outgroup.create_dataset(name, data=arr, chunks=chunks)
+            continue
+        h5dset = outgroup.create_dataset(name, shape=arr.shape, dtype=arr.dtype, chunks=chunks, **compressionArgs(compression, level))
+        if executor is not None and compression in ["gzip", "lz4"]:
+            writeRawChunks(h5dset, arr, chunks, compression, executor, level)
+        else:
+            h5dset[...] = arr
+
+    outgroup.attrs["axes"] = np.void(pickle.dumps(list(h.axes)))
+    outgroup.attrs["storage"] = np.void(pickle.dumps(h.storage_type()))
+    outgroup.attrs["name"] = h.name if h.name else ""
+    outgroup.attrs["label"] = h.label if h.label else ""
+
+    return view.nbytes
+
+def maxLogkDeviation(nominal, variation, dtype = np.float32, maxChunkBytes = 16*1024**2):
+    # accuracy check of storing the variation with reduced precision: the maximum absolute difference of logk = log(variation/nominal)
+    #   computed from the stored and the original values, for bins where both are positive
+    #   nominal is broadcast to the leading axes of the variation (e.g. the nominal histogram for a histogram with additional systematic axes)
+    #   for float32 the deviation is bounded by the relative rounding error 2**-24 ~ 6e-8 (since the nominal is kept in double precision),
+    #   orders of magnitude below the statistical precision of any logk in the fit
+    variation = variation.reshape(variation.shape[0], -1, *variation.shape[nominal.ndim:])
+    nominal = nominal.reshape(nominal.shape[0], -1, *[1]*(variation.ndim-2))
+    step = max(1, int(maxChunkBytes // max(variation[0].nbytes, 1)))
+    maxdev = 0.
+    for i in range(0, variation.shape[0], step):
+        var = variation[i:i+step]
+        nom = nominal[i:i+step]
+        mask = (var > 0) & (nom > 0)
+        if not np.any(mask):
+            continue
+        logk = np.log(var/np.where(nom > 0, nom, 1.), where=mask, out=np.zeros(var.shape))
+        logk_reduced = np.log(var.astype(dtype).astype(var.dtype)/np.where(nom > 0, nom, 1.), where=mask, out=np.zeros(var.shape))
+        maxdev = max(maxdev, float(np.max(np.abs(logk_reduced-logk))))
+    return maxdev
+
+def readRawHistAxes(h5group):
+    return pickle.loads(h5group.attrs["axes"].tobytes())
+
+def readRawHist(h5group):
+    # read a histogram written with writeRawHist
+    axes = readRawHistAxes(h5group)
+    storage = pickle.loads(h5group.attrs["storage"].tobytes())
+
+    name = h5group.attrs["name"]
+    label = h5group.attrs["label"]
+    h = hist.Hist(*axes, storage=storage, name=name if name else None, label=label if label else None)
+    if "variances" in h5group:
+        view = h.view(flow=True)
+        view.value[...] = h5group["values"][...]
+        view.variance[...] = h5group["variances"][...]
+    else:
+        h.view(flow=True)[...] = h5group["values"][...]
+
+    return h
+
+class H5RawHist(object):
+    # reference to a histogram stored with writeRawHist, pickled in place of the histogram
+    #   the hdf5 file is not pickled and has to be bound after loading (see bindRawHists)
+    def __init__(self, path, h5file = None):
+        self.path = path
+        self.h5file = h5file
+
+    def __getstate__(self):
+        return {"path" : self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.h5file = None
+
+    def group(self):
+        if self.h5file is None:
+            raise RuntimeError(f"No hdf5 file bound to raw histogram {self.path}")
+        return self.h5file[self.path]
+
+    def get(self):
+        return readRawHist(self.group())
+
+    def axes(self):
+        return readRawHistAxes(self.group())
+
+def bindRawHists(results, h5file):
+    # bind the file to the references of raw histograms in the output of each dataset
+    for dataset in results.values():
+        if not isinstance(dataset, dict) or not isinstance(dataset.get("output", None), dict):
+            continue
+        for h in dataset["output"].values():
+            if isinstance(h, H5RawHist):
+                h.h5file = h5file
+    return results
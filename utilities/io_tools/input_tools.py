@@ -8,6 +8,7 @@ import json
 import hdf5plugin
 import h5py
 from narf import ioutils
+from utilities.h5pyutils import H5RawHist, bindRawHists
 import ROOT
 import uproot
 
@@ -43,13 +44,13 @@ def read_sumw(fname, proc):
 
 def read_and_scale(fname, proc, histname, calculate_lumi=False, scale=1, apply_xsec=True):
     with h5py.File(fname, "r") as h5file:
-        results = ioutils.pickle_load_h5py(h5file["results"])
+        results = bindRawHists(ioutils.pickle_load_h5py(h5file["results"]), h5file)
             
         return load_and_scale(results, proc, histname, calculate_lumi, scale, apply_xsec)
 
 def load_and_scale(res_dict, proc, histname, calculate_lumi=False, scale=1., apply_xsec=True):
     h = res_dict[proc]["output"][histname]
-    if isinstance(h, ioutils.H5PickleProxy):
+    if isinstance(h, (ioutils.H5PickleProxy, H5RawHist)):
         h = h.get()
     if not res_dict[proc]["dataset"]["is_data"]:
         if apply_xsec:
@@ -65,7 +66,7 @@ def load_and_scale(res_dict, proc, histname, calculate_lumi=False, scale=1., app
 
 def read_all_and_scale(fname, procs, histnames, lumi=False):
     h5file = h5py.File(fname, "r")
-    results = ioutils.pickle_load_h5py(h5file["results"])
+    results = bindRawHists(ioutils.pickle_load_h5py(h5file["results"]), h5file)
 
     hists = []
     for histname in histnames:
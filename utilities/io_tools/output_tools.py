@@ -9,11 +9,14 @@ import h5py
 import narf
 import numpy as np
 import re
+import hist
 from utilities import logging
+from utilities.h5pyutils import writeRawHist, H5RawHist, maxLogkDeviation
 import glob
 import shutil
 import lz4.frame
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.child_logger(__name__)
 
@@ -81,6 +84,139 @@ def writeMetaInfoToRootFile(rtfile, exclude_diff='notebooks', args=None):
         out = ROOT.TNamed(str(key), str(value))
         out.Write()
 
+def root_axis_args(axes):
+    # constructor arguments of TH1D/TH2D/TH3D, variable bin edges are used for all axes if any axis is not regular
+    #   since TH3D has no constructor with mixed axes
+    if all(isinstance(ax, hist.axis.Integer) or (isinstance(ax, hist.axis.Regular) and ax.transform is None) for ax in axes):
+        return tuple(a for ax in axes for a in (ax.size, float(ax.edges[0]), float(ax.edges[-1])))
+    return tuple(a for ax in axes for a in (ax.size, np.ascontiguousarray(ax.edges, dtype=np.float64)))
+
+def root_array(h, values):
+    # values with flow (as from h.values(flow=True)) to the flat array of the cells of a ROOT histogram,
+    #   (missing flow bins are zero, the first axis runs fastest)
+    out = np.zeros([ax.size+2 for ax in h.axes], dtype=np.float64)
+    slices = tuple(slice(1-int(ax.traits.underflow), ax.size+1+int(ax.traits.overflow)) for ax in h.axes)
+    out[slices] = values
+    return out.ravel(order="F")
+
+class RootHistWriter(object):
+    # writes hist histograms as TH1D/TH2D/TH3D into subdirectories of a ROOT file, the content and sum of weights squared
+    #   are copied from numpy arrays into a single ROOT histogram per binning, which is reused for all histograms with this binning,
+    #   instead of converting each histogram into a new ROOT object
+    # histograms are queued and written in batches by directory, with flush() to write all pending histograms
+    def __init__(self, rtfile, batch_size=1000):
+        self.rtfile = rtfile
+        self.batch_size = batch_size
+        self.pending = {}
+        self.npending = 0
+        self.templates = {}
+        self.nwritten = 0
+
+    def write(self, directory, name, h):
+        if len(h.axes) > 3 or any(not ax.traits.continuous and not isinstance(ax, hist.axis.Integer) for ax in h.axes):
+            # categorical axes are not supported as ROOT bins, use the generic conversion
+            self.flush()
+            self.make_directory(directory).cd()
+            hout = narf.hist_to_root(h)
+            hout.SetName(name)
+            hout.Write()
+            self.rtfile.cd()
+            self.nwritten += 1
+            return
+
+        variances = h.variances(flow=True)
+        self.pending.setdefault(directory, []).append((name, h.axes, root_array(h, h.values(flow=True)),
+            root_array(h, variances) if variances is not None else None))
+        self.npending += 1
+        if self.npending >= self.batch_size:
+            self.flush()
+
+    def make_directory(self, directory):
+        return self.rtfile.mkdir(directory, directory, True)
+
+    def template(self, axes):
+        import ROOT
+        key = tuple((type(ax).__name__, ax.size, tuple(ax.edges)) for ax in axes)
+        if key not in self.templates:
+            constructor = [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D][len(axes)-1]
+            th = constructor(f"root_writer_template{len(self.templates)}", "", *root_axis_args(axes))
+            th.SetDirectory(ROOT.nullptr)
+            self.templates[key] = th
+        return self.templates[key]
+
+    def flush(self):
+        for directory, entries in self.pending.items():
+            rtdir = self.make_directory(directory)
+            for name, axes, values, variances in entries:
+                th = self.template(axes)
+                th.SetContent(values)
+                if variances is None:
+                    th.GetSumw2().Set(0)
+                else:
+                    th.GetSumw2().Set(len(variances), variances)
+                th.ResetStats()
+                th.SetName(name)
+                rtdir.WriteTObject(th, name)
+            self.nwritten += len(entries)
+        self.pending = {}
+        self.npending = 0
+
+# chunk sizes of raw histograms, compressed chunks are smaller such that reading single slices decompresses less data
+raw_chunk_bytes = 16*1024**2
+compressed_chunk_bytes = 4*1024**2
+
+def syst_variation_base(hists, h_name, h):
+    # histogram of which h is a tensor of systematic variations, i.e. named {base}_{syst} with double storage
+    #   and the axes of the base histogram followed by the tensor axes, or None
+    if h.storage_type != hist.storage.Double:
+        return None
+    parts = h_name.split("_")
+    for i in range(len(parts)-1, 0, -1):
+        base = hists.get("_".join(parts[:i]), None)
+        if base is None:
+            continue
+        if not isinstance(base, hist.Hist) or base.storage_type == hist.storage.Double:
+            return None
+        if h.ndim > base.ndim and h.axes[:base.ndim] == base.axes:
+            return base
+        logger.warning(f"Histogram {h_name} has different axes than {'_'.join(parts[:i])} and can not be checked, keep it in double precision")
+        return None
+    return None
+
+def write_raw_hists(results, h5file, min_bytes, compact=False, compression=None, level=None, nthreads=None):
+    # store histograms with at least min_bytes in the raw layout (see h5pyutils.writeRawHist) and replace them by references in the results
+    #   optionally compressed with one of h5pyutils.rawHistCodecs, the chunks are compressed with nthreads threads (the ThreadPoolExecutor default if None, as for -j 0)
+    #   with compact=True, the systematic variations are stored in single precision independent of their size,
+    #   the deviation of logk from the rounding is checked with respect to the nominal
+    nbytes = 0
+    maxdev = 0.
+    executor = ThreadPoolExecutor(max_workers=nthreads) if compression is not None else None
+    for d_name, dataset in results.items():
+        if not isinstance(dataset, dict) or not isinstance(dataset.get("output", None), dict):
+            continue
+        # the histograms before any of them is replaced by a reference
+        hists = {k: v.get() if isinstance(v, narf.ioutils.H5PickleProxy) else v for k, v in dataset["output"].items()}
+        for h_name, h in hists.items():
+            if not isinstance(h, hist.Hist) or h.ndim == 0:
+                continue
+            nominal = syst_variation_base(hists, h_name, h) if compact else None
+            reduced = nominal is not None
+            if not reduced and (min_bytes is None or h.view(flow=True).nbytes < min_bytes):
+                continue
+            if reduced:
+                dev = maxLogkDeviation(nominal.values(flow=True), h.values(flow=True))
+                logger.debug(f"Maximum deviation of logk for histogram {h_name} of dataset {d_name} in single precision: {dev}")
+                maxdev = max(maxdev, dev)
+            logger.debug(f"Write raw histogram {h_name} for dataset {d_name}")
+            nbytes += writeRawHist(h, h5file.require_group(f"raw_hists/{d_name}"), h_name, dtype=np.float32 if reduced else None, 
+                maxChunkBytes=raw_chunk_bytes if compression is None else compressed_chunk_bytes, compression=compression, level=level, executor=executor)
+            dataset["output"][h_name] = H5RawHist(f"raw_hists/{d_name}/{h_name}")
+    if executor is not None:
+        executor.shutdown()
+    logger.info(f"Written {nbytes/1024**3:.3f} GB of histograms in raw layout" + (f" with {compression} compression" if compression else ""))
+    if compact:
+        logger.info(f"Maximum deviation of logk for systematic variations stored in single precision: {maxdev}")
+
 def write_analysis_output(results, outfile, args, update_name=True):
     analysis_debug_output(results)
     results.update({"meta_info" : metaInfoDict(args=args)})
@@ -105,6 +241,11 @@ def write_analysis_output(results, outfile, args, update_name=True):
 
     time0 = time.time()
     with h5py.File(outfile, 'w') as f:
+        if args.rawHistMinSize is not None or args.compactSystHists or args.outputCompression:
+            # with compression all histograms are written in the raw layout, which applies the codec
+            min_bytes = args.rawHistMinSize*1024**2 if args.rawHistMinSize is not None else (0 if args.outputCompression else None)
+            write_raw_hists(results, f, min_bytes, compact=args.compactSystHists, 
+                compression=args.outputCompression, level=args.outputCompressionLevel, nthreads=args.nThreads or None)
         narf.ioutils.pickle_dump_h5py("results", results, f)
 
     logger.info(f"Writing output: {time.time()-time0}")
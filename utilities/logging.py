@@ -1,5 +1,6 @@
 import os, logging
 import time
+import resource
 
 class CustomFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -100,6 +101,11 @@ def print_time_info(logger):
         for tag, itime in logger.times.items():
             logger.info(f"{tag}: {time_end - itime}")
 
+def print_memory_info(tag, logger=logging.getLogger("wremnants")):
+    # peak resident set size of the process so far (ru_maxrss is given in kB on linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logger.info(f"Peak RSS after {tag}: {peak/1024**2:.3f} GB")
+
 def summary(verbosity=logging.WARNING, extended=True):
     base_logger = logging.getLogger("wremnants")
 
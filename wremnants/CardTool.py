@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from wremnants import histselections as sel
+from wremnants import histselections as sel, declare_headers
 from wremnants.combine_helpers import setSimultaneousABCD
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import output_tools
@@ -25,6 +25,7 @@ class CardTool(object):
     
         self.skipHist = False # don't produce/write histograms, file with them already exists
         self.outfile = None
+        self.writer = None
         self.systematics = {}
         self.lnNSystematics = {}
         self.predictedProcs = []
@@ -476,10 +477,9 @@ class CardTool(object):
 
         return updated_skip
 
-    def systHists(self, hvar, syst):
-        if syst == self.nominalName:
-            return {self.nominalName : hvar}
-
+    def systHistEntries(self, hvar, syst):
+        # apply the action of the systematic and find the entries along the systematic axes (and the corresponding output names)
+        #   returns the histogram after the action, the names of the systematic axes and the list of entries
         systInfo = self.systematics[syst] 
         systAxes = systInfo["systAxes"]
         systAxesLabels = systInfo.get("labelsByAxis", systAxes)
@@ -526,14 +526,56 @@ class CardTool(object):
             if not len(systInfo["outNames"]):
                 raise RuntimeError(f"Did not find any valid variations for syst {syst}")
 
-        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
-        if hvar.axes[-1].name == "mirror" and len(variations) == 2*len(systInfo["outNames"]):
+        if hvar.axes[-1].name == "mirror" and len(entries) == 2*len(systInfo["outNames"]):
             systInfo["outNames"] = [n + d for n in systInfo["outNames"] for d in ["Up", "Down"]]
-        elif len(variations) != len(systInfo["outNames"]):
+        elif len(entries) != len(systInfo["outNames"]):
             logger.warning(f"The number of variations doesn't match the number of names for "
-                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(variations)} variations.")
+                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(entries)} variations.")
+
+        return hvar, axNames, entries
+
+    def systHists(self, hvar, syst):
+        if syst == self.nominalName:
+            return {self.nominalName : hvar}
+
+        hvar, axNames, entries = self.systHistEntries(hvar, syst)
+
+        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
+
+        return {name : var for name,var in zip(self.systematics[syst]["outNames"], variations) if name}
 
-        return {name : var for name,var in zip(systInfo["outNames"], variations) if name}
+    def systFlowIndex(self, axis, entry):
+        # index of a bin along an axis in the array of values including flow bins
+        offset = 1 if axis.traits.underflow else 0
+        if entry == hist.underflow:
+            return 0
+        if entry == hist.overflow:
+            return axis.size + offset
+        if isinstance(entry, str):
+            return axis.index(entry) + offset
+        return int(entry) + offset
+
+    def systHistsArray(self, hvar, syst, axes):
+        # same variations as systHists, but without materializing a histogram for each of them:
+        #   the histogram is projected once on the given (fit) axes and the systematic axes, 
+        #   and the values of all variations are gathered in one array of shape [nbins, nvariations] (without flow bins along the fit axes)
+        #   returns a dict of {variation name : column index} and the array
+        hvar, axNames, entries = self.systHistEntries(hvar, syst)
+
+        hproj = hvar.project(*axes, *axNames)
+        values = hproj.values(flow=True)
+
+        # slices without flow along the fit axes, and all entries along the systematic axes
+        slices = tuple(slice(1 if ax.traits.underflow else 0, (1 if ax.traits.underflow else 0) + ax.size) for ax in hproj.axes[:len(axes)])
+        indices = tuple(np.array([self.systFlowIndex(hproj.axes[ax], entry[i]) for entry in entries], dtype=int) for i,ax in enumerate(axNames))
+        values = values[slices + indices].reshape(-1, len(entries))
+
+        columns = {}
+        for i, name in enumerate(self.systematics[syst]["outNames"][:len(entries)]):
+            if name:
+                columns[name] = i
+
+        return columns, values
 
     def variationName(self, proc, name):
         if name == self.nominalName:
@@ -610,6 +652,7 @@ class CardTool(object):
         #                          "edges" : [ [etaEdges], [ptEdges] ]}
         #                   }
         # TODO: could also do charge decorrelation by using the z axis if present
+        declare_headers()
         ret = {}
         hnomiroot = narf.hist_to_root(hnomi)
         hsystroot = narf.hist_to_root(h)
@@ -691,7 +734,7 @@ class CardTool(object):
         if proc in self.noStatUncProcesses:
             logger.warning(f"Zeroing statistical uncertainty for process {proc}")
             setZeroStatUnc = True
-        # this is a big loop a bit slow, but it might be mainly the hist->root conversion and writing into the root file
+        # the histograms are written in batches into the sub directory of the process by the RootHistWriter
         for name, var in var_map.items():
             if name != "":
                 self.writeHist(var, proc, name, setZeroStatUnc=setZeroStatUnc,
@@ -763,9 +806,11 @@ class CardTool(object):
             else:
                 self.outfile = ROOT.TFile(outfile, "recreate")
                 self.outfile.cd()
+                self.writer = output_tools.RootHistWriter(self.outfile)
         else:
             self.outfile = outfile
             self.outfile.cd()
+            self.writer = output_tools.RootHistWriter(self.outfile)
 
     def setOutput(self, outfolder, basename):
         self.outfolder = outfolder
@@ -819,6 +864,9 @@ class CardTool(object):
             )
             self.writeForProcesses(syst, label="syst", processes=processes, check_systs=check_systs)
 
+        if self.writer is not None:
+            self.writer.flush()
+            logger.info(f"Wrote {self.writer.nwritten} histograms")
         output_tools.writeMetaInfoToRootFile(self.outfile, exclude_diff='notebooks', args=args)
         if self.skipHist:
             logger.info("Histograms will not be written because 'skipHist' flag is set to True")
@@ -1018,17 +1066,13 @@ class CardTool(object):
             self.cardContent[chan] = output_tools.readTemplate(self.nominalTemplate, args)
             self.cardGroups[chan] = ""
             
-    def writeHistByCharge(self, h, name):
+    def writeHistByCharge(self, h, proc, name):
         for charge in self.channels:
             q = self.chargeIdDict[charge]["val"]
-            hout = narf.hist_to_root(self.getBoostHistByCharge(h, q))
-            hout.SetName(name.replace("CHANNEL",charge)+f"_{charge}")
-            hout.Write()
+            self.writer.write(proc, name.replace("CHANNEL",charge)+f"_{charge}", self.getBoostHistByCharge(h, q))
         
-    def writeHistWithCharges(self, h, name):
-        hout = narf.hist_to_root(h)
-        hout.SetName(f"{name}_{self.channels[0]}" if self.channels else name)
-        hout.Write()
+    def writeHistWithCharges(self, h, proc, name):
+        self.writer.write(proc, f"{name}_{self.channels[0]}" if self.channels else name, h)
     
     def writeHist(self, h, proc, syst, setZeroStatUnc=False, decorrByBin={}, hnomi=None):
         if self.skipHist:
@@ -1063,10 +1107,6 @@ class CardTool(object):
         if setZeroStatUnc:
             h.variances(flow=True)[...] = 0.
 
-        # make sub directories for each process or return existing sub directory
-        directory = self.outfile.mkdir(proc, proc, True)
-        directory.cd()
-
         name = self.variationName(proc, syst)
 
         hists = {name: h} # always keep original variation in output file for checks
@@ -1075,7 +1115,6 @@ class CardTool(object):
 
         for hname, histo in hists.items():
             if self.writeByCharge:
-                self.writeHistByCharge(histo, hname)
+                self.writeHistByCharge(histo, proc, hname)
             else:
-                self.writeHistWithCharges(histo, hname)
-        self.outfile.cd()
+                self.writeHistWithCharges(histo, proc, hname)
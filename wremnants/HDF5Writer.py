@@ -6,16 +6,169 @@ import time
 import numpy as np
 import hist
 import h5py
-from utilities.h5pyutils import writeFlatInChunks, writeSparse
+from utilities.h5pyutils import writeFlatInChunks, writeSparse, FlatChunkedWriter
+from utilities.cache_tools import hash_object, file_fingerprint
 import math
 import pandas as pd
 import os
+import tempfile
+import multiprocessing
+import concurrent.futures
 import narf
 import re
 from collections import defaultdict
 
 logger = logging.child_logger(__name__)
 
+class LogkStore(object):
+    # keeps the logk arrays (logkavg, logkhalfdiff) for each channel, process and systematic in memory
+    def __init__(self):
+        self.logk = defaultdict(dict)
+
+    def add(self, chan, proc, syst, logkavg, logkhalfdiff):
+        self.logk[(chan, proc)][syst] = (logkavg, logkhalfdiff)
+
+    def systs(self, chan, proc):
+        return self.logk[(chan, proc)].keys() if (chan, proc) in self.logk else set()
+
+    def get(self, chan, proc, syst, start=None, stop=None):
+        logkavg, logkhalfdiff = self.logk[(chan, proc)][syst]
+        return logkavg[start:stop], logkhalfdiff[start:stop]
+
+    def close(self):
+        self.logk.clear()
+
+    def detach(self):
+        return self
+
+class LogkSpool(LogkStore):
+    # keeps the logk arrays in a temporary (uncompressed) hdf5 file instead of memory, 
+    #   such that each systematic is released as soon as it is computed
+    def __init__(self, outfolder):
+        fd, self.path = tempfile.mkstemp(prefix="logk_spool_", suffix=".hdf5", dir=outfolder)
+        os.close(fd)
+        logger.info(f"Spool logk arrays to temporary file {self.path}")
+        self.file = h5py.File(self.path, mode="w")
+        # map from (chan, proc) to {syst: dataset name}, dataset names are indices to avoid issues with special characters 
+        self.names = defaultdict(dict)
+        self.nentries = 0
+
+    def add(self, chan, proc, syst, logkavg, logkhalfdiff):
+        names = self.names[(chan, proc)]
+        if syst in names:
+            del self.file[names[syst]]
+        else:
+            names[syst] = str(self.nentries)
+            self.nentries += 1
+        # store as [nbins, 2] such that the values for a range of bins are contiguous on disk
+        self.file.create_dataset(names[syst], data=np.stack([logkavg, logkhalfdiff], axis=-1))
+
+    def systs(self, chan, proc):
+        return self.names[(chan, proc)].keys() if (chan, proc) in self.names else set()
+
+    def get(self, chan, proc, syst, start=None, stop=None):
+        logk = self.file[self.names[(chan, proc)][syst]][start:stop]
+        return logk[:,0], logk[:,1]
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+    def detach(self):
+        # close the file such that the spool can be passed to and reopened (read only) in another process
+        self.file.close()
+        return self
+
+    def __getstate__(self):
+        return {"path" : self.path, "names" : self.names, "nentries" : self.nentries}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file = h5py.File(self.path, mode="r")
+
+class LogkStoreChannels(LogkStore):
+    # separate logk stores for each channel, e.g. filled in different worker processes
+    def __init__(self, spooldir=None):
+        # directory for the spool files of the channels, if None the logk arrays are kept in memory
+        self.spooldir = spooldir
+        self.stores = {}
+
+    def add(self, chan, proc, syst, logkavg, logkhalfdiff):
+        self.stores[chan].add(chan, proc, syst, logkavg, logkhalfdiff)
+
+    def systs(self, chan, proc):
+        return self.stores[chan].systs(chan, proc) if chan in self.stores else set()
+
+    def get(self, chan, proc, syst, start=None, stop=None):
+        return self.stores[chan].get(chan, proc, syst, start, stop)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores.clear()
+
+class LogkCache(object):
+    # persistent cache of the logk arrays of the shape systematics, one file for each channel, process and systematic group
+    #   the entries are keyed by a hash of everything that goes into their computation (see HDF5Writer.logk_cache_key)
+    # bump the version if the computation of the logk arrays changes
+    version = 1
+
+    def __init__(self, cachedir):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.cachedir = cachedir
+        logger.info(f"Use cache for logk arrays in {cachedir}")
+
+    def path(self, key):
+        return f"{self.cachedir}/logk_{key}.hdf5"
+
+    def load(self, key):
+        # returns a list of (var_name, logkavg, logkhalfdiff) or None if there is no entry
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        with h5py.File(path, mode="r") as f:
+            var_names = list(f["names"].asstr()[...])
+            logkavg = f["logkavg"][...]
+            logkhalfdiff = f["logkhalfdiff"][...]
+        return [(var_name, np.ascontiguousarray(logkavg[:,i]), np.ascontiguousarray(logkhalfdiff[:,i])) for i, var_name in enumerate(var_names)]
+
+    def save(self, key, var_names, logkavg, logkhalfdiff):
+        # logkavg and logkhalfdiff of shape [nbins, nvar], write to a temporary file first such that concurrent writers never leave a partial entry
+        fd, tmppath = tempfile.mkstemp(prefix="logk_", suffix=".tmp", dir=self.cachedir)
+        os.close(fd)
+        with h5py.File(tmppath, mode="w") as f:
+            f.create_dataset("names", data=np.array(var_names, dtype=object), dtype=h5py.string_dtype())
+            f.create_dataset("logkavg", data=logkavg)
+            f.create_dataset("logkhalfdiff", data=logkhalfdiff)
+        os.replace(tmppath, self.path(key))
+
+# writer and arguments for the computation of the shape systematics in worker processes, inherited through fork
+_pool_state = None
+
+def _get_logk_shape_pool(shape_syst):
+    writer, kwargs = _pool_state
+    return writer.get_logk_shape(*shape_syst, **kwargs)
+
+# writer, spool directory and arguments for the preparation of the channels in worker processes, inherited through fork
+_channel_state = None
+
+def _prepare_channel_pool(chan):
+    writer, spooldir, kwargs = _channel_state
+    logk_store = LogkSpool(spooldir) if spooldir is not None else LogkStore()
+    result = writer.prepare_channel(chan, writer.channels[chan], logk_store, **kwargs)
+    return result, logk_store.detach()
+
+def get_blocks(sizes, maxsize):
+    # split consecutive entries into blocks with a total size of at most maxsize (but at least one entry per block)
+    cumsizes = np.cumsum(sizes)
+    lo = 0
+    while lo < len(sizes):
+        base = cumsizes[lo-1] if lo > 0 else 0
+        hi = max(lo+1, int(np.searchsorted(cumsizes, base+maxsize, side="right")))
+        yield lo, hi
+        lo = hi
+
 class HDF5Writer(object):
     # keeps multiple card tools and writes them out in a single file to fit (appending the histograms)
     def __init__(self, card_name="card"):
@@ -41,6 +194,9 @@ class HDF5Writer(object):
         self.channels = {}
         self.masked_channels = []
 
+        # persistent cache of the logk arrays of the shape systematics
+        self.logkCache = None
+
         self.clipSystVariations=False
         self.clipSystVariationsSignal=False
         if self.clipSystVariations>0.:
@@ -120,8 +276,24 @@ class HDF5Writer(object):
         dict_pseudodata = {c : [] for c in self.get_channels()}
         dict_sumw2 = {c : {} for c in self.get_channels()}
         dict_norm = {c : {} for c in self.get_channels()}
-        dict_logkavg = {c : {} for c in self.get_channels()}
-        dict_logkhalfdiff = {c : {} for c in self.get_channels()}
+
+        if args.logkCacheDir:
+            self.logkCache = LogkCache(args.logkCacheDir)
+
+        # streaming mode: keep logk arrays on disk and write the output tensors in blocks of bounded size
+        streaming = args.streaming
+        maxMemory = int(args.maxMemory*1024**3)
+        if streaming and not os.path.isdir(outfolder):
+            os.makedirs(outfolder)
+
+        # prepare the channels in parallel worker processes, each filling its own logk store
+        channelJobs = min(args.channelJobs, len(self.channels))
+        if channelJobs > 1:
+            logk_store = LogkStoreChannels(outfolder if streaming else None)
+        elif streaming:
+            logk_store = LogkSpool(outfolder)
+        else:
+            logk_store = LogkStore()
 
         # store list of axes for each channel
         hist_axes = {}
@@ -132,268 +304,35 @@ class HDF5Writer(object):
         npseudodata = 0
         pseudoDataNames = []
 
-        for chan, chanInfo in self.get_channels().items():
-            masked = chanInfo.xnorm and not self.theoryFit
-            logger.info(f"Now in channel {chan} masked={masked}")
-
-            dg = chanInfo.datagroups
-            if masked:
+        for chan, result in self.iter_channels(channelJobs, logk_store, args=args, signals=signals, 
+            forceNonzero=forceNonzero, allowNegativeExpectation=allowNegativeExpectation
+        ):
+            if result["masked"]:
                 self.masked_channels.append(chan)
-                axes = ["count"]
-                nbinschan = 1
             else:
-                axes = chanInfo.fit_axes[:]
-                nbinschan = None
-
-            # load data and nominal ans syst histograms
-            dg.loadHistsForDatagroups(
-                baseName=chanInfo.nominalName, syst=chanInfo.nominalName,
-                procsToRead=dg.groups.keys(),
-                label=chanInfo.nominalName, 
-                scaleToNewLumi=chanInfo.lumiScale, 
-                forceNonzero=forceNonzero)
-
-            if not masked and chanInfo.ABCD:
-                setSimultaneousABCD(chanInfo)
-
-                if dg.fakeName not in bkgs:
-                    bkgs.append(dg.fakeName)
-                if chanInfo.nameMT not in axes:
-                    axes.append(chanInfo.nameMT)
-                if common.passIsoName not in axes:
-                    axes.append(common.passIsoName)
-
-            procs_chan = chanInfo.predictedProcesses()
-
-            # get nominal histograms of any of the processes to keep track of the list of axes
-            hist_nominal = dg.groups[procs_chan[0]].hists[chanInfo.nominalName] 
-            hist_axes[chan] = [hist_nominal.axes[a] for a in axes]
-
-            # nominal predictions
-            for proc in procs_chan:
-                logger.debug(f"Now  in channel {chan} at process {proc}")
-                
-                # nominal histograms of prediction
-                norm_proc_hist = dg.groups[proc].hists[chanInfo.nominalName]
-
-                if not masked:                
-                    norm_proc, sumw2_proc = self.get_flat_values(norm_proc_hist, chanInfo, axes)
-                else:
-                    norm_proc = self.get_flat_values(norm_proc_hist, chanInfo, axes, return_variances=False)
-
-                if nbinschan is None:
-                    nbinschan = norm_proc.shape[0]
-                    nbins += nbinschan
-                elif nbinschan != norm_proc.shape[0]:
-                    raise Exception(f"Mismatch between number of bins in channel {chan} and process {proc} for expected ({nbinschan}) and ({norm_proc.shape[0]})")
-             
-                if not allowNegativeExpectation:
-                    norm_proc = np.maximum(norm_proc, 0.)
-
-                if not masked:                
-                    dict_sumw2[chan][proc] = sumw2_proc
-
-                dict_norm[chan][proc] = norm_proc
-
-            dict_logkavg[chan] = {p : {} for p in procs_chan}
-            dict_logkhalfdiff[chan] = {p : {} for p in procs_chan}
+                nbins += result["nbins"]
+                dict_sumw2[chan] = result["sumw2"]
+                dict_data_obs[chan] = result["data_obs"]
+                dict_pseudodata[chan] = result["pseudodata"]
 
-            ibins.append(nbinschan)
-
-            if not masked:                
-                # pseudodata
-                if chanInfo.pseudoData:
-                    pseudoDataNameList = []
-                    data_pseudo_hists = chanInfo.loadPseudodata()
-                    for data_pseudo_hist, pseudo_data_name, pseudo_hist_name, pseudo_axis_name, pseudo_idxs in zip(data_pseudo_hists, chanInfo.pseudoDataName, chanInfo.pseudoData, chanInfo.pseudoDataAxes, chanInfo.pseudoDataIdxs):
-                        
-                        if pseudo_axis_name is not None:
-                            pseudo_axis = data_pseudo_hist.axes[pseudo_axis_name]
-
-                            if len(pseudo_idxs) == 1 and pseudo_idxs[0] is not None and int(pseudo_idxs[0]) == -1:
-                                pseudo_idxs = pseudo_axis
-
-                            for syst_idx in pseudo_idxs:
-                                idx = 0 if syst_idx is None else syst_idx
-                                pseudo_hist = data_pseudo_hist[{pseudo_axis_name : idx}] 
-                                data_pseudo = self.get_flat_values(pseudo_hist, chanInfo, axes, return_variances=False)
-                                dict_pseudodata[chan].append(data_pseudo)
-                                if type(pseudo_axis) == hist.axis.StrCategory:
-                                    syst_bin = pseudo_axis.bin(idx) if type(idx) == int else str(idx)
-                                else:
-                                    syst_bin = str(pseudo_axis.index(idx)) if type(idx) == int else str(idx)
-                                key = f"{pseudo_data_name}{f'_{syst_bin}' if syst_idx is not None else ''}"
-                                logger.info(f"Write pseudodata {key}")
-                                pseudoDataNameList.append(key)
-                        else:
-                            # pseudodata from alternative histogram that has no syst axis
-                            data_pseudo = self.get_flat_values(data_pseudo_hist, chanInfo, axes, return_variances=False)
-                            dict_pseudodata[chan].append(data_pseudo)
-                            logger.info(f"Write pseudodata {pseudo_data_name}")
-                            pseudoDataNameList.append(pseudo_data_name)
-                                
+                if result["pseudodata_names"] is not None:
                     if npseudodata == 0:
                         npseudodata = len(dict_pseudodata[chan])
-                        pseudoDataNames = pseudoDataNameList
-                    elif npseudodata != len(dict_pseudodata[chan]) or pseudoDataNames != pseudoDataNameList:
+                        pseudoDataNames = result["pseudodata_names"]
+                    elif npseudodata != len(dict_pseudodata[chan]) or pseudoDataNames != result["pseudodata_names"]:
                         raise RuntimeError("Different pseudodata settings for different channels not supported!")
 
-                # data
-                if self.theoryFit:
-                    if self.theoryFitData is None or self.theoryFitDataCov is None:
-                        raise RuntimeError("No data or covariance found to perform theory fit")
-                    data_obs = self.theoryFitData[chan]
-                elif chanInfo.real_data and dg.dataName in dg.groups:
-                    data_obs_hist = dg.groups[dg.dataName].hists[chanInfo.nominalName]
-                    data_obs = self.get_flat_values(data_obs_hist, chanInfo, axes, return_variances=False)
-                else:
-                    # in case pseudodata is given, write first pseudodata into data hist, otherwise write sum of expected processes
-                    if chanInfo.pseudoData:
-                        logger.warning("Writing combinetf hdf5 input without data, use first pseudodata.")
-                        data_obs = dict_pseudodata[chan][0]
-                    else:
-                        logger.warning("Writing combinetf hdf5 input without data, use sum of processes.")
-                        data_obs = sum(dict_norm[chan].values())
-
-                dict_data_obs[chan] = data_obs
-
-            # lnN systematics
-            for name, syst in chanInfo.lnNSystematics.items():
-                logger.info(f"Now in channel {chan} at lnN systematic {name}")
-
-                if chanInfo.isExcludedNuisance(name): 
-                    continue
-                procs_syst = [p for p in syst["processes"] if p in procs_chan]
-                if len(procs_syst) == 0:
-                    continue
-
-                ksyst = syst["size"]
-                if type(ksyst) is list:
-                    ksystup = ksyst[1]
-                    ksystdown = ksyst[0]
-                    if ksystup == 0. and ksystdown==0.:
-                        continue
-                    if ksystup == 0.:
-                        ksystup = 1.
-                    if ksystdown == 0.:
-                        ksystdown = 1.
-                    logkup_proc = math.log(ksystup)*np.ones([nbinschan],dtype=self.dtype)
-                    logkdown_proc = -math.log(ksystdown)*np.ones([nbinschan],dtype=self.dtype)
-                    logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                    logkhalfdiff_proc = 0.5*(logkup_proc - logkdown_proc)
-                    logkup_proc = None
-                    logkdown_proc = None
-                else:
-                    if ksyst == 0.:
-                        continue
-                    logkavg_proc = math.log(ksyst)*np.ones([nbinschan],dtype=self.dtype)
-                    logkhalfdiff_proc = np.zeros([nbinschan],dtype=self.dtype)
+            ibins.append(result["nbins"])
+            hist_axes[chan] = result["axes"]
+            dict_norm[chan] = result["norm"]
 
-                for proc in procs_syst:
-                    logger.debug(f"Now at proc {proc}!")
-
-                    # save for later
-                    norm_proc = dict_norm[chan][proc]
-                    #ensure that systematic tensor is sparse where normalization matrix is sparse
-                    dict_logkavg[chan][proc][name] = np.where(np.equal(norm_proc,0.), 0., logkavg_proc)
-                    dict_logkhalfdiff[chan][proc][name] = np.where(np.equal(norm_proc,0.), 0., logkhalfdiff_proc)
+            for proc in result["bkgs"]:
+                if proc not in bkgs:
+                    bkgs.append(proc)
 
+            for syst, name in result["booked"]:
                 self.book_systematic(syst, name)
-
-            # shape systematics
-            for systKey, syst in chanInfo.systematics.items():
-                logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
-
-                if chanInfo.isExcludedNuisance(systKey): 
-                    continue
-
-                # some channels (e.g. xnorm) don't have all processes affected by the systematic
-                procs_syst = [p for p in syst["processes"] if p in procs_chan]
-                if len(procs_syst) == 0:
-                    continue
-
-                systName = systKey if not syst["name"] else syst["name"]
-
-                # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                forceToNominal=[x for x in dg.getProcNames() if x not in 
-                    dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
-
-                dg.loadHistsForDatagroups(
-                    chanInfo.nominalName, systName, label="syst",
-                    procsToRead=procs_syst, 
-                    forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
-                    preOpMap=syst["actionMap"], preOpArgs=syst["actionArgs"],
-                    # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                    forceToNominal=forceToNominal,
-                    scaleToNewLumi=chanInfo.lumiScale,
-                    nominalIfMissing=not chanInfo.xnorm # for masked channels not all systematics exist (we can skip loading nominal since Fake does not exist)
-                )
-
-                for proc in procs_syst:
-                    logger.debug(f"Now at proc {proc}!")
-
-                    hvar = dg.groups[proc].hists["syst"]
-                    
-                    if syst["doActionBeforeMirror"] and syst["action"]:
-                        logger.debug(f"Do action before mirror")
-                        hvar = syst["action"](hvar, **syst["actionArgs"])
-                    if syst["decorrByBin"]:
-                        raise NotImplementedError("By bin decorrelation is not supported for writing output in hdf5")
-
-                    var_map = chanInfo.systHists(hvar, systKey)
-                    var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) 
-                        for x in filter(lambda x: x != "", var_map.keys())]
-                    # Deduplicate while keeping order
-                    var_names = list(dict.fromkeys(var_names))
-                    norm_proc = dict_norm[chan][proc]
-
-                    for var_name in var_names:
-                        kfac = syst["scale"]
-
-                        def get_logk(histname, var_type=""):
-                            _hist = var_map[histname+var_type]
-
-                            _syst = self.get_flat_values(_hist, chanInfo, axes, return_variances=False)
-                            
-                            # check if there is a sign flip between systematic and nominal
-                            _logk = kfac*np.log(_syst/norm_proc)
-                            _logk_view = np.where(np.equal(np.sign(norm_proc*_syst),1), _logk, self.logkepsilon*np.ones_like(_logk))
-                            _syst = None
-
-                            if self.clipSystVariations>0.:
-                                _logk = np.clip(_logk,-self.clip,self.clip)
-                            if self.clipSystVariationsSignal>0. and proc in signals:
-                                _logk = np.clip(_logk,-self.clipSig,self.clipSig)
-
-                            return _logk_view
-
-                        if syst["mirror"]:
-                            logkavg_proc = get_logk(var_name)
-                            logkhalfdiff_proc = np.zeros([nbinschan],dtype=self.dtype)
-                        else:
-                            logkup_proc = get_logk(var_name, "Up")
-                            logkdown_proc = get_logk(var_name, "Down")
-
-                            logkavg_proc = 0.5*(logkup_proc - logkdown_proc)
-                            logkhalfdiff_proc = 0.5*(logkup_proc + logkdown_proc)
-
-                            logkup_proc = None
-                            logkdown_proc = None
-
-                        #ensure that systematic tensor is sparse where normalization matrix is sparse
-                        logkavg_proc = np.where(np.equal(norm_proc,0.), 0., logkavg_proc)
-                        logkhalfdiff_proc = np.where(np.equal(norm_proc,0.), 0., logkhalfdiff_proc)
-
-                        # save for later
-                        dict_logkavg[chan][proc][var_name] = logkavg_proc
-                        dict_logkhalfdiff[chan][proc][var_name] = logkhalfdiff_proc
-
-                        self.book_systematic(syst, var_name)
-
-                    # free memory
-                    for var in var_map.keys():
-                        var_map[var] = None
-                    dg.groups[proc].hists["syst"] = None
+            result = None
 
         procs = signals + bkgs
         nproc = len(procs)
@@ -427,180 +366,50 @@ class HDF5Writer(object):
 
         nbinsfull = sum(ibins)
 
-        ibin = 0
         if args.sparse:
             logger.info(f"Write out sparse array")
+            norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, norm_idx_maps, idxdtype = self.get_sparse_norm(procs, nsyst, ibins, dict_norm)
 
-            idxdtype = 'int32'
-            maxsparseidx = max(nbinsfull*nproc,2*nsyst)
-            if maxsparseidx > np.iinfo(idxdtype).max:
-                logger.info("sparse array shapes are too large for index datatype, switching to int64")
-                idxdtype = 'int64'
-
-            norm_sparse_size = 0
-            norm_sparse_indices = np.zeros([norm_sparse_size,2],idxdtype)
-            norm_sparse_values = np.zeros([norm_sparse_size],self.dtype)
-
-            logk_sparse_size = 0
-            logk_sparse_normindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_systindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_values = np.zeros([logk_sparse_size],self.dtype)
-
-            for nbinschan, chan in zip(ibins, self.get_channels()):
-                dict_norm_chan = dict_norm[chan]
-                dict_logkavg_chan = dict_logkavg[chan]
-                dict_logkhalfdiff_chan = dict_logkhalfdiff[chan]
-
-                for iproc, proc in enumerate(procs):
-                    if proc not in dict_norm_chan:
-                        continue
-                    norm_proc = dict_norm_chan[proc]
-
-                    norm_indices = np.transpose(np.nonzero(norm_proc))
-                    norm_values = np.reshape(norm_proc[norm_indices],[-1])
-                        
-                    nvals = len(norm_values)
-                    oldlength = norm_sparse_size
-                    norm_sparse_size = oldlength + nvals
-                    norm_sparse_indices.resize([norm_sparse_size,2])
-                    norm_sparse_values.resize([norm_sparse_size])
-                    
-                    out_indices = np.array([[ibin,iproc]]) + np.pad(norm_indices,((0,0),(0,1)),'constant')
-                    norm_indices = None
-                    
-                    norm_sparse_indices[oldlength:norm_sparse_size] = out_indices
-                    out_indices = None
-                    
-                    norm_sparse_values[oldlength:norm_sparse_size] = norm_values
-                    norm_values = None
-                    
-                    norm_idx_map = np.cumsum(np.not_equal(norm_proc, 0.)) - 1 + oldlength
-
-                    dict_logkavg_proc = dict_logkavg_chan[proc]
-                    dict_logkhalfdiff_proc = dict_logkhalfdiff_chan[proc]
-                    for isyst, syst in enumerate(systs):
-                        if syst not in dict_logkavg_proc.keys():
-                            continue
-
-                        logkavg_proc = dict_logkavg_proc[syst]
-                        logkhalfdiff_proc = dict_logkhalfdiff_proc[syst]
-
-                        logkavg_proc_indices = np.transpose(np.nonzero(logkavg_proc))
-                        logkavg_proc_values = np.reshape(logkavg_proc[logkavg_proc_indices],[-1])
-                        
-                        nvals_proc = len(logkavg_proc_values)
-                        oldlength = logk_sparse_size
-                        logk_sparse_size = oldlength + nvals_proc
-                        logk_sparse_normindices.resize([logk_sparse_size,1])
-                        logk_sparse_systindices.resize([logk_sparse_size,1])
-                        logk_sparse_values.resize([logk_sparse_size])
-
-                        #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                        #second dimension is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] flattened to isyst
-                        #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                        out_normindices = norm_idx_map[logkavg_proc_indices]
-                        logkavg_proc_indices = None
-                        
-                        logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                        logk_sparse_systindices[oldlength:logk_sparse_size] = isyst
-                        out_normindices = None
-                        
-                        logk_sparse_values[oldlength:logk_sparse_size] = logkavg_proc_values
-                        logkavg_proc_values = None
-                        
-                        logkhalfdiff_proc_indices = np.transpose(np.nonzero(logkhalfdiff_proc))
-                        logkhalfdiff_proc_values = np.reshape(logkhalfdiff_proc[logkhalfdiff_proc_indices],[-1])
-                                
-                        nvals_proc = len(logkhalfdiff_proc_values)
-                        oldlength = logk_sparse_size
-                        logk_sparse_size = oldlength + nvals_proc
-                        logk_sparse_normindices.resize([logk_sparse_size,1])
-                        logk_sparse_systindices.resize([logk_sparse_size,1])
-                        logk_sparse_values.resize([logk_sparse_size])
-                                
-                        #out_indices = np.array([[ibin,iproc,isyst,1]]) + np.pad(logkhalfdiff_proc_indices,((0,0),(0,3)),'constant')
-                        #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                        #second dimension is flattened in the [2,nsyst] space, where logkhalfdiff corresponds to [1,isyst] flattened to nsyst + isyst
-                        #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                        out_normindices = norm_idx_map[logkhalfdiff_proc_indices]
-                        logkhalfdiff_proc_indices = None
-                        
-                        logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                        logk_sparse_systindices[oldlength:logk_sparse_size] = nsyst + isyst
-                        out_normindices = None
-                        
-                        logk_sparse_values[oldlength:logk_sparse_size] = logkhalfdiff_proc_values
-                    logkhalfdiff_proc_values = None        
-    
-                    # free memory
-                    logkavg_proc = None
-                    logkhalfdiff_proc = None
-
-                # free memory
-                norm_proc = None
-                norm_idx_map = None
-
-                ibin += nbinschan
-            
-            logger.info(f"Resize and sort sparse arrays into canonical order")
-            #resize sparse arrays to actual length
-            norm_sparse_indices.resize([norm_sparse_size,2])
-            norm_sparse_values.resize([norm_sparse_size])
-            logk_sparse_normindices.resize([logk_sparse_size,1])
-            logk_sparse_systindices.resize([logk_sparse_size,1])
-            logk_sparse_values.resize([logk_sparse_size])
-            
-            #straightforward sorting of norm_sparse into canonical order
-            norm_sparse_dense_shape = (nbinsfull, nproc)
-            norm_sort_indices = np.argsort(np.ravel_multi_index(np.transpose(norm_sparse_indices),norm_sparse_dense_shape))
-            norm_sparse_indices = norm_sparse_indices[norm_sort_indices]
-            norm_sparse_values = norm_sparse_values[norm_sort_indices]
-                
-            #now permute the indices of the first dimension of logk_sparse corresponding to the resorting of norm_sparse
-            
-            #compute the inverse permutation from the sorting of norm_sparse
-            #since the final indices are filled from here, need to ensure it has the correct data type
-            logk_permute_indices = np.argsort(norm_sort_indices).astype(idxdtype)
-            norm_sort_indices = None
-            logk_sparse_normindices = logk_permute_indices[logk_sparse_normindices]
-            logk_permute_indices = None
-            logk_sparse_indices = np.concatenate([logk_sparse_normindices, logk_sparse_systindices],axis=-1)
-            logk_normindices = None
-
-            #now straightforward sorting of logk_sparse into canonical order
+            logger.debug("Count non-zero entries of sparse logk array")
+            logk_counts = self.count_sparse_logk(procs, systs, ibins, norm_idx_maps, logk_store)
+            logk_sparse_size = int(np.sum(logk_counts))
             logk_sparse_dense_shape = (norm_sparse_indices.shape[0], 2*nsyst)
-            logk_sort_indices = np.argsort(np.ravel_multi_index(np.transpose(logk_sparse_indices),logk_sparse_dense_shape))
-            logk_sparse_indices = logk_sparse_indices[logk_sort_indices]
-            logk_sparse_values = logk_sparse_values[logk_sort_indices]
-            logk_sort_indices = None
 
+            if not streaming:
+                logger.debug(f"Fill {logk_sparse_size} non-zero entries of sparse logk array")
+                logk_sparse_indices = np.zeros([logk_sparse_size,2], idxdtype)
+                logk_sparse_values = np.zeros([logk_sparse_size], self.dtype)
+                logk_offsets = self.get_sparse_logk_offsets(logk_counts)
+                for nbinschan, chan in zip(ibins, self.get_channels()):
+                    self.fill_sparse_logk(logk_sparse_indices, logk_sparse_values, 0, chan, 0, nbinschan, procs, systs, norm_idx_maps[chan], logk_store, logk_offsets)
+                logk_offsets = None
+                logk_counts = None
         else:
             logger.info(f"Write out dense array")
             #initialize with zeros, i.e. no variation
             norm = np.zeros([nbinsfull,nproc], self.dtype)
-            logk = np.zeros([nbinsfull,nproc,2,nsyst], self.dtype)
+            if not streaming:
+                logk = np.zeros([nbinsfull,nproc,2,nsyst], self.dtype)
 
+            ibin = 0
             for nbinschan, chan in zip(ibins, self.get_channels()):
                 dict_norm_chan = dict_norm[chan]
-                dict_logkavg_chan = dict_logkavg[chan]
-                dict_logkhalfdiff_chan = dict_logkhalfdiff[chan]
 
                 for iproc, proc in enumerate(procs):
                     if proc not in dict_norm_chan:
                         continue
                     norm[ibin:ibin+nbinschan, iproc] = dict_norm_chan[proc]
 
-                    dict_logkavg_proc = dict_logkavg_chan[proc]
-                    dict_logkhalfdiff_proc = dict_logkhalfdiff_chan[proc]
-                    for isyst, syst in enumerate(systs):
-                        if syst not in dict_logkavg_proc.keys():
-                            continue
+                if not streaming:
+                    self.fill_dense_logk(logk[ibin:ibin+nbinschan], chan, 0, nbinschan, procs, systs, logk_store)
 
-                        logk[ibin:ibin+nbinschan,iproc,0,isyst] = dict_logkavg_proc[syst]
-                        logk[ibin:ibin+nbinschan,iproc,1,isyst] = dict_logkhalfdiff_proc[syst]
-                        
                 ibin += nbinschan
-            
+
+        if not streaming:
+            logk_store.close()
+
+        logging.print_memory_info("tensor assembly", logger)
+
         #compute poisson parameter for Barlow-Beeston bin-by-bin statistical uncertainties
         kstat = np.square(sumw)/sumw2
         #numerical protection to avoid poorly defined constraint
@@ -721,17 +530,559 @@ class HDF5Writer(object):
             nbytes += writeSparse(norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, f, "hnorm_sparse", maxChunkBytes = self.chunkSize)
             norm_sparse_indices = None
             norm_sparse_values = None
-            nbytes += writeSparse(logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape, f, "hlogk_sparse", maxChunkBytes = self.chunkSize)
-            logk_sparse_indices = None
-            logk_sparse_values = None
+            if streaming:
+                nbytes += self.write_sparse_logk_streaming(f, procs, systs, ibins, norm_idx_maps, idxdtype, logk_store, logk_counts, logk_sparse_dense_shape, maxMemory)
+                logk_counts = None
+            else:
+                nbytes += writeSparse(logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape, f, "hlogk_sparse", maxChunkBytes = self.chunkSize)
+                logk_sparse_indices = None
+                logk_sparse_values = None
         else:
             nbytes += writeFlatInChunks(norm, f, "hnorm", maxChunkBytes = self.chunkSize)
             norm = None
-            nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize)
-            logk = None
+            if streaming:
+                nbytes += self.write_dense_logk_streaming(f, procs, systs, ibins, logk_store, maxMemory)
+            else:
+                nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize)
+                logk = None
+
+        if streaming:
+            logk_store.close()
 
         logger.info(f"Total raw bytes in arrays = {nbytes}")
+        logging.print_memory_info("writing output", logger)
         
+    def prepare_channel(self, chan, chanInfo, logk_store, args, signals, forceNonzero=True, allowNegativeExpectation=False):
+        # load the histograms of a channel and compute the nominal, data and pseudodata arrays, 
+        #   the logk arrays of the systematics are added to the logk store
+        #   returns a dict with the arrays and the bookkeeping of the channel, such that the channels can be prepared independently
+        masked = chanInfo.xnorm and not self.theoryFit
+        logger.info(f"Now in channel {chan} masked={masked}")
+
+        dict_norm = {}
+        dict_sumw2 = {}
+        data_obs = None
+        pseudodata = []
+        pseudoDataNameList = None
+        bkgs = []
+        # systematics to be booked, as (attributes needed for booking, name)
+        booked = []
+
+        dg = chanInfo.datagroups
+        if masked:
+            axes = ["count"]
+            nbinschan = 1
+        else:
+            axes = chanInfo.fit_axes[:]
+            nbinschan = None
+
+        # load data and nominal ans syst histograms
+        dg.loadHistsForDatagroups(
+            baseName=chanInfo.nominalName, syst=chanInfo.nominalName,
+            procsToRead=dg.groups.keys(),
+            label=chanInfo.nominalName, 
+            scaleToNewLumi=chanInfo.lumiScale, 
+            forceNonzero=forceNonzero)
+
+        if not masked and chanInfo.ABCD:
+            setSimultaneousABCD(chanInfo)
+
+            if dg.fakeName not in bkgs:
+                bkgs.append(dg.fakeName)
+            if chanInfo.nameMT not in axes:
+                axes.append(chanInfo.nameMT)
+            if common.passIsoName not in axes:
+                axes.append(common.passIsoName)
+
+        procs_chan = chanInfo.predictedProcesses()
+
+        # get nominal histograms of any of the processes to keep track of the list of axes
+        hist_nominal = dg.groups[procs_chan[0]].hists[chanInfo.nominalName] 
+        hist_axes = [hist_nominal.axes[a] for a in axes]
+
+        # nominal predictions
+        for proc in procs_chan:
+            logger.debug(f"Now  in channel {chan} at process {proc}")
+            
+            # nominal histograms of prediction
+            norm_proc_hist = dg.groups[proc].hists[chanInfo.nominalName]
+
+            if not masked:                
+                norm_proc, sumw2_proc = self.get_flat_values(norm_proc_hist, chanInfo, axes)
+            else:
+                norm_proc = self.get_flat_values(norm_proc_hist, chanInfo, axes, return_variances=False)
+
+            if nbinschan is None:
+                nbinschan = norm_proc.shape[0]
+            elif nbinschan != norm_proc.shape[0]:
+                raise Exception(f"Mismatch between number of bins in channel {chan} and process {proc} for expected ({nbinschan}) and ({norm_proc.shape[0]})")
+         
+            if not allowNegativeExpectation:
+                norm_proc = np.maximum(norm_proc, 0.)
+
+            if not masked:                
+                dict_sumw2[proc] = sumw2_proc
+
+            dict_norm[proc] = norm_proc
+
+        if not masked:                
+            # pseudodata
+            if chanInfo.pseudoData:
+                pseudoDataNameList = []
+                data_pseudo_hists = chanInfo.loadPseudodata()
+                for data_pseudo_hist, pseudo_data_name, pseudo_hist_name, pseudo_axis_name, pseudo_idxs in zip(data_pseudo_hists, chanInfo.pseudoDataName, chanInfo.pseudoData, chanInfo.pseudoDataAxes, chanInfo.pseudoDataIdxs):
+                    
+                    if pseudo_axis_name is not None:
+                        pseudo_axis = data_pseudo_hist.axes[pseudo_axis_name]
+
+                        if len(pseudo_idxs) == 1 and pseudo_idxs[0] is not None and int(pseudo_idxs[0]) == -1:
+                            pseudo_idxs = pseudo_axis
+
+                        for syst_idx in pseudo_idxs:
+                            idx = 0 if syst_idx is None else syst_idx
+                            pseudo_hist = data_pseudo_hist[{pseudo_axis_name : idx}] 
+                            data_pseudo = self.get_flat_values(pseudo_hist, chanInfo, axes, return_variances=False)
+                            pseudodata.append(data_pseudo)
+                            if type(pseudo_axis) == hist.axis.StrCategory:
+                                syst_bin = pseudo_axis.bin(idx) if type(idx) == int else str(idx)
+                            else:
+                                syst_bin = str(pseudo_axis.index(idx)) if type(idx) == int else str(idx)
+                            key = f"{pseudo_data_name}{f'_{syst_bin}' if syst_idx is not None else ''}"
+                            logger.info(f"Write pseudodata {key}")
+                            pseudoDataNameList.append(key)
+                    else:
+                        # pseudodata from alternative histogram that has no syst axis
+                        data_pseudo = self.get_flat_values(data_pseudo_hist, chanInfo, axes, return_variances=False)
+                        pseudodata.append(data_pseudo)
+                        logger.info(f"Write pseudodata {pseudo_data_name}")
+                        pseudoDataNameList.append(pseudo_data_name)
+                            
+            # data
+            if self.theoryFit:
+                if self.theoryFitData is None or self.theoryFitDataCov is None:
+                    raise RuntimeError("No data or covariance found to perform theory fit")
+                data_obs = self.theoryFitData[chan]
+            elif chanInfo.real_data and dg.dataName in dg.groups:
+                data_obs_hist = dg.groups[dg.dataName].hists[chanInfo.nominalName]
+                data_obs = self.get_flat_values(data_obs_hist, chanInfo, axes, return_variances=False)
+            else:
+                # in case pseudodata is given, write first pseudodata into data hist, otherwise write sum of expected processes
+                if chanInfo.pseudoData:
+                    logger.warning("Writing combinetf hdf5 input without data, use first pseudodata.")
+                    data_obs = pseudodata[0]
+                else:
+                    logger.warning("Writing combinetf hdf5 input without data, use sum of processes.")
+                    data_obs = sum(dict_norm.values())
+
+        # lnN systematics
+        for name, syst in chanInfo.lnNSystematics.items():
+            logger.info(f"Now in channel {chan} at lnN systematic {name}")
+
+            if chanInfo.isExcludedNuisance(name): 
+                continue
+            procs_syst = [p for p in syst["processes"] if p in procs_chan]
+            if len(procs_syst) == 0:
+                continue
+
+            ksyst = syst["size"]
+            if type(ksyst) is list:
+                ksystup = ksyst[1]
+                ksystdown = ksyst[0]
+                if ksystup == 0. and ksystdown==0.:
+                    continue
+                if ksystup == 0.:
+                    ksystup = 1.
+                if ksystdown == 0.:
+                    ksystdown = 1.
+                logkup_proc = math.log(ksystup)*np.ones([nbinschan],dtype=self.dtype)
+                logkdown_proc = -math.log(ksystdown)*np.ones([nbinschan],dtype=self.dtype)
+                logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
+                logkhalfdiff_proc = 0.5*(logkup_proc - logkdown_proc)
+                logkup_proc = None
+                logkdown_proc = None
+            else:
+                if ksyst == 0.:
+                    continue
+                logkavg_proc = math.log(ksyst)*np.ones([nbinschan],dtype=self.dtype)
+                logkhalfdiff_proc = np.zeros([nbinschan],dtype=self.dtype)
+
+            for proc in procs_syst:
+                logger.debug(f"Now at proc {proc}!")
+
+                # save for later
+                norm_proc = dict_norm[proc]
+                #ensure that systematic tensor is sparse where normalization matrix is sparse
+                logk_store.add(chan, proc, name, np.where(np.equal(norm_proc,0.), 0., logkavg_proc), np.where(np.equal(norm_proc,0.), 0., logkhalfdiff_proc))
+
+            booked.append((self.booking_info(syst), name))
+
+        # shape systematics
+        shape_systs = []
+        for systKey, syst in chanInfo.systematics.items():
+            if chanInfo.isExcludedNuisance(systKey): 
+                continue
+
+            # some channels (e.g. xnorm) don't have all processes affected by the systematic
+            procs_syst = [p for p in syst["processes"] if p in procs_chan]
+            if len(procs_syst) == 0:
+                continue
+
+            shape_systs.append((systKey, procs_syst))
+
+        for systKey, logk_syst in self.iter_logk_shape(shape_systs, args.jobs, chan=chan, chanInfo=chanInfo, axes=axes, 
+            dict_norm_chan=dict_norm, signals=signals, nbinschan=nbinschan, forceNonzero=forceNonzero
+        ):
+            syst = chanInfo.systematics[systKey]
+            for proc, var_name, logkavg_proc, logkhalfdiff_proc in logk_syst:
+                # save for later
+                logk_store.add(chan, proc, var_name, logkavg_proc, logkhalfdiff_proc)
+                booked.append((self.booking_info(syst), var_name))
+            logk_syst = None
+
+        logging.print_memory_info(f"channel {chan}", logger)
+
+        return {
+            "masked" : masked,
+            "axes" : hist_axes,
+            "nbins" : nbinschan,
+            "norm" : dict_norm,
+            "sumw2" : dict_sumw2,
+            "data_obs" : data_obs,
+            "pseudodata" : pseudodata,
+            "pseudodata_names" : pseudoDataNameList,
+            "bkgs" : bkgs,
+            "booked" : booked,
+        }
+
+    def iter_channels(self, jobs, logk_store, **kwargs):
+        # prepare the channels, optionally in (forked) worker processes, one per channel
+        #   the results are returned in the order of the channels, such that the output is identical to the serial processing
+        channels = self.get_channels()
+        if jobs <= 1 or len(channels) <= 1:
+            for chan, chanInfo in channels.items():
+                yield chan, self.prepare_channel(chan, chanInfo, logk_store, **kwargs)
+            return
+
+        global _channel_state
+        _channel_state = (self, logk_store.spooldir, kwargs)
+        logger.info(f"Prepare {len(channels)} channels in {min(jobs, len(channels))} worker processes")
+        # the worker processes inherit the state of the card tools through fork, 
+        #   they are not daemonic such that they can use a pool for the shape systematics themselves
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(channels)), mp_context=multiprocessing.get_context("fork")) as executor:
+            for chan, (result, store) in zip(channels.keys(), executor.map(_prepare_channel_pool, channels.keys())):
+                logk_store.stores[chan] = store
+                yield chan, result
+        _channel_state = None
+
+    def booking_info(self, syst):
+        # attributes of a systematic that are needed to book it
+        return {k : syst[k] for k in ["noProfile", "noConstraint", "noi", "group", "splitGroup"] if k in syst}
+
+    def iter_logk_shape(self, shape_systs, jobs=1, **kwargs):
+        # compute the logk arrays of the shape systematic groups, optionally in a pool of (forked) worker processes
+        #   the results are returned in the order of the systematic groups, such that the output is identical to the serial processing
+        if jobs <= 1 or len(shape_systs) <= 1:
+            for systKey, procs_syst in shape_systs:
+                yield systKey, self.get_logk_shape(systKey, procs_syst, **kwargs)
+            return
+
+        global _pool_state
+        _pool_state = (self, kwargs)
+        logger.info(f"Process {len(shape_systs)} shape systematic groups in {min(jobs, len(shape_systs))} worker processes")
+        # the worker processes inherit the state of the datagroups and card tool through fork
+        with multiprocessing.get_context("fork").Pool(min(jobs, len(shape_systs))) as pool:
+            for (systKey, _), logk_syst in zip(shape_systs, pool.imap(_get_logk_shape_pool, shape_systs)):
+                yield systKey, logk_syst
+        _pool_state = None
+
+    def get_logk_shape(self, systKey, procs_syst, chan, chanInfo, axes, dict_norm_chan, signals, nbinschan, forceNonzero=True):
+        # compute logkavg and logkhalfdiff for each process and variation of a shape systematic group
+        #   returns a list of (proc, var_name, logkavg, logkhalfdiff)
+        logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
+        dg = chanInfo.datagroups
+        syst = chanInfo.systematics[systKey]
+
+        systName = systKey if not syst["name"] else syst["name"]
+
+        # Needed to avoid always reading the variation for the fakes, even for procs not specified
+        forceToNominal=[x for x in dg.getProcNames() if x not in 
+            dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
+
+        # reuse the cached logk arrays of processes for which nothing changed
+        cache_keys = {}
+        cached = {}
+        if self.logkCache is not None:
+            for proc in procs_syst:
+                cache_keys[proc] = self.logk_cache_key(systKey, proc, chanInfo, axes, dict_norm_chan[proc], forceNonzero, forceToNominal)
+                entries = self.logkCache.load(cache_keys[proc])
+                if entries is not None:
+                    cached[proc] = entries
+            logger.info(f"Found cached logk arrays for {len(cached)}/{len(procs_syst)} processes of shape systematic group {systKey}")
+
+        # the histograms of all processes are needed to build the fakes and to find missing systematics consistently
+        if len(cached) < len(procs_syst):
+            dg.loadHistsForDatagroups(
+                chanInfo.nominalName, systName, label="syst",
+                procsToRead=procs_syst, 
+                forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
+                preOpMap=syst["actionMap"], preOpArgs=syst["actionArgs"],
+                # Needed to avoid always reading the variation for the fakes, even for procs not specified
+                forceToNominal=forceToNominal,
+                scaleToNewLumi=chanInfo.lumiScale,
+                nominalIfMissing=not chanInfo.xnorm # for masked channels not all systematics exist (we can skip loading nominal since Fake does not exist)
+            )
+
+        logk_syst = []
+        for proc in procs_syst:
+            logger.debug(f"Now at proc {proc}!")
+
+            if proc in cached:
+                logk_syst.extend([(proc, *entry) for entry in cached[proc]])
+                dg.groups[proc].hists["syst"] = None
+                continue
+
+            hvar = dg.groups[proc].hists["syst"]
+            
+            if syst["doActionBeforeMirror"] and syst["action"]:
+                logger.debug(f"Do action before mirror")
+                hvar = syst["action"](hvar, **syst["actionArgs"])
+            if syst["decorrByBin"]:
+                raise NotImplementedError("By bin decorrelation is not supported for writing output in hdf5")
+
+            norm_proc = dict_norm_chan[proc]
+            kfac = syst["scale"]
+
+            if chanInfo.ABCD and set(chanInfo.fakerateAxes) != set(chanInfo.fit_axes):
+                # the ABCD projection needs the histogram of each variation
+                var_map = chanInfo.systHists(hvar, systKey)
+                var_columns = {name : i for i, name in enumerate(var_map.keys())}
+                var_values = np.stack([self.get_flat_values(var_map[name], chanInfo, axes, return_variances=False) for name in var_map.keys()], axis=-1)
+                var_map = None
+            else:
+                # values of all variations at once, as an array of shape [nbins, nvariations]
+                var_columns, var_values = chanInfo.systHistsArray(hvar, systKey, axes)
+                var_values = var_values.astype(self.dtype)
+            hvar = None
+            dg.groups[proc].hists["syst"] = None
+
+            var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) 
+                for x in filter(lambda x: x != "", var_columns.keys())]
+            # Deduplicate while keeping order
+            var_names = list(dict.fromkeys(var_names))
+
+            if not len(var_names):
+                if proc in cache_keys:
+                    self.logkCache.save(cache_keys[proc], [], np.zeros([len(norm_proc), 0], self.dtype), np.zeros([len(norm_proc), 0], self.dtype))
+                continue
+
+            # compute logk for all variations in one go 
+            var_logk = kfac*np.log(var_values/norm_proc[:,None])
+            # check if there is a sign flip between systematic and nominal
+            var_logk = np.where(np.equal(np.sign(norm_proc[:,None]*var_values),1), var_logk, self.logkepsilon)
+            var_values = None
+
+            if self.clipSystVariations>0.:
+                var_logk = np.clip(var_logk,-self.clip,self.clip)
+            if self.clipSystVariationsSignal>0. and proc in signals:
+                var_logk = np.clip(var_logk,-self.clipSig,self.clipSig)
+
+            if syst["mirror"]:
+                logkavg = var_logk[:, [var_columns[n] for n in var_names]]
+                logkhalfdiff = np.zeros_like(logkavg)
+            else:
+                logkup = var_logk[:, [var_columns[n+"Up"] for n in var_names]]
+                logkdown = var_logk[:, [var_columns[n+"Down"] for n in var_names]]
+
+                logkavg = 0.5*(logkup - logkdown)
+                logkhalfdiff = 0.5*(logkup + logkdown)
+
+                logkup = None
+                logkdown = None
+            var_logk = None
+
+            #ensure that systematic tensor is sparse where normalization matrix is sparse
+            logkavg = np.where(np.equal(norm_proc,0.)[:,None], 0., logkavg).astype(self.dtype)
+            logkhalfdiff = np.where(np.equal(norm_proc,0.)[:,None], 0., logkhalfdiff).astype(self.dtype)
+
+            if proc in cache_keys:
+                self.logkCache.save(cache_keys[proc], var_names, logkavg, logkhalfdiff)
+
+            for i, var_name in enumerate(var_names):
+                logk_syst.append((proc, var_name, np.ascontiguousarray(logkavg[:,i]), np.ascontiguousarray(logkhalfdiff[:,i])))
+
+        return logk_syst
+
+    def logk_cache_key(self, systKey, proc, chanInfo, axes, norm_proc, forceNonzero, forceToNominal):
+        # hash of everything the logk arrays of a process and shape systematic group are computed from:
+        #   the input file, the definition of the systematic, the processing of the histograms of the process, the fit axes and the nominal prediction
+        # note that changes in the helper functions called by the actions are not detected, the cache directory should be cleared after such changes
+        dg = chanInfo.datagroups
+        group = dg.groups[proc]
+        syst = chanInfo.systematics[systKey]
+        return hash_object({
+            "version" : LogkCache.version,
+            "input" : file_fingerprint(dg.infile),
+            "syst" : systKey,
+            "definition" : {k : v for k, v in syst.items() if k not in ["processes", "group", "splitGroup", "groupFilter", "noi", "noConstraint", "noProfile", "customizeNuisanceAttributes"]},
+            "proc" : proc,
+            "members" : [(m.name, dg.processScaleFactor(m)) for m in group.members],
+            "operations" : [dg.globalAction, group.scale, group.memberOp, group.rebinOp, group.selectOp, group.selectOpArgs, getattr(dg, "gen_axes", None)],
+            "fit" : [axes, chanInfo.fit_axes, chanInfo.fakerateAxes, chanInfo.ABCD, chanInfo.xnorm, chanInfo.lumiScale, chanInfo.nominalName],
+            "options" : [forceNonzero, forceToNominal, self.dtype, self.logkepsilon, self.clipSystVariations, self.clipSystVariationsSignal],
+            "norm" : norm_proc,
+        })
+
+    def get_sparse_norm(self, procs, nsyst, ibins, dict_norm):
+        # sparse norm tensor in canonical (bin, proc) order
+        nproc = len(procs)
+        nbinsfull = sum(ibins)
+
+        idxdtype = 'int32'
+        maxsparseidx = max(nbinsfull*nproc,2*nsyst)
+        if maxsparseidx > np.iinfo(idxdtype).max:
+            logger.info("sparse array shapes are too large for index datatype, switching to int64")
+            idxdtype = 'int64'
+
+        # map from dense [bin,proc] to the index in the norm_sparse vectors (-1 for zero entries), per channel
+        norm_idx_maps = {}
+        norm_sparse_indices = []
+        norm_sparse_values = []
+        norm_sparse_size = 0
+        ibin = 0
+        for nbinschan, chan in zip(ibins, self.get_channels()):
+            norm_chan = np.zeros([nbinschan, nproc], self.dtype)
+            for iproc, proc in enumerate(procs):
+                if proc in dict_norm[chan]:
+                    norm_chan[:, iproc] = dict_norm[chan][proc]
+
+            # np.nonzero returns the indices in row-major, i.e. canonical (bin, proc) order
+            norm_indices = np.nonzero(norm_chan)
+            nvals = len(norm_indices[0])
+
+            norm_idx_map = np.full([nbinschan, nproc], -1, dtype=idxdtype)
+            norm_idx_map[norm_indices] = np.arange(norm_sparse_size, norm_sparse_size + nvals, dtype=idxdtype)
+            norm_idx_maps[chan] = norm_idx_map
+
+            norm_sparse_indices.append(np.stack([norm_indices[0] + ibin, norm_indices[1]], axis=-1).astype(idxdtype))
+            norm_sparse_values.append(norm_chan[norm_indices])
+
+            norm_sparse_size += nvals
+            ibin += nbinschan
+            norm_chan = None
+
+        norm_sparse_indices = np.concatenate(norm_sparse_indices).astype(idxdtype) if norm_sparse_indices else np.zeros([0,2],idxdtype)
+        norm_sparse_values = np.concatenate(norm_sparse_values).astype(self.dtype) if norm_sparse_values else np.zeros([0],self.dtype)
+        norm_sparse_dense_shape = (nbinsfull, nproc)
+
+        return norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, norm_idx_maps, idxdtype
+
+    def count_sparse_logk(self, procs, systs, ibins, norm_idx_maps, logk_store):
+        # number of non-zero (logkavg, logkhalfdiff) entries for each non-zero norm entry, used to preallocate the sparse logk tensor
+        nnorm = sum(np.count_nonzero(m >= 0) for m in norm_idx_maps.values())
+        logk_counts = np.zeros([nnorm, 2], dtype='int64')
+        for chan in self.get_channels():
+            norm_idx_map = norm_idx_maps[chan]
+            for iproc, proc in enumerate(procs):
+                store_systs = logk_store.systs(chan, proc)
+                for syst in systs:
+                    if syst not in store_systs:
+                        continue
+                    for ihalf, logk_proc in enumerate(logk_store.get(chan, proc, syst)):
+                        # each bin appears at most once per logk array, so the indices are unique
+                        logk_counts[norm_idx_map[np.flatnonzero(logk_proc), iproc], ihalf] += 1
+        return logk_counts
+
+    def get_sparse_logk_offsets(self, logk_counts):
+        # position of the next logkavg and logkhalfdiff entry to fill for each norm entry
+        #   the logk entries of each norm entry are ordered by the flattened [2,nsyst] index, i.e. all logkavg entries come first
+        logk_offsets = np.cumsum(np.sum(logk_counts, axis=-1)) - np.sum(logk_counts, axis=-1)
+        return np.stack([logk_offsets, logk_offsets + logk_counts[:,0]], axis=-1)
+
+    def fill_sparse_logk(self, out_indices, out_values, out_start, chan, ibinlo, ibinhi, procs, systs, norm_idx_map, logk_store, logk_offsets):
+        # fill the sparse logk entries for the bins [ibinlo, ibinhi) of a channel at their final position in canonical order
+        #   first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
+        #   second dimension is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] flattened to isyst
+        #   and logkhalfdiff to [1,isyst] flattened to nsyst + isyst
+        #   systematics are processed in order, such that the positions given by logk_offsets are filled in canonical order as well
+        nsyst = len(systs)
+        for iproc, proc in enumerate(procs):
+            store_systs = logk_store.systs(chan, proc)
+            for isyst, syst in enumerate(systs):
+                if syst not in store_systs:
+                    continue
+                for ihalf, logk_proc in enumerate(logk_store.get(chan, proc, syst, ibinlo, ibinhi)):
+                    logk_indices = np.flatnonzero(logk_proc)
+                    if len(logk_indices) == 0:
+                        continue
+                    out_normindices = norm_idx_map[ibinlo + logk_indices, iproc]
+                    out_positions = logk_offsets[out_normindices, ihalf] - out_start
+                    out_indices[out_positions, 0] = out_normindices
+                    out_indices[out_positions, 1] = ihalf*nsyst + isyst
+                    out_values[out_positions] = logk_proc[logk_indices]
+                    logk_offsets[out_normindices, ihalf] += 1
+
+    def fill_dense_logk(self, out, chan, ibinlo, ibinhi, procs, systs, logk_store):
+        # fill the dense logk tensor for the bins [ibinlo, ibinhi) of a channel, out has shape [ibinhi-ibinlo, nproc, 2, nsyst]
+        for iproc, proc in enumerate(procs):
+            store_systs = logk_store.systs(chan, proc)
+            for isyst, syst in enumerate(systs):
+                if syst not in store_systs:
+                    continue
+                logkavg_proc, logkhalfdiff_proc = logk_store.get(chan, proc, syst, ibinlo, ibinhi)
+                out[:,iproc,0,isyst] = logkavg_proc
+                out[:,iproc,1,isyst] = logkhalfdiff_proc
+
+    def write_dense_logk_streaming(self, f, procs, systs, ibins, logk_store, maxMemory):
+        # fill the dense logk tensor in blocks of bins with at most maxMemory bytes each
+        nproc = len(procs)
+        nsyst = len(systs)
+        rowsize = nproc*2*nsyst*np.dtype(self.dtype).itemsize
+        logger.info(f"Write dense logk array in blocks of up to {max(1, maxMemory//max(1,rowsize))} bins")
+
+        writer = FlatChunkedWriter(f, "hlogk", [sum(ibins),nproc,2,nsyst], self.dtype, maxChunkBytes = self.chunkSize)
+        for nbinschan, chan in zip(ibins, self.get_channels()):
+            for ibinlo, ibinhi in get_blocks(np.full([nbinschan], rowsize), maxMemory):
+                logk_block = np.zeros([ibinhi-ibinlo,nproc,2,nsyst], self.dtype)
+                self.fill_dense_logk(logk_block, chan, ibinlo, ibinhi, procs, systs, logk_store)
+                writer.append(logk_block)
+                logk_block = None
+        return writer.close()
+
+    def write_sparse_logk_streaming(self, f, procs, systs, ibins, norm_idx_maps, idxdtype, logk_store, logk_counts, dense_shape, maxMemory):
+        # fill the sparse logk tensor in blocks of bins with at most maxMemory bytes each 
+        #   (or a single bin if it has more entries than that)
+        entrysize = 2*np.dtype(idxdtype).itemsize + np.dtype(self.dtype).itemsize
+        logk_sparse_size = int(np.sum(logk_counts))
+        logk_offsets = self.get_sparse_logk_offsets(logk_counts)
+        logk_counts_norm = np.sum(logk_counts, axis=-1)
+
+        outgroup = f.create_group("hlogk_sparse")
+        indices_writer = FlatChunkedWriter(outgroup, "indices", [logk_sparse_size,2], idxdtype, maxChunkBytes = self.chunkSize)
+        values_writer = FlatChunkedWriter(outgroup, "values", [logk_sparse_size], self.dtype, maxChunkBytes = self.chunkSize)
+        outgroup.attrs['dense_shape'] = np.array(dense_shape, dtype='int64')
+
+        out_start = 0
+        for nbinschan, chan in zip(ibins, self.get_channels()):
+            norm_idx_map = norm_idx_maps[chan]
+            # number of logk entries per bin
+            nentries_bins = np.zeros([nbinschan], dtype='int64')
+            valid = norm_idx_map >= 0
+            np.add.at(nentries_bins, np.nonzero(valid)[0], logk_counts_norm[norm_idx_map[valid]])
+            for ibinlo, ibinhi in get_blocks(nentries_bins*entrysize, maxMemory):
+                nentries = int(np.sum(nentries_bins[ibinlo:ibinhi]))
+                logk_sparse_indices = np.zeros([nentries,2], idxdtype)
+                logk_sparse_values = np.zeros([nentries], self.dtype)
+                self.fill_sparse_logk(logk_sparse_indices, logk_sparse_values, out_start, chan, ibinlo, ibinhi, procs, systs, norm_idx_map, logk_store, logk_offsets)
+                indices_writer.append(logk_sparse_indices)
+                values_writer.append(logk_sparse_values)
+                out_start += nentries
+                logk_sparse_indices = None
+                logk_sparse_values = None
+
+        nbytes = indices_writer.close()
+        nbytes += values_writer.close()
+        return nbytes
+
     def book_systematic(self, syst, name):
         logger.debug(f"book systematic {name}")
         if syst.get('noProfile', False):
@@ -1,29 +1,65 @@
-import ROOT
-import narf
+import importlib
+import importlib.util
 import pathlib
 
-ROOT.gInterpreter.AddIncludePath(f"{pathlib.Path(__file__).parent}/include/")
-
-narf.clingutils.Declare('#include "muonCorr.h"')
-narf.clingutils.Declare('#include "histoScaling.h"')
-narf.clingutils.Declare('#include "histHelpers.h"')
-narf.clingutils.Declare('#include "utils.h"')
-narf.clingutils.Declare('#include "csVariables.h"')
-narf.clingutils.Declare('#include "EtaPtCorrelatedEfficiency.h"')
-narf.clingutils.Declare('#include "theoryTools.h"')
-
-from .muon_prefiring import make_muon_prefiring_helpers
-from .muon_efficiencies_smooth import make_muon_efficiency_helpers_smooth
-from .muon_efficiencies_binned import make_muon_efficiency_helpers_binned
-from .muon_efficiencies_binned_vqt import make_muon_efficiency_helpers_binned_vqt
-from .muon_efficiencies_binned_vqt_integrated import make_muon_efficiency_helpers_binned_vqt_integrated
-from .muon_efficiencies_binned_vqt_real import make_muon_efficiency_helpers_binned_vqt_real
-from .qcdScaleByHelicity_helper import makeQCDScaleByHelicityHelper
-from .pileup import make_pileup_helper
-from .vertex import make_vertex_helper
-from .syst_tools import scale_helicity_hist_to_variations
-from .theory_tools import axis_helicity, scale_tensor_axes, define_prefsr_vars, moments_to_angular_coeffs
-from .muon_calibration import *
-from .helicity_utils import *
+# ROOT, narf and the C++ headers are loaded lazily, such that scripts which only read the output
+#   (plotting, datacards) do not pay for the startup of the interpreter,
+#   the headers are declared by the helper modules in the functions that build helpers or define columns, not on import
+
+include_dir = f"{pathlib.Path(__file__).parent}/include/"
+
+# headers used in the expressions of the histmakers, declared together with the first header needed by any module
+base_headers = ["muonCorr.h", "histoScaling.h", "histHelpers.h", "utils.h", "csVariables.h", "EtaPtCorrelatedEfficiency.h", "theoryTools.h"]
+
+_declared_headers = set()
+
+def declare_headers(*headers):
+    # declare the headers (and the base headers) to the interpreter, each header only once
+    import ROOT
+    import narf.clingutils
+
+    if not _declared_headers:
+        ROOT.gInterpreter.AddIncludePath(include_dir)
+
+    for header in [*base_headers, *headers]:
+        if header in _declared_headers:
+            continue
+        narf.clingutils.Declare(f'#include "{header}"')
+        _declared_headers.add(header)
+
+# objects provided at the package level, the module is imported on first access
+_lazy_exports = {
+    "make_muon_prefiring_helpers" : "muon_prefiring",
+    "make_muon_efficiency_helpers_smooth" : "muon_efficiencies_smooth",
+    "make_muon_efficiency_helpers_binned" : "muon_efficiencies_binned",
+    "make_muon_efficiency_helpers_binned_vqt" : "muon_efficiencies_binned_vqt",
+    "make_muon_efficiency_helpers_binned_vqt_integrated" : "muon_efficiencies_binned_vqt_integrated",
+    "make_muon_efficiency_helpers_binned_vqt_real" : "muon_efficiencies_binned_vqt_real",
+    "makeQCDScaleByHelicityHelper" : "qcdScaleByHelicity_helper",
+    "make_pileup_helper" : "pileup",
+    "make_vertex_helper" : "vertex",
+    "scale_helicity_hist_to_variations" : "syst_tools",
+    "axis_helicity" : "theory_tools",
+    "scale_tensor_axes" : "theory_tools",
+    "define_prefsr_vars" : "theory_tools",
+    "moments_to_angular_coeffs" : "theory_tools",
+}
+
+# modules of which all public names are provided at the package level (previously through 'import *')
+_star_modules = ["muon_calibration", "helicity_utils"]
+
+def __getattr__(name):
+    if name in _lazy_exports:
+        return getattr(importlib.import_module(f".{_lazy_exports[name]}", __name__), name)
+
+    if not name.startswith("_"):
+        if importlib.util.find_spec(f".{name}", __name__) is not None:
+            return importlib.import_module(f".{name}", __name__)
+        for module_name in _star_modules:
+            module = importlib.import_module(f".{module_name}", __name__)
+            if hasattr(module, name):
+                return getattr(module, name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 data_dir = f"{pathlib.Path(__file__).parent}/../wremnants-data/data/"
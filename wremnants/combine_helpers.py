@@ -86,117 +86,102 @@ def setSimultaneousABCD(cardTool,
         hist_failMT_failIso = hist_fake[{**common.failIso, nameMT: failMT}]
         hist_failMT_passIso = hist_fake[{**common.passIso, nameMT: failMT}]
     hFRF = hh.divideHists(hist_failMT_failIso, hist_failMT_failIso+hist_failMT_passIso)
+    if list(hFRF.axes.name) != fakerate_axes:
+        hFRF = hFRF.project(*fakerate_axes)
     
     # axes other than fakerate axes
     other_axes = [n for n in cardTool.fit_axes if n not in fakerate_axes]
-    other_bin_sizes = [ax.size for ax in hist_fake.axes if ax.name in other_axes]
+    other_bin_sizes = [hist_fake.axes[n].size for n in other_axes]
 
     # all axes (except passIso and passMT if passMT is boolean)
     all_axes = fakerate_axes + other_axes
-
-    # helper function to get indices from a 'flat' bin count
-    def get_ax_idx(bin_sizes, i):
-        current_i = i
-        ax_idx = []
-        for num in reversed(bin_sizes):
-            ax_idx.insert(0, current_i % num)
-            current_i //= num
-        return ax_idx
-
-    # loop over all fakerate axes bins
-    for i in range(np.product(fakerate_bin_sizes)):
-
-        fakerate_ax_idx = get_ax_idx(fakerate_bin_sizes, i)
-        fakerate_bin_name = "_".join([f"{ax}{fakerate_ax_idx[j]}" for j, ax in enumerate(fakerate_axes)])
-        fakerate_indices = {ax: fakerate_ax_idx[j] for j, ax in enumerate(fakerate_axes)}
-        logger.debug(f"Now at fakerate bin {i}/{np.product(fakerate_bin_sizes)}: {fakerate_bin_name}")
-
-        # get fakerate independent of other axes
-        fr = hFRF[fakerate_indices].value
-
-        # systematic variation for fakerate, should be smaller 1 and bigger 0
-        diff = min(fr, 1-fr)
-        frUp = fr + variation_fakerate * diff
-        hist_var_fakerate = hist.Hist(*hist_fake.axes, storage=hist.storage.Double())
-        hist_var_fakerate.view(flow=True)[...] = hist_fake.values(flow=True)
-
-        cardTool.datagroups.groups[fakename].hists[f"{cardTool.nominalName}_r{fakename}_{fakerate_bin_name}"] = hist_var_fakerate
-
-        cardTool.addSystematic(f"r{fakename}_{fakerate_bin_name}",
-            processes=[fakename],
-            group=f"r{fakename}",
-            noConstraint=True,
-            outNames=[f"r{fakename}_{fakerate_bin_name}"],
-            mirror=True
-        )
-
-        # systematic variation for fake normalization in low MT
-        hist_var_lowMT = hist.Hist(*hist_fake.axes, storage=hist.storage.Double())
-        hist_var_lowMT.view(flow=True)[...] = hist_fake.values(flow=True)
-
-        cardTool.datagroups.groups[fakename].hists[f"{cardTool.nominalName}_N{fakename}LowMT_{fakerate_bin_name}"] = hist_var_lowMT
-
-        cardTool.addSystematic(f"N{fakename}LowMT_{fakerate_bin_name}",
+    all_bin_sizes = fakerate_bin_sizes + other_bin_sizes
+
+    # The variations are computed for all bins at once on the array of values (without flow) with axes [..., passIso, mt], 
+    #   a 'cell' is a bin in all axes except passIso, i.e. the array of cells has the shape of the histogram without the passIso axis
+    values = hist_fake.values(flow=False)
+    cell_axes = [n for n in hist_fake.axes.name if n != common.passIsoName]
+    cell_shape = [hist_fake.axes[n].size for n in cell_axes]
+    cell_coords = np.indices(cell_shape, sparse=True)
+    nMT = cell_shape[-1]
+
+    def coords_of(axes):
+        # coordinates of each cell along the given axes, broadcastable to the cell shape
+        return tuple(cell_coords[cell_axes.index(n)] if n in cell_axes else np.zeros([1]*len(cell_shape), dtype=int) for n in axes)
+
+    # mT bins in the low and high mT regions
+    mt_bins = np.arange(nMT)
+    lowMT = np.zeros(nMT, dtype=bool)
+    highMT = np.zeros(nMT, dtype=bool)
+    lowMT[mt_bins[failMT]] = True
+    highMT[mt_bins[passMT]] = True
+
+    # sum of failing and passing isolation in each cell, this is the normalization in low (high) mT for cells in low (high) mT
+    n_cell = values[..., 0, :] + values[..., 1, :]
+
+    # fakerate in each cell
+    fr = hFRF.values(flow=False)[coords_of(fakerate_axes)]
+    # systematic variation for fakerate, should be smaller 1 and bigger 0
+    frUp = fr + variation_fakerate * np.minimum(fr, 1-fr)
+
+    # index of the fakerate bin of each cell
+    idx_fakerate = np.ravel_multi_index(coords_of(fakerate_axes), fakerate_bin_sizes) if fakerate_axes else np.zeros([1]*len(cell_shape), dtype=int)
+    idx_fakerate = np.broadcast_to(idx_fakerate, cell_shape)
+
+    # high mT normalizations are defined for each bin of the fakerate and other axes, as long as it is in the high mT region
+    valid_highMT = np.ones(all_bin_sizes, dtype=bool)
+    if axis_name_mt in other_axes:
+        valid_highMT[(slice(None),)*len(fakerate_axes) + tuple(slice(None) if n != axis_name_mt else ~highMT for n in other_axes)] = False
+    map_highMT = np.where(valid_highMT, np.cumsum(valid_highMT).reshape(valid_highMT.shape)-1, -1)
+    idx_highMT = np.broadcast_to(map_highMT[coords_of(all_axes)], cell_shape)
+
+    def bin_name(axes, idx):
+        return "_".join([f"{ax}{i}" for ax, i in zip(axes, idx)])
+
+    fakerate_bin_names = [bin_name(fakerate_axes, idx) for idx in itertools.product(*[range(n) for n in fakerate_bin_sizes])]
+    highMT_bin_names = [bin_name(all_axes, idx) for idx, valid in zip(itertools.product(*[range(n) for n in all_bin_sizes]), valid_highMT.flatten()) if valid]
+
+    def make_variations(name, idx_cell, nfail, npass, nvars):
+        # one histogram with all variations along a trailing axis, 
+        #   the cells with idx_cell >= 0 are set to nfail (npass) for failing (passing) isolation in the variation idx_cell, all others are nominal
+        axis_var = hist.axis.Integer(0, nvars, underflow=False, overflow=False, name=name)
+        hvar = hist.Hist(*hist_fake.axes, axis_var, storage=hist.storage.Double())
+        hvar.view(flow=True)[...] = hist_fake.values(flow=True)[...,None]
+
+        sel = idx_cell >= 0
+        idx = np.nonzero(sel)
+        view = hvar.view(flow=False)
+        view[(*idx[:-1], 0, idx[-1], idx_cell[sel])] = nfail[sel]
+        view[(*idx[:-1], 1, idx[-1], idx_cell[sel])] = npass[sel]
+        return hvar
+
+    def add_variations(name, hvar, outNames, group):
+        cardTool.datagroups.groups[fakename].hists[f"{cardTool.nominalName}_{name}"] = hvar
+
+        cardTool.addSystematic(name,
             processes=[fakename],
-            group=f"{fakename}LowMT",
+            group=group,
             noConstraint=True,
-            outNames=[f"N{fakename}LowMT_{fakerate_bin_name}"],
+            systAxes=[hvar.axes[-1].name],
+            outNames=outNames,
             mirror=True
         )
 
-        # loop over all other axes 
-        jMax = np.product(other_bin_sizes) if other_axes else 1
-        for j in range(jMax):
-            other_ax_idx = get_ax_idx(other_bin_sizes, j)
-            other_indices = {ax: other_ax_idx[k] for k, ax in enumerate(other_axes)}
-
-            # Set bins in low MT
-            if axis_name_mt not in other_indices or other_indices[axis_name_mt] < failMT.stop:
-
-                n_lowMT = hist_fake[{**common.failIso, nameMT: failMT, **fakerate_indices, **other_indices}].value \
-                    + hist_fake[{**common.passIso, nameMT: failMT, **fakerate_indices, **other_indices}].value
-
-                # set lowMT variation histogram
-                hist_var_lowMT[{**common.failIso, nameMT: failMT, **fakerate_indices, **other_indices}] = (1+variation_normalization_fake) * n_lowMT * fr
-                hist_var_lowMT[{**common.passIso, nameMT: failMT, **fakerate_indices, **other_indices}] = (1+variation_normalization_fake) * n_lowMT * (1-fr)
-
-                # set fakerate variation histogram
-                hist_var_fakerate[{**common.failIso, nameMT: failMT, **fakerate_indices, **other_indices}] = n_lowMT * frUp
-                hist_var_fakerate[{**common.passIso, nameMT: failMT, **fakerate_indices, **other_indices}] = n_lowMT * (1-frUp)
-
-            # Set bins in high MT
-            if axis_name_mt not in other_indices or other_indices[axis_name_mt] >= passMT.start:
-
-                all_ax_idx = fakerate_ax_idx + other_ax_idx
-
-                highMT_bin_name = "_".join([f"{ax}{all_ax_idx[k]}" for k, ax in enumerate(all_axes)])
-                highMT_histname = f"{cardTool.nominalName}_N{fakename}HighMT_{highMT_bin_name}"
-
-                # systematic variation for fake normalization in high MT
-                logger.debug(f"Create new hist with name {highMT_histname}")
-                hist_var_highMT = hist.Hist(*hist_fake.axes, storage=hist.storage.Double())
-                hist_var_highMT.view(flow=True)[...] = hist_fake.values(flow=True)
-
-                cardTool.datagroups.groups[fakename].hists[highMT_histname] = hist_var_highMT
-
-                cardTool.addSystematic(f"N{fakename}HighMT_{highMT_bin_name}",
-                    processes=[fakename],
-                    group=f"{fakename}HighMT",
-                    noConstraint=True,
-                    outNames=[f"N{fakename}HighMT_{highMT_bin_name}"],
-                    mirror=True
-                )
+    logger.debug(f"Set variations for {len(fakerate_bin_names)} fakerate bins and {len(highMT_bin_names)} high mT bins")
 
-                n_highMT = hist_fake[{**common.failIso, nameMT: passMT, **fakerate_indices, **other_indices}].value \
-                    + hist_fake[{**common.passIso, nameMT: passMT, **fakerate_indices, **other_indices}].value
+    # systematic variation for fakerate, in low and high mT
+    hist_var_fakerate = make_variations("fakerateBin", np.where(lowMT | highMT, idx_fakerate, -1), n_cell * frUp, n_cell * (1-frUp), len(fakerate_bin_names))
+    add_variations(f"r{fakename}", hist_var_fakerate, [f"r{fakename}_{n}" for n in fakerate_bin_names], f"r{fakename}")
 
-                # set highMT variations histogram
-                hist_var_highMT[{**common.failIso, nameMT: passMT, **fakerate_indices, **other_indices}] = (1+variation_normalization_fake) * n_highMT * fr
-                hist_var_highMT[{**common.passIso, nameMT: passMT, **fakerate_indices, **other_indices}] = (1+variation_normalization_fake) * n_highMT * (1-fr)    
+    # systematic variation for fake normalization in low mT
+    hist_var_lowMT = make_variations("fakerateBin", np.where(lowMT, idx_fakerate, -1), 
+        (1+variation_normalization_fake) * n_cell * fr, (1+variation_normalization_fake) * n_cell * (1-fr), len(fakerate_bin_names))
+    add_variations(f"N{fakename}LowMT", hist_var_lowMT, [f"N{fakename}LowMT_{n}" for n in fakerate_bin_names], f"{fakename}LowMT")
 
-                # set fakerate variation histogram
-                hist_var_fakerate[{**common.failIso, nameMT: passMT, **fakerate_indices, **other_indices}] = n_highMT * frUp
-                hist_var_fakerate[{**common.passIso, nameMT: passMT, **fakerate_indices, **other_indices}] = n_highMT * (1-frUp)
+    # systematic variation for fake normalization in high mT, separately in each bin of the fakerate and other axes
+    hist_var_highMT = make_variations("highMTBin", np.where(highMT, idx_highMT, -1), 
+        (1+variation_normalization_fake) * n_cell * fr, (1+variation_normalization_fake) * n_cell * (1-fr), len(highMT_bin_names))
+    add_variations(f"N{fakename}HighMT", hist_var_highMT, [f"N{fakename}HighMT_{n}" for n in highMT_bin_names], f"{fakename}HighMT")
 
 
 def projectABCD(cardTool, h, return_variances=False, dtype="float64"):
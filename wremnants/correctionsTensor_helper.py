@@ -1,9 +1,9 @@
-import narf
 import ROOT
-
-narf.clingutils.Declare('#include "theory_corrections.h"')
+from wremnants import declare_headers
 
 def makeCorrectionsTensor(corrh, tensor=None, tensor_rank=1, weighted_corr=False):
+    import narf
+    declare_headers("theory_corrections.h")
     hist_dims = len(corrh.axes)-tensor_rank 
 
 
@@ -12,16 +12,142 @@ import hist
 import pandas as pd
 import math
 import numpy as np
+from collections import OrderedDict
 
+from utilities.h5pyutils import H5RawHist, bindRawHists
 from wremnants.datasets.datagroup import Datagroup
 from wremnants.datasets.dataset_tools import getDatasets
 
 logger = logging.child_logger(__name__)
 
+class HistCache(object):
+    # process level cache of the histograms decoded from hdf5 files, with least-recently-used eviction once maxBytes are exceeded
+    #   the histograms are keyed by (file, process, histogram name) and are shared between all Datagroups reading the same file,
+    #   each lookup returns a copy, such that operations modifying the histograms in place do not affect later reads
+    # the cache is disabled (maxBytes=0) unless enabled with set_max_bytes, e.g. by setupCombine.py
+    def __init__(self, maxBytes=0):
+        self.maxBytes = maxBytes
+        self.hists = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_max_bytes(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.evict()
+
+    def get(self, key, read):
+        if key in self.hists:
+            self.hits += 1
+            self.hists.move_to_end(key)
+            logger.debug(f"Histogram cache hit for {key}")
+            return self.hists[key][0].copy()
+
+        if self.maxBytes <= 0:
+            return read()
+
+        self.misses += 1
+        logger.debug(f"Histogram cache miss for {key}")
+        h = read()
+        nbytes = h.view(flow=True).nbytes
+        if nbytes <= self.maxBytes:
+            self.hists[key] = (h, nbytes)
+            self.nbytes += nbytes
+            self.evict()
+            return h.copy()
+        return h
+
+    def evict(self):
+        while self.nbytes > self.maxBytes and len(self.hists):
+            key, (h, nbytes) = self.hists.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            logger.debug(f"Evict histogram {key} from cache")
+
+    def clear(self):
+        self.hists.clear()
+        self.nbytes = 0
+
+    def print_info(self):
+        logger.info(f"Histogram cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {len(self.hists)} histograms with {self.nbytes/1024**3:.3f} GB cached (max {self.maxBytes/1024**3:.3f} GB)")
+
+histCache = HistCache()
+
+class GenBinSplitter(object):
+    # splits the histograms of the members of a signal group into all bins of the gen axes in one step,
+    #   shared by the groups of the single gen bins defined in Datagroups.defineSignalBinsUnfolding
+    # the histograms are identified by the member and histogram name, such that each histogram is read and split once for all gen bins,
+    #   the gen axes are moved to the front of a view of the histogram such that the gen bins are views as well,
+    #   the last maxEntries histograms (i.e. one per member of the base group) are kept
+    def __init__(self, gen_axes, maxEntries=1):
+        self.gen_axes = list(gen_axes)
+        self.maxEntries = maxEntries
+        self.splits = OrderedDict()
+
+    def __getstate__(self):
+        # the split histograms are not part of the state (e.g. for copies of the groups or hashing the member operations)
+        return {"gen_axes" : self.gen_axes, "maxEntries" : self.maxEntries}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.splits = OrderedDict()
+
+    def make_split(self, h):
+        gen_indices = [h.axes.name.index(a) for a in self.gen_axes]
+        gen_view = np.moveaxis(h.view(flow=True), gen_indices, range(len(gen_indices)))
+        axes = [ax for ax in h.axes if ax.name not in self.gen_axes]
+        # first index of the regular bins and number of bins for each gen axis
+        bins = [(int(h.axes[a].traits.underflow), h.axes[a].size) for a in self.gen_axes]
+        # the view keeps a reference to the histogram
+        return (axes, h.storage_type(), h.name, gen_view, bins)
+
+    def split(self, key, read):
+        # read() is only called if the histogram for this key is not split yet
+        if key in self.splits:
+            self.splits.move_to_end(key)
+            return self.splits[key]
+
+        split = self.make_split(read())
+        self.splits[key] = split
+        if len(self.splits) > self.maxEntries:
+            self.splits.popitem(last=False)
+        return split
+
+    def select(self, split, indices):
+        # same as h[{gen_axis : index}] for the gen axes, with index an integer or hist.underflow/hist.overflow
+        axes, storage, name, gen_view, bins = split
+        flow_indices = []
+        for idx, (start, size) in zip(indices, bins):
+            if idx == hist.underflow:
+                flow_indices.append(0)
+            elif idx == hist.overflow:
+                flow_indices.append(start+size)
+            else:
+                flow_indices.append(start+idx)
+        # the slice is copied, since the histograms of the groups are modified in place later on
+        hnew = hist.Hist(*axes, storage=storage, name=name)
+        hnew.view(flow=True)[...] = gen_view[tuple(flow_indices)]
+        return hnew
+
+class GenBinSelection(object):
+    # member operation selecting a single gen bin through a GenBinSplitter,
+    #   Datagroups.loadHistsForDatagroups reads the histograms through read() to share the split between the gen bins
+    def __init__(self, splitter, indices):
+        self.splitter = splitter
+        self.indices = indices
+
+    def __call__(self, h):
+        return self.splitter.select(self.splitter.make_split(h), self.indices)
+
+    def read(self, key, read):
+        return self.splitter.select(self.splitter.split(key, read), self.indices)
+
 class Datagroups(object):
 
     def __init__(self, infile, combine=False, filter_datasets=True, mode=None, **kwargs):
         self.combine = combine
+        self.infile = infile
         self.h5file = None
         self.rtfile = None
         if infile.endswith(".pkl.lz4"):
@@ -29,7 +155,9 @@ class Datagroups(object):
                 self.results = pickle.load(f)
         elif infile.endswith(".hdf5"):
             self.h5file = h5py.File(infile, "r")
-            self.results = narf.ioutils.pickle_load_h5py(self.h5file["results"])
+            # identify the file for the histogram cache, including the modification time in case it gets rewritten
+            self.cacheKey = (os.path.realpath(infile), os.path.getmtime(infile))
+            self.results = bindRawHists(narf.ioutils.pickle_load_h5py(self.h5file["results"]), self.h5file)
         elif infile.endswith(".root"):
             self.rtfile = ROOT.TFile.Open(infile)
             self.results = None
@@ -301,13 +429,20 @@ class Datagroups(object):
                 if member.name in forceToNominal:
                     read_syst = ""
                     logger.debug(f"Forcing group member {member.name} to read the nominal hist for syst {syst}")
+                memberOp = group.memberOp[i] if group.memberOp else None
+                def read(base, syst, member=member, memberOp=memberOp):
+                    if isinstance(memberOp, GenBinSelection):
+                        # the histogram is read and split once for the groups of all gen bins
+                        return memberOp.read((member.name, self.histName(base, member.name, syst)), lambda: self.readHist(base, member, procName, syst))
+                    return self.readHist(base, member, procName, syst)
+
                 try:
-                    h = self.readHist(baseName, member, procName, read_syst)
+                    h = read(baseName, read_syst)
                     foundExact = True
                 except ValueError as e:
                     if nominalIfMissing:
                         logger.info(f"{str(e)}. Using nominal hist {self.nominalName} instead")
-                        h = self.readHist(self.nominalName, member, procName, "")
+                        h = read(self.nominalName, "")
                     else:
                         logger.warning(str(e))
                         continue
@@ -316,12 +451,13 @@ class Datagroups(object):
 
                 logger.debug(f"Hist axes are {h.axes.name}")
 
-                if group.memberOp:
-                    if group.memberOp[i] is not None:
-                        logger.debug(f"Apply operation to member {i}: {member.name}/{procName}")
-                        h = group.memberOp[i](h)
-                    else:
-                        logger.debug(f"No operation for member {i}: {member.name}/{procName}")
+                if isinstance(memberOp, GenBinSelection):
+                    logger.debug(f"Selected gen bin {memberOp.indices} for member {i}: {member.name}/{procName}")
+                elif memberOp is not None:
+                    logger.debug(f"Apply operation to member {i}: {member.name}/{procName}")
+                    h = memberOp(h)
+                elif group.memberOp:
+                    logger.debug(f"No operation for member {i}: {member.name}/{procName}")
 
                 if preOpMap and member.name in preOpMap:
                     logger.debug(f"Applying preOp to {member.name}/{procName} after loading")
@@ -557,10 +693,16 @@ class Datagroups(object):
 
         gen_bin_indices = self.getGenBinIndices(nominal_hist, axesToRead=axesToRead)
 
+        # the groups of all gen bins share the members (without copying the base group) and the splitting of their histograms,
+        #   such that each histogram is read and split once and not once per gen bin
+        base_group = self.groups[group_name]
+        gen_axes = self.gen_axes[:len(gen_bin_indices)]
+        splitter = GenBinSplitter(gen_axes, maxEntries=len(base_members))
+
         for indices in itertools.product(*gen_bin_indices):
 
             proc_name = group_name if new_name is None else new_name
-            for idx, var in zip(indices, self.gen_axes):
+            for idx, var in zip(indices, gen_axes):
                 if idx == hist.underflow:
                     idx_str = "U"
                 elif idx == hist.overflow:
@@ -569,10 +711,10 @@ class Datagroups(object):
                     idx_str = str(idx)
                 proc_name += f"_{var}{idx_str}"
 
-            self.copyGroup(group_name, proc_name, member_filter=member_filter)
-
-            memberOp = lambda x, indices=indices, genvars=self.gen_axes: x[{var : i for var, i in zip(genvars, indices)}]
-            self.groups[proc_name].memberOp = [memberOp for m in base_members]
+            memberOp = GenBinSelection(splitter, indices)
+            self.groups[proc_name] = Datagroup(proc_name, members=base_members[:], scale=base_group.scale, 
+                selectOp=base_group.selectOp, selectOpArgs=base_group.selectOpArgs, rebinOp=base_group.rebinOp, 
+                memberOp=[memberOp for m in base_members], label=base_group.label, color=base_group.color)
 
             self.unconstrainedProcesses.append(proc_name)
 
@@ -651,8 +793,8 @@ class Datagroups(object):
             raise ValueError(f"Histogram {histname} not found for process {proc.name}")
 
         h = output[histname]
-        if isinstance(h, narf.ioutils.H5PickleProxy):
-            h = h.get()
+        if isinstance(h, (H5RawHist, narf.ioutils.H5PickleProxy)):
+            h = histCache.get((self.cacheKey, proc.name, histname), h.get)
 
         return h
 
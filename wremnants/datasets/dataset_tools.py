@@ -7,6 +7,11 @@ import glob
 import random
 import pathlib
 import socket
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import time
 #set the debug level for logging incase of full printout 
 from wremnants.datasets.datasetDict_v9 import dataDictV9
 from wremnants.datasets.datasetDict_gen import genDataDict
@@ -26,16 +31,70 @@ default_nfiles = {
     'ZtautauPostVFP' : 1200,
 }
 
-def buildFileListPosix(path):
+# number of concurrent directory listings (per sample) and of samples for which the files are listed concurrently
+list_threads = 16
+sample_threads = 8
+
+def joinPath(path, name):
+    return f"{path}/{name}"
+
+def listDirsConcurrent(path, listdir, nthreads = list_threads, join = joinPath):
+    # list a directory tree with the directory listings running concurrently in a thread pool,
+    #   listdir(path) returns the entries of a directory as a list of (name, is_dir, recurse)
+    #   returns a dict of {path : entries} for all listed directories
+    listings = {}
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        pending = {executor.submit(listdir, path) : path}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dirpath = pending.pop(future)
+                entries = future.result()
+                listings[dirpath] = entries
+                for name, is_dir, recurse in entries:
+                    if is_dir and recurse:
+                        childpath = join(dirpath, name)
+                        pending[executor.submit(listdir, childpath)] = childpath
+    return listings
+
+def collectFiles(listings, path, match, files_first = False, join = joinPath):
+    # files in the order of a sequential recursive listing, either in the order of the entries 
+    #   or with the files of each directory before its subdirectories (as os.walk), join(path, name) gives the paths of subdirectories
     outfiles = []
-    for root, dirs, fnames in os.walk(path):
-        for fname in fnames:
-            if fname.lower().endswith(".root"):
-                outfiles.append(f"{root}/{fname}")
-
+    entries = listings.get(path, None)
+    if entries is None:
+        return outfiles
+    if files_first:
+        entries = [e for e in entries if not e[1]] + [e for e in entries if e[1]]
+    for name, is_dir, recurse in entries:
+        if is_dir:
+            if recurse:
+                outfiles.extend(collectFiles(listings, join(path, name), match, files_first, join))
+        elif match(name):
+            outfiles.append(f"{path}/{name}")
     return outfiles
 
-def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False, num_clients = 16):
+def listDirPosix(path):
+    # symbolic links to directories are not followed (as os.walk)
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir, is_dir and not entry.is_symlink()))
+    except OSError:
+        pass
+    return entries
+
+def buildFileListPosix(path, nthreads = list_threads):
+    # same files in the same order as a sequential os.walk
+    listings = listDirsConcurrent(path, listDirPosix, nthreads, join=os.path.join)
+    return collectFiles(listings, path, lambda name: name.lower().endswith(".root"), files_first=True, join=os.path.join)
+
+def listDirXrd(xrdfs, path):
     status, dirlist = xrdfs.dirlist(path, flags = XRootD.client.flags.DirListFlags.STAT)
 
     if not status.ok:
@@ -44,34 +103,30 @@ def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False,
         else:
             raise RuntimeError(f"Error in XRootD.client.FileSystem.dirlist: {status.message}, {status.code}, {status.errno}")
 
-        return
+        return []
 
+    entries = []
     for diritem in dirlist:
         is_dir = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.IS_DIR
         is_other = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.OTHER
-        is_file = not (is_dir or is_other)
-
-        if is_dir and recurse:
-            childpath = f"{path}/{diritem.name}"
-            appendFilesXrd(filelist, xrdfs, childpath, suffixes=suffixes, recurse=recurse, num_clients=num_clients)
-        elif is_file:
-            lowername = diritem.name.lower()
-            matchsuffix = False
-            for suffix in suffixes:
-                if lowername.endswith(suffix):
-                    matchsuffix = True
-                    break
-
-            if matchsuffix:
-                if num_clients > 0:
-                    # construct client string if necessary to force multiple xrootd connections
-                    # (needed for good performance when a single or small number of xrootd servers is used)
-                    client = f"user_{random.randrange(num_clients)}"
-                    outname = f"{xrdfs.url.protocol}://{client}@{xrdfs.url.hostname}:{xrdfs.url.port}/{path}/{diritem.name}"
-                else:
-                    outname = f"{xrdfs.url.protocol}://{xrdfs.url.hostid}/{path}/{diritem.name}"
-
-                filelist.append(outname)
+        if is_dir or not is_other:
+            entries.append((diritem.name, bool(is_dir), True))
+    return entries
+
+def xrdFileName(xrdfs, path, num_clients = 16):
+    if num_clients > 0:
+        # construct client string if necessary to force multiple xrootd connections
+        # (needed for good performance when a single or small number of xrootd servers is used)
+        client = f"user_{random.randrange(num_clients)}"
+        return f"{xrdfs.url.protocol}://{client}@{xrdfs.url.hostname}:{xrdfs.url.port}/{path}"
+    return f"{xrdfs.url.protocol}://{xrdfs.url.hostid}/{path}"
+
+def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False, num_clients = 16, nthreads = list_threads):
+    # the directories are listed concurrently
+    listdir = lambda p: [e if recurse else (e[0], e[1], False) for e in listDirXrd(xrdfs, p)]
+    listings = listDirsConcurrent(path, listdir, nthreads)
+    match = lambda name: any(name.lower().endswith(suffix) for suffix in suffixes)
+    filelist.extend(xrdFileName(xrdfs, p, num_clients) for p in collectFiles(listings, path, match))
 
 def buildFileListXrd(path, num_clients = 16):
     xrdurl =  XRootD.client.URL(path)
@@ -87,12 +142,45 @@ def buildFileListXrd(path, num_clients = 16):
 
     return outfiles
 
-def buildFileList(path):
+def buildFileListUncached(path):
     xrdprefix = "root://"
     return buildFileListXrd(path) if path.startswith(xrdprefix) else buildFileListPosix(path)
 
+# default directory of the on disk cache of the file lists
+default_filelist_cache = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "wremnants", "filelists")
+
+def buildFileList(path, cache_dir = None, ttl = 0):
+    # the file lists are cached for ttl hours (no caching for ttl = 0), keyed by the path (which includes the production tag)
+    if not ttl or ttl <= 0:
+        return buildFileListUncached(path)
+    if cache_dir is None:
+        cache_dir = default_filelist_cache
+
+    cachefile = os.path.join(cache_dir, hashlib.sha256(path.encode()).hexdigest()[:32] + ".json")
+    try:
+        with open(cachefile) as f:
+            cached = json.load(f)
+        if cached["path"] == path and time.time() - cached["time"] < ttl*3600:
+            logger.debug(f"Use cached file list for {path}")
+            return cached["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    files = buildFileListUncached(path)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpfile = f"{cachefile}.{os.getpid()}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump({"path" : path, "time" : time.time(), "files" : files}, f)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        logger.warning(f"Could not write the file list cache {cachefile}: {e}")
+
+    return files
+
 #TODO add the rest of the samples!
-def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None):
+def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None, cache_dir=None, cache_ttl=0):
     filelist = []
     for orig_path in paths:
         if maxFiles > 0 and len(filelist) >= maxFiles:
@@ -105,7 +193,7 @@ def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_dat
             path = orig_path.format(**format_args)
             logger.debug(f"Reading files from path {path}")
 
-            files = buildFileList(path)
+            files = buildFileList(path, cache_dir, cache_ttl)
 
             if len(files) == 0:
                 fallback = True
@@ -205,7 +293,8 @@ def is_zombie(file_path):
 
 def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_path=None, nanoVersion="v9",
                 data_tags=["TrackFitV722_NanoProdv3", "TrackFitV722_NanoProdv2"],
-                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP"):
+                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP",
+                filelist_cache=None, filelist_cache_ttl=0):
 
     if maxFiles is None or (isinstance(maxFiles, int) and maxFiles < -1):
         maxFiles=default_nfiles
@@ -227,19 +316,27 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
     elif mode and "lowpu" in mode:
         dataDict = dataDictLowPU
 
+    # the file lists of all samples are built concurrently
+    filelists = {}
+    with ThreadPoolExecutor(max_workers=sample_threads) as executor:
+        for sample,info in dataDict.items():
+            if sample in genDataDict:
+                base_path = base_path.replace("NanoAOD", "NanoGen")
+
+            is_data = info.get("group","") == "Data"
+
+            prod_tags = data_tags if is_data else mc_tags
+            nfiles = maxFiles
+            if type(maxFiles) == dict:
+                nfiles = maxFiles[sample] if sample in maxFiles else -1
+            filelists[sample] = executor.submit(makeFilelist, info["filepaths"], nfiles, base_path=base_path, nano_prod_tags=prod_tags, is_data=is_data, 
+                oneMCfileEveryN=oneMCfileEveryN, cache_dir=filelist_cache, cache_ttl=filelist_cache_ttl)
+
     narf_datasets = []
     for sample,info in dataDict.items():
-        if sample in genDataDict:
-            base_path = base_path.replace("NanoAOD", "NanoGen")
-
         is_data = info.get("group","") == "Data"
+        paths = filelists[sample].result()
 
-        prod_tags = data_tags if is_data else mc_tags
-        nfiles = maxFiles
-        if type(maxFiles) == dict:
-            nfiles = maxFiles[sample] if sample in maxFiles else -1
-        paths = makeFilelist(info["filepaths"], nfiles, base_path=base_path, nano_prod_tags=prod_tags, is_data=is_data, oneMCfileEveryN=oneMCfileEveryN)
-            
         if checkFileForZombie:
             paths = [p for p in paths if not is_zombie(p)]
 
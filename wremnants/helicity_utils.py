@@ -15,11 +15,10 @@ import numpy as np
 import h5py
 import hdf5plugin
 import narf
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "syst_helicity_utils.h"')
-
 data_dir = f"{pathlib.Path(__file__).parent}/data/"
 
 #UL, A0...A4
@@ -27,6 +26,7 @@ axis_helicity_multidim = hist.axis.Integer(-1, 8, name="helicitySig", overflow=F
 
 #creates the helicity weight tensor
 def makehelicityWeightHelper(is_w_like = False, filename=None):
+    declare_headers("syst_helicity_utils.h")
     if filename is None:
         filename = f"{common.data_dir}/angularCoefficients/w_z_moments_theoryAgnosticBinning.hdf5"
     with h5py.File(filename, "r") as ff:
@@ -55,6 +55,7 @@ def makehelicityWeightHelper(is_w_like = False, filename=None):
 
 #Muon eff vars
 def make_muon_eff_stat_helpers_helicity(helper_stat, nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     axes = helper_stat.tensor_axes
     nEta = axes[0].size
     nPt = axes[1].size
@@ -67,6 +68,7 @@ def make_muon_eff_stat_helpers_helicity(helper_stat, nhelicity=6):
 #1D tensor
 # axis_all = hist.axis.Integer(0, 5, underflow = False, overflow = False, name = "reco-tracking-idip-trigger-iso")
 def make_muon_eff_syst_helper_helicity(helper_syst, nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     nsize=helper_syst.tensor_axes[0].size
     nvars=helper_syst.tensor_axes[1].size
     helper_syst_helicity=ROOT.wrem.tensorRank2_helper_helicity[nsize, nvars, nhelicity]()
@@ -75,6 +77,7 @@ def make_muon_eff_syst_helper_helicity(helper_syst, nhelicity=6):
 
 #mass weights
 def make_massweight_helper_helicity(mass_axis, nhelicity=9):
+    declare_headers("syst_helicity_utils.h")
     tensor_axes=[axis_helicity_multidim, mass_axis]
     helper = ROOT.wrem.tensor1D_helper_helicity[mass_axis.size, nhelicity]()
     return helper, tensor_axes
@@ -82,12 +85,14 @@ def make_massweight_helper_helicity(mass_axis, nhelicity=9):
 #muon prefire
 #this is helcity X <up/down> 
 def make_muon_prefiring_helper_syst_byHelicity(nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     helper_syst = ROOT.wrem.tensor1D_helper_helicity[2, nhelicity]()
     axis_tensor = [axis_helicity_multidim, common.down_up_axis]
     return helper_syst, axis_tensor
 
 #this is helicity X <Neta,2> type
 def make_muon_prefiring_helper_stat_byHelicity(helper_stat, nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     nEta = helper_stat.tensor_axes[0].size
     helper_stat_helicity = ROOT.wrem.tensorupdownvar_helper_helicity[nEta, nhelicity]()
     tensor_axes = [axis_helicity_multidim, *helper_stat.tensor_axes]
@@ -96,18 +101,21 @@ def make_muon_prefiring_helper_stat_byHelicity(helper_stat, nhelicity=6):
 
 #for muonscale_hist
 def make_dummymuonscale_helper_helicity(nweights, netabins, haxes,nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     helper = ROOT.wrem.tensorRank2_helper_helicity[nweights, netabins, nhelicity]()
     tensor_axes = [axis_helicity_multidim, *haxes]
     return helper, tensor_axes
 
 ##for pdf
 def make_pdfweight_helper_helicity(npdf, pdf_axes, nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     helper=ROOT.wrem.tensor1D_helper_helicity[npdf, nhelicity]()
     tensor_axes=[axis_helicity_multidim,pdf_axes]
     return helper, tensor_axes
 
 #for qcd scale
 def make_qcdscale_helper_helicity(qcd_axes,nhelicity=6):
+    declare_headers("syst_helicity_utils.h")
     helper = ROOT.wrem.tensorRank2_helper_helicity[3, 3, nhelicity]()
     tensor_axes = [axis_helicity_multidim, *qcd_axes]
     return helper, tensor_axes
@@ -1,11 +1,45 @@
+import ROOT
+import narf
 from narf.ioutils import H5PickleProxy
+import copy
+import hist
+import multiprocessing
 import time
+from concurrent.futures import ThreadPoolExecutor
 from utilities import logging
+from utilities import boostHistHelpers as hh
 
 logger = logging.child_logger(__name__)
 
-def scale_to_data(result_dict, data_name = "dataPostVFP"):
-    # scale histograms by lumi*xsec/sum(gen weights)
+# histograms are processed in chunks along the first axis, such that large histograms are shared between the threads
+chunk_bytes = 64*1024**2
+
+def array_chunks(h):
+    # slices along the first axis (including flow bins) of about chunk_bytes each
+    view = h.view(flow=True)
+    if view.ndim == 0:
+        return [Ellipsis]
+    nper = max(1, int(chunk_bytes*view.shape[0] // max(view.nbytes, 1)))
+    return [slice(i, i+nper) for i in range(0, view.shape[0], nper)]
+
+def run_parallel(tasks, nthreads=None):
+    # numpy releases the GIL for the array operations, such that the tasks run in parallel in threads
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        for future in [executor.submit(task) for task in tasks]:
+            future.result()
+
+def scale_chunk(h, sl, scale):
+    vals, varis = hh.outputArrays(h)
+    hh.scaleArrays(vals[sl], None if varis is None else varis[sl], scale, out=vals[sl], out_vars=None if varis is None else varis[sl])
+
+def add_chunk(hout, h, sl):
+    vals, varis = hh.outputArrays(hout)
+    vals2, varis2 = hh.outputArrays(h)
+    hh.addArrays(vals[sl], vals2[sl], None if varis is None else varis[sl], None if varis2 is None else varis2[sl], 
+        out=vals[sl], out_vars=None if varis is None else varis[sl])
+
+def scale_to_data(result_dict, data_name = "dataPostVFP", nthreads=None):
+    # scale histograms by lumi*xsec/sum(gen weights), in place
     time0 = time.time()
 
     lumi = [result["lumi"] for result in result_dict.values() if result["dataset"]["is_data"]]
@@ -15,6 +49,8 @@ def scale_to_data(result_dict, data_name = "dataPostVFP"):
         lumi = sum(lumi)
 
     logger.warning(f"Scale histograms with luminosity = {lumi} /fb")
+    tasks = []
+    nbytes = 0
     for d_name, result in result_dict.items():
         if result["dataset"]["is_data"]:
             continue
@@ -30,17 +66,22 @@ def scale_to_data(result_dict, data_name = "dataPostVFP"):
         for h_name, histogram in result["output"].items():
 
             histo = histogram.get()
+            nbytes += histo.view(flow=True).nbytes
+
+            tasks.extend([lambda h=histo, sl=sl, scale=scale: scale_chunk(h, sl, scale) for sl in array_chunks(histo)])
 
-            histo *= scale
+    time1 = time.time()
+    run_parallel(tasks, nthreads)
 
-    logger.info(f"Scale to data: {time.time() - time0}")
+    logger.info(f"Scale to data: {time.time() - time0} (scaling {nbytes/1024**3:.3f} GB in {len(tasks)} chunks: {time.time() - time1})")
 
 
-def aggregate_groups(datasets, result_dict, groups_to_aggregate):
-    # add members of groups together
+def aggregate_groups(datasets, result_dict, groups_to_aggregate, nthreads=None):
+    # add members of groups together, the histograms of the first member are used for the sums (in place)
     time0 = time.time()
 
     for group in groups_to_aggregate:
+        time_group = time.time()
 
         dataset_names = [d.name for d in datasets if d.group == group]
         if len(dataset_names) == 0:
@@ -84,13 +125,34 @@ def aggregate_groups(datasets, result_dict, groups_to_aggregate):
             to_del.append(name)
 
         output = {}
+        tasks = []
         for h_name, histograms in members.items():
 
             if len(histograms) != resdict["n_members"]:
                 logger.warning(f"There is a different number of histograms ({len(histograms)}) than original members {resdict['n_members']} for {h_name} from group {group}")
                 logger.warning("Summing them up probably leads to wrong behaviour")
 
-            output[h_name] = H5PickleProxy(sum(histograms))
+            # members with different axes or storage (if any) are added with broadcasting into a new histogram first,
+            #   such that the axes of the sum are final before the other members are added in place
+            hsum = histograms[0]
+            matching = []
+            for h in histograms[1:]:
+                if h.axes != hsum.axes or h.storage_type != hsum.storage_type:
+                    hsum = hh.addHists(hsum, h)
+                else:
+                    matching.append(h)
+            others = []
+            for h in matching:
+                if h.axes != hsum.axes or h.storage_type != hsum.storage_type:
+                    # matched the sum before it was broadcast, the axes of the sum do not change anymore
+                    hsum = hh.addHists(hsum, h)
+                else:
+                    others.append(h)
+            tasks.extend([lambda hsum=hsum, others=others, sl=sl: [add_chunk(hsum, h, sl) for h in others] for sl in array_chunks(hsum)])
+
+            output[h_name] = H5PickleProxy(hsum)
+
+        run_parallel(tasks, nthreads)
 
         result_dict[group] = resdict
         result_dict[group]["output"] = output
@@ -99,4 +161,99 @@ def aggregate_groups(datasets, result_dict, groups_to_aggregate):
         for name in to_del:
             del result_dict[name]
 
+        logger.debug(f"Aggregate group {group}: {time.time() - time_group}")
+
     logger.info(f"Aggregate groups: {time.time() - time0}")
+
+def hist_memory(datasets, build_graph):
+    # memory of the histograms booked by build_graph for each dataset, from a run over a single event of the first file of each dataset
+    #   the graph is built and run in a forked process, such that the histmaker state (e.g. lists filled in build_graph) is not modified
+    #   returns a list of (dataset name, histogram name, number of bytes)
+    ctx = multiprocessing.get_context("fork")
+    conn_recv, conn_send = ctx.Pipe(duplex=False)
+
+    def run():
+        dry_datasets = []
+        for dataset in datasets:
+            ds = copy.copy(dataset)
+            ds.filepaths = dataset.filepaths[:1]
+            dry_datasets.append(ds)
+        # the filter on the entry number does not read any branch, the event loop over the rest of the file is cheap
+        resultdict = narf.build_and_run(dry_datasets, lambda df, dataset: build_graph(df.Filter("rdfentry_ == 0"), dataset))
+        entries = []
+        for d_name, result in resultdict.items():
+            for h_name, h in result["output"].items():
+                h = h.get() if isinstance(h, H5PickleProxy) else h
+                if isinstance(h, hist.Hist):
+                    entries.append((d_name, h_name, h.view(flow=True).nbytes))
+        conn_send.send(entries)
+
+    proc = ctx.Process(target=run)
+    proc.start()
+    conn_send.close()
+    try:
+        entries = conn_recv.recv()
+    except EOFError:
+        entries = None
+    proc.join()
+    if entries is None or proc.exitcode != 0:
+        raise RuntimeError(f"Failed to determine the memory of the histograms (exit code {proc.exitcode})")
+    return entries
+
+def memory_estimate(total, largest, nthreads, njobs=None):
+    # memory of the histograms in bytes, each thread fills its own copy of the histograms and one more copy is needed for the merged output
+    #   in a sharded run with njobs worker processes (see shard_tools), each worker holds the copies for a shard of one dataset
+    #   (at most the largest one) with nthreads/njobs threads, and the main process the merged output of all datasets
+    if njobs is None:
+        return total*(nthreads+1)
+    return njobs*largest*(max(nthreads // njobs, 1)+1) + total
+
+def print_memory_table(entries, nthreads, njobs=None, nrows=30):
+    # ranked table of the histograms summed over datasets, returns the total size and the size of the largest dataset
+    per_hist = {}
+    per_dataset = {}
+    for d_name, h_name, nbytes in entries:
+        per_hist[h_name] = per_hist.get(h_name, 0) + nbytes
+        per_dataset[d_name] = per_dataset.get(d_name, 0) + nbytes
+    total = sum(per_hist.values())
+    largest = max(per_dataset.values(), default=0)
+
+    logger.info(f"Memory of the histograms per thread, {len(per_hist)} histograms for {len(per_dataset)} datasets")
+    logger.info(f"{'histogram'.ljust(60)} {'MB/thread'.rjust(12)} {'fraction'.rjust(9)}")
+    for h_name, nbytes in sorted(per_hist.items(), key=lambda x: -x[1])[:nrows]:
+        logger.info(f"{h_name.ljust(60)} {nbytes/1024**2:12.1f} {nbytes/total if total else 0:9.3f}")
+    if len(per_hist) > nrows:
+        logger.info(f"... {len(per_hist)-nrows} more histograms with {sum(sorted(per_hist.values())[:-nrows])/1024**2:.1f} MB/thread")
+    for d_name, nbytes in sorted(per_dataset.items(), key=lambda x: -x[1])[:10]:
+        logger.info(f"Dataset {d_name.ljust(52)} {nbytes/1024**2:12.1f}")
+    jobs = f" in {njobs} processes" if njobs is not None else ""
+    logger.info(f"Total: {total/1024**3:.3f} GB per thread, {memory_estimate(total, largest, nthreads, njobs)/1024**3:.3f} GB with {nthreads} threads{jobs}")
+
+    return total, largest
+
+def max_threads_for_budget(total, largest, nthreads, budget, njobs=None):
+    # largest number of threads (up to nthreads) for which the histograms fit into the memory budget (in bytes)
+    for n in range(nthreads, 0, -1):
+        if memory_estimate(total, largest, n, njobs) <= budget:
+            return n
+    jobs = f" per process in {njobs} processes" if njobs is not None else ""
+    hint = ", reduce the number of processes (--shardJobs)" if njobs is not None and njobs > 1 else ""
+    raise RuntimeError(f"The histograms need {memory_estimate(total, largest, 1, njobs)/1024**3:.3f} GB with a single thread{jobs}, more than the memory budget of {budget/1024**3:.3f} GB{hint}")
+
+def check_memory(datasets, build_graph, nthreads=None, budget=None, njobs=None):
+    # print the memory table and reduce the number of threads of ROOT if needed to stay within the budget (in GB)
+    #   njobs is the number of worker processes for a sharded run (None otherwise)
+    #   returns the number of threads to use
+    if not nthreads:
+        nthreads = max(ROOT.ROOT.GetThreadPoolSize(), 1)
+    total, largest = print_memory_table(hist_memory(datasets, build_graph), nthreads, njobs)
+    if budget is None:
+        return nthreads
+
+    nthreads_budget = max_threads_for_budget(total, largest, nthreads, budget*1024**3, njobs)
+    if nthreads_budget < nthreads:
+        logger.warning(f"Reduce the number of threads from {nthreads} to {nthreads_budget} to stay within the memory budget of {budget} GB")
+        ROOT.ROOT.DisableImplicitMT()
+        if nthreads_budget > 1:
+            ROOT.ROOT.EnableImplicitMT(nthreads_budget)
+    return nthreads_budget
@@ -5,6 +5,7 @@ from utilities import boostHistHelpers as hh
 from utilities import common, logging
 import narf
 import ROOT
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
@@ -129,6 +130,7 @@ def applyCorrection(h, scale=1.0, offsetCorr=0.0, corrFile=None, corrHist=None,
         corr = safeGetRootObject(f, corrHist, detach=True)
         if offsetCorr:
             offsetHist = corr.Clone("offsetHist")
+            declare_headers()
             ROOT.wrem.initializeRootHistogram(offsetHist, offsetCorr)
             corr.Add(offsetHist)
         f.Close()
@@ -24,7 +24,21 @@ namespace wrem {
         outWeights(0) = nominal_weight * scaleDown;
         outWeights(1) = nominal_weight * scaleUp;
         return outWeights;
-        
+
+    }
+
+    // concatenate the flattened (column major) weight tensors into a single one dimensional tensor,
+    // such that several systematic tensors with the same axes can be filled at once
+    template <typename... Ts>
+    auto concatFlatTensors(const Ts&... tensors) {
+
+        constexpr std::ptrdiff_t size = (... + Ts::Dimensions::total_size);
+        Eigen::TensorFixedSize<double, Eigen::Sizes<size>> outWeights;
+
+        double *out = outWeights.data();
+        ((out = std::copy(tensors.data(), tensors.data() + Ts::Dimensions::total_size, out)), ...);
+        return outWeights;
+
     }
 
 }
@@ -0,0 +1,196 @@
+#ifndef WREMNANTS_SPARSE_HIST_H
+#define WREMNANTS_SPARSE_HIST_H
+
+#include <ROOT/RVec.hxx>
+#include <ROOT/RDataFrame.hxx>
+#include <ROOT/RDF/RActionImpl.hxx>
+#include <algorithm>
+#include <cmath>
+#include <memory>
+#include <string>
+#include <type_traits>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+class TTreeReader;
+
+namespace wrem {
+
+    // histogram storing only the filled bins (sum of weights and sum of squared weights),
+    //   indexed by the position in the dense storage including the flow bins (row major, as the numpy view of hist)
+
+    class SparseAxis {
+    public:
+        enum Kind { Regular = 0, Variable = 1, Integer = 2 };
+
+        SparseAxis(int kind, std::size_t nbins, double low, double high, const std::vector<double> &edges, bool underflow, bool overflow) :
+            kind_(kind), nbins_(nbins), low_(low), high_(high), edges_(edges), underflow_(underflow), overflow_(overflow) {}
+
+        std::size_t extent() const { return nbins_ + underflow_ + overflow_; }
+
+        // index in the storage including the flow bins, -1 if the value falls into a flow bin which the axis does not have,
+        //   the bins are found in the same way as by boost::histogram (the upper edge belongs to the last bin without overflow)
+        long long index(double x) const {
+            long long idx;
+            if (kind_ == Regular) {
+                const double z = (x - low_)/(high_ - low_);
+                if (z < 1) {
+                    idx = z >= 0 ? static_cast<long long>(z*nbins_) : -1;
+                }
+                else {
+                    idx = (z == 1 && !overflow_) ? nbins_ - 1 : nbins_;
+                }
+            }
+            else if (kind_ == Variable) {
+                if (x == edges_.back()) {
+                    idx = overflow_ ? nbins_ : nbins_ - 1;
+                }
+                else {
+                    idx = std::upper_bound(edges_.begin(), edges_.end(), x) - edges_.begin() - 1;
+                }
+            }
+            else {
+                const double z = std::floor(x) - low_;
+                idx = z >= 0 ? (z < nbins_ ? static_cast<long long>(z) : nbins_) : -1;
+            }
+
+            if (idx < 0) {
+                return underflow_ ? 0 : -1;
+            }
+            if (idx >= static_cast<long long>(nbins_)) {
+                return overflow_ ? nbins_ + underflow_ : -1;
+            }
+            return idx + underflow_;
+        }
+
+    private:
+        int kind_;
+        std::size_t nbins_;
+        double low_;
+        double high_;
+        std::vector<double> edges_;
+        bool underflow_;
+        bool overflow_;
+    };
+
+    using SparseBins = std::unordered_map<std::size_t, std::pair<double, double>>;
+
+    class SparseHist {
+    public:
+        SparseBins bins;
+
+        std::size_t size() const { return bins.size(); }
+
+        void add(const SparseBins &other) {
+            for (auto const &[idx, w] : other) {
+                auto &bin = bins[idx];
+                bin.first += w.first;
+                bin.second += w.second;
+            }
+        }
+
+        // write the filled bins into the flat arrays of the dense storage (with the flow bins)
+        void fill_dense(double *values, double *variances) const {
+            for (auto const &[idx, w] : bins) {
+                values[idx] = w.first;
+                variances[idx] = w.second;
+            }
+        }
+    };
+
+    template <typename T>
+    struct is_rvec : std::false_type {};
+
+    template <typename T>
+    struct is_rvec<ROOT::VecOps::RVec<T>> : std::true_type {};
+
+    template <typename T>
+    std::size_t fill_size(const T &x) {
+        if constexpr (is_rvec<T>::value) {
+            return x.size();
+        }
+        else {
+            return 1;
+        }
+    }
+
+    template <typename T>
+    double fill_value(const T &x, std::size_t i) {
+        if constexpr (is_rvec<T>::value) {
+            return x[i];
+        }
+        else {
+            return x;
+        }
+    }
+
+    // RDataFrame action filling a SparseHist, with one map of the filled bins per slot which are merged at the end of the event loop,
+    //   the last column is the weight, vector columns are filled element by element (with the scalar columns broadcasted)
+    class SparseHistHelper : public ROOT::Detail::RDF::RActionImpl<SparseHistHelper> {
+    public:
+        using Result_t = SparseHist;
+
+        SparseHistHelper(const std::vector<SparseAxis> &axes, unsigned int nslots) :
+            axes_(axes), slots_(nslots), result_(std::make_shared<SparseHist>()) {}
+        SparseHistHelper(SparseHistHelper &&) = default;
+        SparseHistHelper(const SparseHistHelper &) = delete;
+
+        std::shared_ptr<Result_t> GetResultPtr() const { return result_; }
+
+        void Initialize() {}
+        void InitTask(TTreeReader *, unsigned int) {}
+
+        template <typename... Ts>
+        void Exec(unsigned int slot, const Ts &... vals) {
+            constexpr std::size_t ncols = sizeof...(Ts);
+            static_assert(ncols >= 2, "At least one axis column and the weight column are needed");
+
+            std::size_t n = 1;
+            if constexpr ((is_rvec<Ts>::value || ...)) {
+                n = std::max({(is_rvec<Ts>::value ? fill_size(vals) : 0)...});
+            }
+
+            for (std::size_t i = 0; i < n; ++i) {
+                const double x[ncols] = {fill_value(vals, i)...};
+                fill(slots_[slot], x, x[ncols-1]);
+            }
+        }
+
+        void Finalize() {
+            for (auto &slot : slots_) {
+                result_->add(slot);
+                SparseBins().swap(slot);
+            }
+        }
+
+        std::string GetActionName() const { return "SparseHist"; }
+
+    private:
+        void fill(SparseBins &bins, const double *x, double weight) const {
+            std::size_t idx = 0;
+            for (std::size_t iaxis = 0; iaxis < axes_.size(); ++iaxis) {
+                const long long iaxis_idx = axes_[iaxis].index(x[iaxis]);
+                if (iaxis_idx < 0) {
+                    return;
+                }
+                idx = idx*axes_[iaxis].extent() + iaxis_idx;
+            }
+            auto &bin = bins[idx];
+            bin.first += weight;
+            bin.second += weight*weight;
+        }
+
+        std::vector<SparseAxis> axes_;
+        std::vector<SparseBins> slots_;
+        std::shared_ptr<SparseHist> result_;
+    };
+
+    template <typename... ColTypes>
+    ROOT::RDF::RResultPtr<SparseHist> BookSparseHist(ROOT::RDF::RNode df, const std::vector<SparseAxis> &axes, const std::vector<std::string> &cols) {
+        return df.Book<ColTypes...>(SparseHistHelper(axes, df.GetNSlots()), cols);
+    }
+
+}
+
+#endif
@@ -5,6 +5,7 @@ import narf
 from utilities import rdf_tools
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
+from wremnants.syst_registry import book_hist
 import uproot
 import numpy as np
 import warnings
@@ -13,12 +14,10 @@ import narf.tfliteutils
 import time
 import lz4.frame
 import pickle
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "muon_calibration.h"')
-narf.clingutils.Declare('#include "lowpu_utils.h"')
-
 data_dir = common.data_dir
 
 def make_muon_calibration_helpers(args,
@@ -26,6 +25,7 @@ def make_muon_calibration_helpers(args,
         data_filename=data_dir+"/calibration/correctionResults_v721_recjpsidata.root", 
         era = None):
 
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     if args.muonCorrMC in ["trackfit_only", "lbl", "lbl_massfit"]:
         raise NotImplementedError(f"Muon calibrations for non-ideal geometry are currently not available! (needed for --muonCorrMC {args.muonCorrMC})")
 
@@ -90,6 +90,7 @@ def make_Z_non_closure_helpers(args, calib_filepaths, closure_filepaths):
 
 def make_muon_bias_helpers(args):
     # apply a bias to MC to correct for the nonclosure with data in the muon momentum scale calibration
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     if args.biasCalibration is None: 
         return None
 
@@ -174,6 +175,7 @@ def make_muon_smearing_helpers(filename = f"{data_dir}/calibration/smearingrel_s
                                filenamevar = f"{data_dir}/calibration/smearing_variations_smooth.pkl.lz4"):
     # this helper smears muon pT to match the resolution in data
 
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     with lz4.frame.open(filename, "rb") as fin:
         smearingrel_smooth = pickle.load(fin)
 
@@ -219,6 +221,7 @@ def add_resolution_uncertainty(df, axes, results, nominal_cols, smearing_uncerta
 
 def make_muon_calibration_helper_single(filename=data_dir+"/calibration/correctionResults_v718_idealgeom_gensim.root"):
 
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     helper = ROOT.wrem.CVHCorrectorSingle[""](filename)
     return helper
 
@@ -239,6 +242,7 @@ def get_dummy_uncertainties():
     return h
 
 def make_jpsi_crctn_helper(filepath):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     f = uproot.open(filepath)
 
     # TODO: convert variable axis to regular if the bin width is uniform
@@ -263,6 +267,7 @@ def make_jpsi_crctn_unc_helper(
     n_scale_params = 3, n_tot_params = 4, n_eta_bins = 48, scale = 1.0, isW = True,
     scale_var_method = 'smearingWeightsSplines', dummy_mu_scale_var = False, dummy_var_mag = 1e-4
 ):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     f = uproot.open(filepath_correction)
     cov = f['covariance_matrix'].to_hist()
     cov_scale_params = get_jpsi_scale_param_cov_mat(cov, n_scale_params, n_tot_params, n_eta_bins, scale)
@@ -309,6 +314,7 @@ def make_Z_non_closure_parametrized_helper(
     n_eta_bins = 24, n_scale_params = 3, correlated = False, scale_var_method = 'smearingWeightsSplines',
     dummy_A = True, dummy_M = False, dummy_A_mag = 7.5e-5, dummy_M_mag = 0
 ):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     f = uproot.open(filepath_correction)
     M = f['MZ'].to_hist()
     A = f['AZ'].to_hist()
@@ -370,6 +376,7 @@ def make_Z_non_closure_binned_helper(
     filepath_correction, filepath_tflite,
     n_eta_bins = 24, n_pt_bins = 5, correlated = False, scale_var_method = 'smearingWeightsSplines'
 ):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     f = uproot.open(filepath)
 
     # TODO: convert variable axis to regular if the bin width is uniform
@@ -442,6 +449,7 @@ def crop_cov_mat(filepath, n_tot_params = 4, n_cropped_eta_bins = 2):
 def define_lblcorr_muons(df, cvh_helper, corr_branch="cvh"):
 
     # split the nested vectors
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.Define("Muon_cvhmergedGlobalIdxs", "wrem::splitNestedRVec(Muon_cvhmergedGlobalIdxs_Vals, Muon_cvhmergedGlobalIdxs_Counts)")
     df = df.Define(f"Muon_{corr_branch}JacRef", f"wrem::splitNestedRVec(Muon_{corr_branch}JacRef_Vals, Muon_{corr_branch}JacRef_Counts)")
 
@@ -507,6 +515,7 @@ def getColName_genFiltered_recoMuonSel(reco_sel = "goodMuons", require_prompt =
     return f"{reco_sel}_genTruth_{genMatch_condition}"
 
 def define_genFiltered_recoMuonSel(df, reco_sel = "goodMuons", require_prompt = True):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     col_name = getColName_genFiltered_recoMuonSel(reco_sel, require_prompt)
     require_prompt = "true" if require_prompt else "false"
     df = df.Define(
@@ -525,6 +534,7 @@ def define_genFiltered_recoMuonSel(df, reco_sel = "goodMuons", require_prompt =
     return df
 
 def define_covMatFiltered_recoMuonSel(df, reco_sel = "goodMuons"):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.Redefine(
         f"{reco_sel}",
         (
@@ -541,6 +551,7 @@ def muon_var_name(mu_type, var):
         return mu_type+(f"_{var}" if mu_type == "Muon" else var.capitalize())
 
 def define_matched_gen_muons_covMat(df, reco_sel = "goodMuons"):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.Define(
         f"{reco_sel}_covMat",
         (
@@ -576,6 +587,7 @@ def define_matched_gen_muons_kinematics(
     return df
 
 def calculate_matched_gen_muon_kinematics(df, reco_sel = "goodMuons"):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.Define(
         f"{reco_sel}_genTheta",
         (f"ROOT::VecOps::RVec<double> res({reco_sel}_genEta.size());"
@@ -606,6 +618,7 @@ def calculate_matched_gen_muon_kinematics(df, reco_sel = "goodMuons"):
     return df
 
 def define_matched_genSmeared_muon_kinematics(df, reco_sel = "goodMuons"):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.Define(f"{reco_sel}_genSmearedQop", 
         (f"ROOT::VecOps::RVec<double> res({reco_sel}_genQop.size());"
          "for (int i = 0; i < res.size(); i++) {"
@@ -683,12 +696,12 @@ def add_jpsi_crctn_stats_unc_hists(
             ]
         )
         if args.validationHists:
-            muonScaleSyst_responseWeights_gaus = df.HistoBoost(
+            book_hist(
+                results, df,
                 "muonScaleSyst_responseWeights_gaus", axes,
                 [*nominal_cols_gen_smeared, "muonScaleSyst_responseWeights_tensor_gaus"],
                 tensor_axes = jpsi_unc_helper.tensor_axes, storage=hist.storage.Double()
             )
-            results.append(muonScaleSyst_responseWeights_gaus)
 
     if args.muonScaleVariation == 'smearingWeightsSplines' or args.validationHists:
         if args.muonScaleVariation == 'smearingWeightsSplines':
@@ -713,12 +726,12 @@ def add_jpsi_crctn_stats_unc_hists(
             ]
         )
         if args.validationHists:
-            muonScaleSyst_responseWeights_splines = df.HistoBoost(
+            book_hist(
+                results, df,
                 "muonScaleSyst_responseWeights_splines", axes,
                 [*nominal_cols, "muonScaleSyst_responseWeights_tensor_splines"],
                 tensor_axes = jpsi_unc_helper.tensor_axes, storage=hist.storage.Double()
             )
-            results.append(muonScaleSyst_responseWeights_splines)
 
     if args.muonScaleVariation == 'massWeights' or args.validationHists:
         if args.muonScaleVariation == 'massWeights' and isW: 
@@ -741,34 +754,34 @@ def add_jpsi_crctn_stats_unc_hists(
             ]
         )
         if args.validationHists:
-            muonScaleSyst_responseWeights_massWeights = df.HistoBoost(
+            book_hist(
+                results, df,
                 "muonScaleSyst_responseWeights_massWeights", axes,
                 [*nominal_cols, "muonScaleSyst_responseWeights_tensor_massWeights"],
                 tensor_axes = jpsi_unc_helper.tensor_axes, storage=hist.storage.Double()
             )
-            results.append(muonScaleSyst_responseWeights_massWeights)
 
     # Set the nominal muon scale variation.
     # If the scale var is derived from smearingWeightsGaus on the smeared-GEN,
     # the nominal will be the transported variation on RECO
     if not args.muonScaleVariation == 'smearingWeightsGaus':
         if args.muonScaleVariation == 'smearingWeightsSplines':
-            df= df.Define(
+            df= df.Alias(
                 "nominal_muonScaleSyst_responseWeights_tensor",
                 "muonScaleSyst_responseWeights_tensor_splines"
             )
         elif args.muonScaleVariation == 'massWeights':
-            df= df.Define(
+            df= df.Alias(
                 "nominal_muonScaleSyst_responseWeights_tensor",
                 "muonScaleSyst_responseWeights_tensor_massWeights"
             )
-        nominal_muonScaleSyst_responseWeights = df.HistoBoost(
+        book_hist(
+            results, df,
             "nominal_muonScaleSyst_responseWeights", axes,
             [*nominal_cols, "nominal_muonScaleSyst_responseWeights_tensor"],
             tensor_axes = jpsi_crctn_data_unc_helper.tensor_axes,
             storage = hist.storage.Double()
         )
-        results.append(nominal_muonScaleSyst_responseWeights)
     return df
 
 def add_jpsi_crctn_Z_non_closure_hists(
@@ -962,6 +975,7 @@ def define_lbl_corrections_jpsi_calibration_ntuples(df, helper):
     return df
 
 def define_passthrough_corrections_jpsi_calibration_ntuples(df):
+    declare_headers("muon_calibration.h", "lowpu_utils.h")
     df = df.DefinePerSample("Muplus_charge", "1")
     df = df.DefinePerSample("Muminus_charge", "-1")
 
@@ -9,14 +9,14 @@ import pickle
 import lz4.frame
 
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_efficiencies_binned.h"')
+from wremnants import declare_headers
 
 data_dir = common.data_dir
 
 def make_muon_efficiency_helpers_binned(filename = data_dir + "/muonSF/allSmooth_GtoH.root",
                                         era = None, is_w_like = False, max_pt = np.inf,
                                         usePseudoSmoothing=False):
+    declare_headers("muon_efficiencies_binned.h")
 
     # usePseudoSmoothing will use smoothed nominal histograms with the same pt binning as the original ones.
     # (should do the same for the systematic but the smoothed histogram with original binning is not available at the moment)
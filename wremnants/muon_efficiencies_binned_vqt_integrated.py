@@ -9,9 +9,7 @@ import pickle
 import lz4.frame
 
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_efficiencies_binned.h"')
-narf.clingutils.Declare('#include "muon_efficiencies_binned_vqt_integrated.h"')
+from wremnants import declare_headers
 
 data_dir = common.data_dir
 
@@ -19,6 +17,7 @@ def make_muon_efficiency_helpers_binned_vqt_integrated(filename = data_dir + "/m
                                                        era = None, is_w_like = False, max_pt = np.inf,
                                                        usePseudoSmoothing=False,
                                                        includeTrigger = False):
+    declare_headers("muon_efficiencies_binned.h", "muon_efficiencies_binned_vqt_integrated.h")
 
     # usePseudoSmoothing will use smoothed nominal histograms with the same pt binning as the original ones.
     # (should do the same for the systematic but the smoothed histogram with original binning is not available at the moment)
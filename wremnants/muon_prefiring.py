@@ -3,12 +3,12 @@ import pathlib
 import hist
 import narf.clingutils
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_prefiring.h"')
+from wremnants import declare_headers
 
 data_dir = common.data_dir
 
 def make_muon_prefiring_helpers(filename = data_dir + "/muonSF/L1MuonPrefiringParametriations_histograms.root", era = None):
+    declare_headers("muon_prefiring.h")
 
     fin = ROOT.TFile.Open(filename);
 
@@ -1,6 +1,6 @@
 import ROOT
 from wremnants import muon_calibration
-from wremnants import theory_tools
+from wremnants import theory_tools, declare_headers
 from utilities.common import background_MCprocs as bkgMCprocs
 
 def apply_met_filters(df):
@@ -44,7 +44,11 @@ def select_good_muons(df, ptLow, ptHigh, datasetGroup, nMuons=1, use_trackerMuon
 
     return df
 
-def define_trigger_muons(df, what_analysis=ROOT.wrem.AnalysisType.Dilepton):
+def define_trigger_muons(df, what_analysis=None):
+    if what_analysis is None:
+        # the enum is only available after declaring the headers
+        declare_headers()
+        what_analysis = ROOT.wrem.AnalysisType.Dilepton
 
     if what_analysis == ROOT.wrem.AnalysisType.Dilepton:
         # by convention define trigMuons as the positive charge, but actually both leptons could be triggering here 
@@ -7,8 +7,7 @@ from functools import reduce
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
 from wremnants.muon_calibration import get_jpsi_scale_param_cov_mat
-
-narf.clingutils.Declare('#include "muon_validation.h"')
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
@@ -48,6 +47,7 @@ def define_jpsi_crctd_muons_pt_unc(df, helper):
     return df
 
 def define_jpsi_crctd_z_mass(df):
+    declare_headers("muon_validation.h")
     df = df.Define("trigMuons_jpsi_crctd_mom4",
         (
             "ROOT::Math::PtEtaPhiMVector("
@@ -65,6 +65,7 @@ def define_jpsi_crctd_z_mass(df):
     return df
 
 def define_jpsi_crctd_unc_z_mass(df):
+    declare_headers("muon_validation.h")
     df = df.Define("trigMuons_jpsi_crctd_mom4_unc",
         (
             "ROOT::VecOps::RVec<double> res(trigMuons_jpsi_crctd_pt_unc.size());"
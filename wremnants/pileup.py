@@ -5,11 +5,10 @@ import narf
 import numpy as np
 import boost_histogram as bh
 from utilities import common, logging
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "pileup.h"')
-
 data_dir = common.data_dir
 
 eradict = { "2016B" : "B",
@@ -43,6 +42,7 @@ fileDict = {
 def make_pileup_helper(era = None, cropHighWeight = 5.,
                        filename_data = None,
                        filename_mc = None):
+    declare_headers("pileup.h")
 
     # following the logic from https://github.com/WMass/cmgtools-lite/blob/7488bc844ee7e7babf8376d9c7b074442b8879f0/WMass/python/plotter/pileupStuff/makePUweightPerEra.py
 
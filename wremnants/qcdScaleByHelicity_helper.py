@@ -3,6 +3,7 @@ import hist
 import pickle
 import lz4.frame
 from .correctionsTensor_helper import makeCorrectionsTensor
+from wremnants import declare_headers
 from utilities import common, logging
 import numpy as np
 
@@ -31,4 +32,5 @@ def makeQCDScaleByHelicityHelper(is_w_like = False, filename=None):
     corrh_noerrs = hist.Hist(*corrh.axes, storage=hist.storage.Double())
     corrh_noerrs.values(flow=True)[...] = corrh.values(flow=True)
 
+    declare_headers("theory_corrections.h")
     return makeCorrectionsTensor(corrh_noerrs, ROOT.wrem.QCDScaleByHelicityCorrectionsHelper, tensor_rank=3)
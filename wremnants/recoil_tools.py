@@ -11,16 +11,17 @@ import array
 from utilities import common as common
 from utilities.io_tools import input_tools
 
-import tensorflow as tf
+from wremnants import declare_headers, sparse_hists
 
 
-ROOT.gInterpreter.Declare('#include "recoil_tools.h"')
-ROOT.gInterpreter.Declare('#include "recoil_helper.h"')
 logger = logging.getLogger("wremnants").getChild(__name__.split(".")[-1])
 
 
 def RecoilCalibrationHelper(fIn, args):
 
+    declare_headers("recoil_tools.h", "recoil_helper.h")
+    # only needed to read the metadata of the model, slow to import
+    import tensorflow as tf
     with open(fIn, 'rb') as f:
         model = f.read()
         interpreter = tf.lite.Interpreter(model_content=model)
@@ -31,11 +32,13 @@ def RecoilCalibrationHelper(fIn, args):
     return helper, nstat
 
 def VPTReweightHelper(fIn):
+    declare_headers("recoil_tools.h", "recoil_helper.h")
     js = input_tools.read_json(fIn)
     helper = ROOT.wrem.VPTReweightHelper(js['vpt_bins'], js['weights'], min(js['vpt_bins']), max(js['vpt_bins']))
     return helper
 
 def METXYCorrectionHelper(fIn):
+    declare_headers("recoil_tools.h", "recoil_helper.h")
     js = input_tools.read_json(fIn)
     helper_data = ROOT.wrem.METXYCorrectionHelper(js['x']['data']['nom'], js['y']['data']['nom'])
     helper_mc = ROOT.wrem.METXYCorrectionHelper(js['x']['mc']['nom'], js['y']['mc']['nom'])
@@ -45,6 +48,7 @@ class Recoil:
 
     def __init__(self, pu_type, args, flavor="mu"):
 
+        declare_headers("recoil_tools.h", "recoil_helper.h")
         self.met = args.met
         self.flavor = flavor
         self.args = args
@@ -131,6 +135,11 @@ class Recoil:
         self.axis_recoil_2d_para = hist.axis.Regular(40, -10, 10, name = "axis_recoil_2d_para", underflow=False, overflow=False)
         self.axis_recoil_2d_perp = hist.axis.Regular(40, -10, 10, name = "axis_recoil_2d_perp", underflow=False, overflow=False)
 
+        # histograms with these (large and mostly empty) axes are only stored with the filled bins during the event loop
+        self.sparse_axes = [] if args.recoilDenseHists else [self.axis_res_ratio, self.axis_res_diff, self.axis_run_no]
+        # [(dataset, name, axes, result)], the name of the dataset is only final after building the graph
+        #   (e.g. the out of acceptance copies of the signal datasets are renamed at the end)
+        self.sparse_results = []
 
 
 
@@ -143,9 +152,23 @@ class Recoil:
             else:
                 cols_fakerate = [coll_passMT if x=="passMT" else x for x in self.cols_fakerate] # get correct passMT definition
                 axes_fakerate = self.axes_fakerate
-            self.results.append(self.df.HistoBoost(name, axes+axes_fakerate, cols+cols_fakerate+[nominal_weight]))
+            self.book_histo(name, axes+axes_fakerate, cols+cols_fakerate+[nominal_weight])
         else:
-            self.results.append(self.df.HistoBoost(name, axes, cols+[nominal_weight]))
+            self.book_histo(name, axes, cols+[nominal_weight])
+
+    def book_histo(self, name, axes, cols):
+        if any(ax in self.sparse_axes for ax in axes) and sparse_hists.is_supported(axes):
+            result = sparse_hists.book_sparse_hist(self.df, axes, cols)
+            self.sparse_results.append((self.dataset, name, axes, result))
+        else:
+            self.results.append(self.df.HistoBoost(name, axes, cols))
+
+    def add_sparse_hists(self, resultdict):
+        # to be called on the output of the event loop, adds the histograms which were filled sparsely
+        sparse_results = {}
+        for dataset, name, axes, result in self.sparse_results:
+            sparse_results.setdefault(dataset.name, []).append((name, axes, result))
+        sparse_hists.add_sparse_hists(resultdict, sparse_results)
 
 
     def recoil_Z(self, df, results, dataset, datasets_to_apply, leps_uncorr, leps_corr):
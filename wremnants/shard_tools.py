@@ -0,0 +1,259 @@
+import ROOT
+import narf
+from narf.ioutils import H5PickleProxy
+import hist
+import copy
+import lz4.frame
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import tempfile
+import time
+
+from utilities import logging
+from utilities.cache_tools import hash_object
+
+logger = logging.child_logger(__name__)
+
+# Split the datasets of a histmaker into shards of input files and run them in a pool of worker processes,
+#   each running narf.build_and_run with its own (smaller) thread pool.
+# The workers are forked from the main process, such that the graph building function and the helpers
+#   do not need to be pickled, the partial results are written to files and merged by adding the histograms
+#   and the sums of weights, event counts and luminosities.
+# With a checkpoint directory, the partial outputs are kept such that an interrupted run can be resumed.
+# The thread pool of ROOT is not fork safe, the workers should be started before any event loop was run in the main process.
+
+# numbers that are summed up in the merged results
+summed_keys = ["weight_sum", "event_count", "lumi"]
+
+def file_weight(path, balance="size"):
+    # expected processing time of a file, in arbitrary units
+    if balance == "events":
+        f = ROOT.TFile.Open(path)
+        tree = f.Get("Events") if f else None
+        nevents = tree.GetEntries() if tree else 0
+        if f:
+            f.Close()
+        return max(nevents, 1)
+    if os.path.isfile(path):
+        return max(os.path.getsize(path), 1)
+    # remote files without cheap access to the size count equally
+    return 1
+
+def split_files(filepaths, weights, nshards):
+    # balanced partition of the files into nshards (largest files first into the lightest shard),
+    #   keeping the original order of the files within each shard
+    shards = [[] for i in range(nshards)]
+    totals = [0]*nshards
+    for i in sorted(range(len(filepaths)), key=lambda i: -weights[i]):
+        ishard = min(range(nshards), key=lambda j: totals[j])
+        shards[ishard].append(i)
+        totals[ishard] += weights[i]
+    return [([filepaths[i] for i in sorted(s)], t) for s, t in zip(shards, totals) if s]
+
+def make_shards(datasets, njobs, shards_per_job=4, balance="size"):
+    # list of (dataset index, shard index, file paths, weight), sorted by decreasing weight
+    #   such that the largest shards are processed first and the small ones fill up the tail
+    weights = [[file_weight(p, balance) for p in d.filepaths] for d in datasets]
+    total = sum(sum(w) for w in weights)
+    target = total / max(njobs*shards_per_job, 1)
+
+    shards = []
+    for idataset, (dataset, w) in enumerate(zip(datasets, weights)):
+        nshards = min(max(math.ceil(sum(w)/target), 1), len(dataset.filepaths)) if total > 0 else 1
+        if nshards <= 1:
+            shards.append((idataset, 0, list(dataset.filepaths), sum(w)))
+            continue
+        for ishard, (paths, weight) in enumerate(split_files(dataset.filepaths, w, nshards)):
+            shards.append((idataset, ishard, paths, weight))
+        logger.debug(f"Split dataset {dataset.name} with {len(dataset.filepaths)} files into {nshards} shards")
+
+    return sorted(shards, key=lambda s: -s[3])
+
+def shard_dataset(dataset, paths):
+    ds = copy.copy(dataset)
+    ds.filepaths = paths
+    return ds
+
+def run_shard(dataset, build_graph, outfile, nthreads, postprocess, state):
+    # runs in the worker process
+    ROOT.ROOT.DisableImplicitMT()
+    if nthreads > 1:
+        ROOT.ROOT.EnableImplicitMT(nthreads)
+
+    resultdict = narf.build_and_run([dataset], build_graph)
+    if postprocess is not None:
+        postprocess(resultdict)
+
+    for result in resultdict.values():
+        result["output"] = {k: v.get() if isinstance(v, H5PickleProxy) else v for k, v in result["output"].items()}
+
+    # the graph building function may rename the dataset (e.g. out of acceptance copies), which only happens on the copy in the worker
+    with lz4.frame.open(f"{outfile}.tmp", "wb") as f:
+        pickle.dump({"results" : resultdict, "state" : state, "name" : dataset.name}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{outfile}.tmp", outfile)
+
+def merge_result(merged, result):
+    if merged is None:
+        return result
+    for key in summed_keys:
+        if key in result and key in merged:
+            merged[key] += result[key]
+    output = merged["output"]
+    for h_name, h in result["output"].items():
+        if h_name not in output:
+            output[h_name] = h
+        elif isinstance(h, hist.Hist):
+            output[h_name] += h
+        else:
+            logger.debug(f"Keep first value of output {h_name}, objects of type {type(h)} are not merged")
+    return merged
+
+def merge_state(state, update):
+    # state of the graph building function (e.g. lists of processes filled by it) from the workers
+    for key, value in update.items():
+        if isinstance(state[key], list):
+            state[key].extend(v for v in value if v not in state[key])
+        else:
+            state[key].update(value)
+
+# arguments of the histmakers which do not change the histograms of a shard
+non_config_args = ["nThreads", "verbose", "noColorLogger", "shardJobs", "shardsPerJob", "shardBalance", "checkpointDir", "resume", "dryRun", "memoryBudget", 
+    "outfolder", "postfix", "forceDefaultName", "theoryCorrCacheDir", "recoilDenseHists", "rawHistMinSize", "compactSystHists", "outputCompression", "outputCompressionLevel", "noScaleToData", "aggregateGroups"]
+
+def checkpoint_config(args):
+    return {k: v for k, v in vars(args).items() if k not in non_config_args}
+
+def shard_key(idataset, dataset, paths, build_graph, config):
+    # copies of a dataset (e.g. the out of acceptance contribution) have the same name and files, but are different datasets
+    return hash_object({
+        "index" : idataset,
+        "name" : dataset.name,
+        "group" : getattr(dataset, "group", None),
+        "out_of_acceptance" : getattr(dataset, "out_of_acceptance", False),
+        "filepaths" : paths,
+        "build_graph" : build_graph,
+        "config" : config,
+    })[:16]
+
+def load_shard(outfile):
+    with lz4.frame.open(outfile, "rb") as f:
+        return pickle.load(f)
+
+def build_and_run(datasets, build_graph, njobs=None, nthreads=None, shards_per_job=4, balance="size", postprocess=None, state=None, 
+    checkpoint_dir=None, resume=False, config={}
+):
+    # drop in replacement for narf.build_and_run, running the shards in njobs worker processes with nthreads each
+    #   postprocess(resultdict) is called in the workers on the results of each shard, before merging
+    #   state is a dict of lists/dicts/sets filled by build_graph, which are updated with the content from the workers
+    # with a checkpoint_dir, the partial output of each shard is kept in this directory, identified by a hash of the
+    #   dataset (index, name and group), the files of the shard, the graph building function and the configuration (e.g. the histmaker arguments),
+    #   with resume=True shards with an existing partial output are not run again
+    if resume and checkpoint_dir is None:
+        raise ValueError("A checkpoint directory is needed to resume a run")
+    if checkpoint_dir is None and (not njobs or njobs <= 1):
+        resultdict = narf.build_and_run(datasets, build_graph)
+        if postprocess is not None:
+            postprocess(resultdict)
+        return resultdict
+
+    time0 = time.time()
+    njobs = max(njobs or 1, 1)
+    if state is None:
+        state = {}
+    if nthreads is None:
+        nthreads = max(ROOT.ROOT.GetThreadPoolSize(), 1)
+    nthreads_job = max(nthreads // njobs, 1)
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        outdir = checkpoint_dir
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        outdir = tmpdir.name
+
+    merged = {}
+    names = {}
+    # names of the datasets after building the graph, applied once all shards are done such that the output files do not change meanwhile
+    final_names = {}
+    def merge_shard(idataset, outfile):
+        shard_output = load_shard(outfile)
+        merge_state(state, shard_output["state"])
+        final_names[idataset] = shard_output["name"]
+        for name, result in shard_output["results"].items():
+            names.setdefault(name, idataset)
+            merged[name] = merge_result(merged.get(name, None), result)
+
+    todo = []
+    nresumed = 0
+    for idataset, ishard, paths, weight in make_shards(datasets, njobs, shards_per_job, balance):
+        dataset = datasets[idataset]
+        if checkpoint_dir is not None:
+            outfile = f"{outdir}/{dataset.name}_{shard_key(idataset, dataset, paths, build_graph, config)}.pkl.lz4"
+        else:
+            outfile = f"{outdir}/{idataset}_{dataset.name}_{ishard}.pkl.lz4"
+        if resume and os.path.isfile(outfile):
+            logger.debug(f"Use partial output {outfile} for shard {ishard} of dataset {dataset.name}")
+            merge_shard(idataset, outfile)
+            nresumed += 1
+        else:
+            todo.append((idataset, ishard, paths, outfile))
+
+    if nresumed:
+        logger.info(f"Resume from the partial outputs of {nresumed} shards")
+    logger.info(f"Run {len(todo)} shards of {len(datasets)} datasets in {njobs} processes with {nthreads_job} threads each")
+
+    ctx = multiprocessing.get_context("fork")
+    running = {}
+    failed = []
+    try:
+        while todo or running:
+            while todo and len(running) < njobs:
+                idataset, ishard, paths, outfile = todo.pop(0)
+                proc = ctx.Process(target=run_shard, args=(shard_dataset(datasets[idataset], paths), build_graph, outfile, nthreads_job, postprocess, state))
+                proc.start()
+                running[proc.sentinel] = (proc, idataset, ishard, outfile, time.time())
+
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                proc, idataset, ishard, outfile, start = running.pop(sentinel)
+                proc.join()
+                dataset = datasets[idataset]
+                if proc.exitcode != 0:
+                    if checkpoint_dir is None:
+                        raise RuntimeError(f"Shard {ishard} of dataset {dataset.name} failed with exit code {proc.exitcode}")
+                    # keep going, such that the partial outputs of all other shards are available for a rerun
+                    logger.error(f"Shard {ishard} of dataset {dataset.name} failed with exit code {proc.exitcode}")
+                    failed.append(f"{dataset.name}:{ishard}")
+                    continue
+
+                logger.debug(f"Finished shard {ishard} of dataset {dataset.name} in {time.time()-start:.1f} s, {len(todo)+len(running)} shards left")
+                merge_shard(idataset, outfile)
+                if checkpoint_dir is None:
+                    os.remove(outfile)
+    finally:
+        for proc, *_ in running.values():
+            proc.terminate()
+        if checkpoint_dir is None:
+            tmpdir.cleanup()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} shards failed ({', '.join(failed)}), the partial outputs of the other shards are in {checkpoint_dir} and can be used with --resume")
+
+    # as if the graph was built on the datasets of the main process
+    for idataset, name in final_names.items():
+        if datasets[idataset].name != name:
+            logger.debug(f"Dataset {datasets[idataset].name} was renamed to {name}")
+            datasets[idataset].name = name
+
+    # same order as the datasets, with the full list of files and the histograms wrapped as from narf.build_and_run
+    resultdict = {}
+    for name in sorted(merged.keys(), key=lambda n: names[n]):
+        result = merged[name]
+        result["dataset"]["filepaths"] = list(datasets[names[name]].filepaths)
+        result["output"] = {k: H5PickleProxy(v) if isinstance(v, hist.Hist) else v for k, v in result["output"].items()}
+        resultdict[name] = result
+
+    logger.info(f"Sharded event loop: {time.time() - time0}")
+    return resultdict
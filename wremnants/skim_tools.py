@@ -0,0 +1,119 @@
+import ROOT
+import os
+from copy import deepcopy
+
+from utilities import logging
+from utilities.cache_tools import hash_object, file_fingerprint
+
+logger = logging.child_logger(__name__)
+
+# Columnar snapshots ("skims") of the events passing the event selection of a histmaker,
+#   such that reruns (e.g. with different systematics or binnings) only read the selected events instead of the full NanoAOD
+# For each dataset two files are written:
+#   - {name}_{key}.root with the input branches of the selected events ("Events") and the "LuminosityBlocks" tree, used as new input
+#   - {name}_{key}_weights.root with the minimal columns of all input events ("SkimWeights") to compute the sum of weights before selection
+# The key is a hash of the input file list, the selection function and the configuration it depends on,
+#   changes in the code of the functions called by the selection function are not detected and require to clear the cache directory
+
+skim_version = 1
+
+events_tree = "Events"
+weights_tree = "SkimWeights"
+lumi_tree = "LuminosityBlocks"
+
+# keep the dataframes for the sums of weights alive until the event loop has run
+_weight_dfs = []
+
+def skim_key(dataset, select_function, config):
+    # local files are identified by their size and modification time in addition to the path
+    filepaths = [file_fingerprint(p) if os.path.exists(p) else p for p in dataset.filepaths]
+    return hash_object({
+        "version" : skim_version,
+        "name" : dataset.name,
+        "is_data" : dataset.is_data,
+        "filepaths" : filepaths,
+        "selection" : select_function,
+        "config" : config,
+    })[:16]
+
+def skim_paths(cachedir, dataset, key):
+    stem = f"{cachedir}/{dataset.name}_{key}"
+    return f"{stem}.root", f"{stem}_weights.root"
+
+def snapshot_options(mode="RECREATE", lazy=False):
+    opts = ROOT.RDF.RSnapshotOptions()
+    opts.fMode = mode
+    opts.fLazy = lazy
+    opts.fCompressionAlgorithm = ROOT.ROOT.RCompressionSetting.EAlgorithm.kZSTD
+    opts.fCompressionLevel = 5
+    return opts
+
+def input_columns(df):
+    defined = set(df.GetDefinedColumnNames())
+    return [c for c in df.GetColumnNames() if c not in defined]
+
+def make_skims(datasets, select_function, cachedir, config={}, skip=lambda dataset: False):
+    # replace the input files of the datasets by skims with the events passing 'select_function(df, dataset)',
+    #   the skims are produced for all datasets in a single event loop if they are not in the cache directory yet
+    #   datasets for which 'skip(dataset)' is true (e.g. if histograms before the selection are needed) are read from the original input
+    os.makedirs(cachedir, exist_ok=True)
+
+    skimmed = []
+    todo = []
+    handles = []
+    for dataset in datasets:
+        if skip(dataset):
+            logger.info(f"Dataset {dataset.name} is not skimmed")
+            skimmed.append(dataset)
+            continue
+
+        key = skim_key(dataset, select_function, config)
+        path, weights_path = skim_paths(cachedir, dataset, key)
+
+        if path in [t[1] for t in todo]:
+            # copies of the same dataset (e.g. out of acceptance contributions) share the skim
+            pass
+        elif not (os.path.isfile(path) and os.path.isfile(weights_path)):
+            logger.info(f"Produce skim for dataset {dataset.name} in {path}")
+            df = ROOT.RDataFrame(events_tree, dataset.filepaths)
+            columns = input_columns(df)
+
+            weight_columns = ["run"] if dataset.is_data else ["genWeight"]
+            handles.append(df.Snapshot(weights_tree, f"{weights_path}.tmp", weight_columns, snapshot_options(lazy=True)))
+
+            df = select_function(df, dataset)
+            handles.append(df.Snapshot(events_tree, f"{path}.tmp", columns, snapshot_options(lazy=True)))
+            todo.append((dataset, path, weights_path))
+        else:
+            logger.info(f"Use skim {path} for dataset {dataset.name}")
+
+        ds = deepcopy(dataset)
+        ds.filepaths = [path]
+        ds.skim_weights = weights_path
+        skimmed.append(ds)
+
+    if handles:
+        ROOT.RDF.RunGraphs(handles)
+
+    for dataset, path, weights_path in todo:
+        # the luminosity blocks are needed to compute the luminosity of data
+        df_lumi = ROOT.RDataFrame(lumi_tree, dataset.filepaths)
+        df_lumi.Snapshot(lumi_tree, f"{path}.tmp", input_columns(df_lumi), snapshot_options(mode="UPDATE"))
+
+        # the skim is only valid once all files are complete
+        os.replace(f"{weights_path}.tmp", weights_path)
+        os.replace(f"{path}.tmp", path)
+
+        nsel = ROOT.RDataFrame(events_tree, path).Count().GetValue()
+        ntot = ROOT.RDataFrame(weights_tree, weights_path).Count().GetValue()
+        logger.info(f"Skim for dataset {dataset.name}: selected {nsel} out of {ntot} events")
+
+    return skimmed
+
+def sum_weights(df, dataset, define_weight):
+    # sum of the weights before the selection, computed from the weights tree for skimmed datasets,
+    #   'define_weight(df, dataset)' defines the "weight" column in the same way as for the main dataframe
+    if hasattr(dataset, "skim_weights"):
+        df = define_weight(ROOT.RDataFrame(weights_tree, dataset.skim_weights), dataset)
+        _weight_dfs.append(df)
+    return df.SumAndCount("weight")
@@ -0,0 +1,70 @@
+import ROOT
+import hist
+import numpy as np
+from narf.ioutils import H5PickleProxy
+from utilities import logging
+from wremnants import declare_headers
+
+logger = logging.child_logger(__name__)
+
+# Histograms with many (mostly empty) bins, e.g. for fine resolution studies or per run, filled through wrem::SparseHistHelper,
+#   which keeps a map of the filled bins per thread instead of a dense histogram per thread, such that the memory
+#   is proportional to the number of filled bins.
+# The results are converted to hist objects with the same axes and Weight storage as from HistoBoost after the event loop,
+#   by add_sparse_hists(resultdict, sparse_results) which adds them to the output of the datasets.
+
+def is_supported(axes):
+    for ax in axes:
+        if isinstance(ax, (hist.axis.Integer, hist.axis.Boolean, hist.axis.Variable)):
+            continue
+        if isinstance(ax, hist.axis.Regular) and ax.transform is None:
+            continue
+        return False
+    return True
+
+def make_axis(ax):
+    underflow = ax.traits.underflow
+    overflow = ax.traits.overflow
+    no_edges = ROOT.std.vector["double"]()
+    if isinstance(ax, hist.axis.Boolean):
+        return ROOT.wrem.SparseAxis(ROOT.wrem.SparseAxis.Integer, 2, 0., 2., no_edges, False, False)
+    if isinstance(ax, hist.axis.Integer):
+        return ROOT.wrem.SparseAxis(ROOT.wrem.SparseAxis.Integer, ax.size, ax.edges[0], ax.edges[-1], no_edges, underflow, overflow)
+    if isinstance(ax, hist.axis.Regular):
+        return ROOT.wrem.SparseAxis(ROOT.wrem.SparseAxis.Regular, ax.size, ax.edges[0], ax.edges[-1], no_edges, underflow, overflow)
+    edges = ROOT.std.vector["double"](list(ax.edges))
+    return ROOT.wrem.SparseAxis(ROOT.wrem.SparseAxis.Variable, ax.size, ax.edges[0], ax.edges[-1], edges, underflow, overflow)
+
+def book_sparse_hist(df, axes, cols):
+    # cols are the columns of the axes followed by the weight column
+    if not is_supported(axes):
+        raise ValueError(f"Sparse histograms only support regular (without transform), variable, integer and boolean axes, got {axes}")
+    declare_headers("sparse_hist.h")
+
+    sparse_axes = ROOT.std.vector["wrem::SparseAxis"]()
+    for ax in axes:
+        sparse_axes.push_back(make_axis(ax))
+
+    col_types = tuple(df.GetColumnType(c) for c in cols)
+    return ROOT.wrem.BookSparseHist[col_types](ROOT.RDF.AsRNode(df), sparse_axes, cols)
+
+def to_hist(result, axes, name):
+    sparse = result.GetValue()
+    h = hist.Hist(*axes, storage=hist.storage.Weight(), name=name)
+    shape = h.view(flow=True).shape
+    values = np.zeros(np.prod(shape))
+    variances = np.zeros(np.prod(shape))
+    sparse.fill_dense(values, variances)
+    h.view(flow=True).value = values.reshape(shape)
+    h.view(flow=True).variance = variances.reshape(shape)
+    logger.debug(f"Converted sparse histogram {name} with {sparse.size()} of {values.size} bins filled")
+    return h
+
+def add_sparse_hists(resultdict, sparse_results):
+    # sparse_results: {dataset name : [(name, axes, result)]}
+    for d_name, results in sparse_results.items():
+        if d_name not in resultdict:
+            continue
+        output = resultdict[d_name]["output"]
+        for name, axes, result in results:
+            output[name] = H5PickleProxy(to_hist(result, axes, name))
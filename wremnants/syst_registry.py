@@ -0,0 +1,148 @@
+import hist
+import numpy as np
+import re
+import contextlib
+from narf.ioutils import H5PickleProxy
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+class SystHistRegistry(list):
+    # list of the histograms booked for one dataset, used in place of the plain results list of a histmaker
+    #  - histograms of systematics that would be excluded from the datacard anyway are not booked,
+    #    using regular expressions as for setupCombine.py --excludeNuisances/--keepNuisances on the name of the systematic
+    #    (i.e. the histogram name without the leading base name), note that setupCombine.py matches them to the names of the
+    #    individual nuisances instead, which are not known at this point
+    #  - within merged_hists(results), histograms with the same axes and columns and different weight tensors are filled
+    #    from a single concatenated tensor (identical weight columns only once), the merged histograms are split
+    #    into the original ones by split_merged_hists after the event loop
+    def __init__(self, exclude=None, keep=None, merge=False, base_names=["nominal"]):
+        super().__init__()
+        self.exclude = re.compile(exclude) if exclude else None
+        self.keep = re.compile(keep) if keep else None
+        self.merge = merge
+        self.base_names = base_names
+        # histograms booked inside merged_hists, which are not booked yet
+        self.pending = None
+        # name of merged histogram: [(name, tensor axes, offset in the merged tensor axis)]
+        self.merged = {}
+        self.pruned = []
+
+    def is_excluded(self, name):
+        syst = next((name[len(b)+1:] for b in self.base_names if name.startswith(f"{b}_")), None)
+        if syst is None or self.exclude is None or not self.exclude.match(syst):
+            return False
+        return self.keep is None or not self.keep.match(syst)
+
+    def book(self, df, name, axes, cols, **kwargs):
+        if self.is_excluded(name):
+            logger.debug(f"Do not book histogram {name}, the systematic is excluded")
+            self.pruned.append(name)
+            return
+        if self.pending is not None and is_mergeable(kwargs):
+            # the merged histogram is filled on the node of the last histogram, all histograms have to be booked after the same filters, 
+            #   each filter (also unnamed ones) adds an entry to the filter names such that a filter applied within merged_hists is detected
+            filters = list(df.GetFilterNames())
+            if self.pending and filters != self.pending[0][5]:
+                raise ValueError(f"Histogram {name} is booked after the filters {filters}, different from the filters {self.pending[0][5]} "
+                    f"of histogram {self.pending[0][1]}, no filters can be applied on the dataframes used for booking within merged_hists")
+            self.pending.append((df, name, axes, cols, kwargs, filters))
+        else:
+            self.append(df.HistoBoost(name, axes, cols, **kwargs))
+
+    def flush(self):
+        pending, self.pending = self.pending, None
+
+        # histograms with the same axes and (non weight) columns
+        groups = []
+        for entry in pending:
+            df, name, axes, cols, kwargs, _ = entry
+            for group in groups:
+                if group["axes"] == axes and group["cols"] == cols[:-1]:
+                    group["entries"].append(entry)
+                    break
+            else:
+                groups.append({"axes" : axes, "cols" : cols[:-1], "entries" : [entry]})
+
+        for group in groups:
+            # the concatenated tensor is defined on the latest node (wrem::concatFlatTensors in histoScaling.h), 
+            #   which has to know all weight columns of the merged histograms
+            entries = []
+            for entry in group["entries"]:
+                columns = entry[0].GetColumnNames()
+                if entries and any(e[3][-1] not in columns for e in entries):
+                    self.book_merged(entries)
+                    entries = []
+                entries.append(entry)
+            self.book_merged(entries)
+
+    def book_merged(self, entries):
+        if len(entries) == 1:
+            df, name, axes, cols, kwargs, _ = entries[0]
+            self.append(df.HistoBoost(name, axes, cols, **kwargs))
+            return
+
+        df, _, axes, cols, _, _ = entries[-1]
+
+        offsets = {}
+        size = 0
+        for _, name, _, entry_cols, kwargs, _ in entries:
+            if entry_cols[-1] not in offsets:
+                offsets[entry_cols[-1]] = size
+                size += int(np.prod([ax.size for ax in kwargs["tensor_axes"]]))
+
+        name = f"mergedSystHists{len(self.merged)}"
+        logger.debug(f"Fill histograms {[e[1] for e in entries]} through {name}")
+
+        df = df.Define(f"{name}_tensor", f"wrem::concatFlatTensors({', '.join(offsets.keys())})")
+        axis_merged = hist.axis.Integer(0, size, name="mergedSystIdx", underflow=False, overflow=False)
+        self.append(df.HistoBoost(name, axes, [*cols[:-1], f"{name}_tensor"], tensor_axes=[axis_merged], storage=hist.storage.Double()))
+
+        self.merged[name] = [(e[1], e[4]["tensor_axes"], offsets[e[3][-1]]) for e in entries]
+
+def is_mergeable(kwargs):
+    # only weight tensors filled into histograms with double storage can be merged
+    return set(kwargs.keys()) == {"tensor_axes", "storage"} and kwargs["storage"] == hist.storage.Double()
+
+def book_hist(results, df, name, axes, cols, **kwargs):
+    # book a histogram and append it to the results, through the registry if results is a SystHistRegistry
+    if isinstance(results, SystHistRegistry):
+        results.book(df, name, axes, cols, **kwargs)
+    else:
+        results.append(df.HistoBoost(name, axes, cols, **kwargs))
+
+@contextlib.contextmanager
+def merged_hists(results):
+    # histograms booked with book_hist in this context can be filled together,
+    #   no filters can be applied on the dataframes used for booking (SystHistRegistry.book raises otherwise)
+    if not isinstance(results, SystHistRegistry) or not results.merge or results.pending is not None:
+        yield
+        return
+    results.pending = []
+    yield
+    results.flush()
+
+def split_tensor(values, tensor_axes, offset):
+    # values of the histogram of one weight tensor from the values of the merged histogram (with the merged axis last),
+    #   the tensors are flattened in column major order
+    shape = tuple(ax.size for ax in tensor_axes)
+    values = values[..., offset:offset+int(np.prod(shape))]
+    values = values.reshape(*values.shape[:-1], *shape[::-1])
+    ntensor = len(shape)
+    return np.moveaxis(values, np.arange(values.ndim-ntensor, values.ndim), np.arange(values.ndim-1, values.ndim-ntensor-1, -1))
+
+def split_merged_hists(resultdict, registries):
+    # replace the merged histograms in the output by the original histograms
+    for d_name, registry in registries.items():
+        if d_name not in resultdict or not registry.merged:
+            continue
+        output = resultdict[d_name]["output"]
+        for name, components in registry.merged.items():
+            hmerged = output.pop(name).get()
+            values = hmerged.values(flow=True)
+            for h_name, tensor_axes, offset in components:
+                hnew = hist.Hist(*hmerged.axes[:-1], *tensor_axes, storage=hist.storage.Double(), name=h_name)
+                tensor_slices = [slice(int(ax.traits.underflow), int(ax.traits.underflow)+ax.size) for ax in tensor_axes]
+                hnew.view(flow=True)[(Ellipsis, *tensor_slices)] = split_tensor(values, tensor_axes, offset)
+                output[h_name] = H5PickleProxy(hnew)
+        logger.debug(f"Split {len(registry.merged)} merged histograms for {d_name}")
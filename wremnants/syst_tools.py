@@ -2,9 +2,10 @@ import ROOT
 import hist
 import numpy as np
 from utilities import boostHistHelpers as hh, common, logging
-from wremnants import theory_tools
+from wremnants import theory_tools, declare_headers
 from wremnants.datasets.datagroups import Datagroups
 from wremnants.helicity_utils import *
+from wremnants.syst_registry import book_hist, merged_hists
 import re
 import collections.abc
 import copy
@@ -21,6 +22,12 @@ def syst_transform_map(base_hist, hist_name):
         scale = pdfInfo[key]["scale"] if "scale" in pdfInfo[key] else 1.
         return theory_tools.hessianPdfUnc(h, uncType=unc, scale=scale, axis_name=axis_name)
 
+    def hessianUnc(h, entries):
+        return theory_tools.hessianPdfUnc(h[{"vars" : entries}], "vars", uncType="asymHessian")
+
+    def envelope(h, entries, do_min, no_flow=[]):
+        return hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", entries, no_flow=no_flow, do_min=do_min)
+
     def uncHist(unc):
         return unc if base_hist == "nominal" else f"{base_hist}_{unc}"
 
@@ -56,6 +63,16 @@ def syst_transform_map(base_hist, hist_name):
     def projAx(hname):
         return hname.split("-")
 
+    def matchingVars(h, patterns):
+        return [x for x in h.axes["vars"] if any(re.match(y, x) for y in patterns)]
+
+    transition_vars = ["transition_points0.2_0.65_1.1", "transition_points0.4_0.55_0.7", 
+        "transition_points0.2_0.45_0.7", "transition_points0.4_0.75_1.1", ]
+    tnp_vars = ["pdf0", "^gamma_", "^q_", "b_", "^s+", "^s-", "^h_"]
+    scale_vars = ["pdf0", "^nuB.*", "nuS.*", "^muB.*", "^muS.*",]
+    np_vars = ["c_nu-0.1-omega_nu0.5", "omega_nu0.5", "Lambda2-0.25", "Lambda20.25", "Lambda4.01", 
+        "Lambda4.16","Delta_Lambda2-0.02", "Delta_Lambda20.02",]
+
     transforms.update({
         "resumFOScaleUp" : {
             "action" : lambda h: scetlibIdx(h, 2)},
@@ -66,69 +83,37 @@ def syst_transform_map(base_hist, hist_name):
         "resumLambdaUp" : {
             "action" : lambda h: scetlibIdx(h, 4)},
         "resumTransitionUp" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                ["transition_points0.2_0.65_1.1", "transition_points0.4_0.55_0.7", 
-                "transition_points0.2_0.45_0.7", "transition_points0.4_0.75_1.1", ],
-                 no_flow=["ptVgen"], do_min=False)},
+            "action" : lambda h: envelope(h, transition_vars, False, ["ptVgen"])},
         "resumTransitionDown" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                ["transition_points0.2_0.65_1.1", "transition_points0.4_0.55_0.7", 
-                "transition_points0.2_0.45_0.7", "transition_points0.4_0.75_1.1", ],
-                 no_flow=["ptVgen"], do_min=True)},
+            "action" : lambda h: envelope(h, transition_vars, True, ["ptVgen"])},
        "resumTNPAllUp" : {
-           "action" : lambda h: h if "vars" not in h.axes.name else theory_tools.hessianPdfUnc(h[{"vars" :
-                 [x for x in h.axes["vars"] if any(re.match(y, x) for y in ["pdf0", "^gamma_", "^q_", "b_", "^s+", "^s-", "^h_"])]}], 
-                "vars", uncType="asymHessian")[0]},
+           "action" : lambda h: h if "vars" not in h.axes.name else hessianUnc(h, matchingVars(h, tnp_vars))[0]},
        "resumTNPAllDown" : {
-           "action" : lambda h: h if "vars" not in h.axes.name else theory_tools.hessianPdfUnc(h[{"vars" :
-                 [x for x in h.axes["vars"] if any(re.match(y, x) for y in ["pdf0", "^gamma_", "^q_", "b_", "^s+", "^s-", "^h_"])]}], 
-                "vars", uncType="asymHessian")[1]},
+           "action" : lambda h: h if "vars" not in h.axes.name else hessianUnc(h, matchingVars(h, tnp_vars))[1]},
        "resumScaleAllUp" : {
-           "action" : lambda h: h if "vars" not in h.axes.name else hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars",
-                 [x for x in h.axes["vars"] if any(re.match(y, x) for y in ["pdf0", "^nuB.*", "nuS.*", "^muB.*", "^muS.*",])],
-                    do_min=False)},
+           "action" : lambda h: h if "vars" not in h.axes.name else envelope(h, matchingVars(h, scale_vars), False)},
        "resumScaleAllDown" : {
-           "action" : lambda h: h if "vars" not in h.axes.name else hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars",
-                 [x for x in h.axes["vars"] if any(re.match(y, x) for y in ["pdf0", "^nuB.*", "nuS.*", "^muB.*", "^muS.*",])],
-                    do_min=True)},
+           "action" : lambda h: h if "vars" not in h.axes.name else envelope(h, matchingVars(h, scale_vars), True)},
        "resumNPUp" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                 ["c_nu-0.1-omega_nu0.5", "omega_nu0.5", "Lambda2-0.25", "Lambda20.25", "Lambda4.01", 
-                     "Lambda4.16","Delta_Lambda2-0.02", "Delta_Lambda20.02",],
-                 no_flow=["ptVgen"], do_min=False) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, np_vars, False, ["ptVgen"]) if "vars" in h.axes.name else h},
         "resumNPDown" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                 ["c_nu-0.1-omega_nu0.5", "omega_nu0.5", "Lambda2-0.25", "Lambda20.25", "Lambda4.01", 
-                     "Lambda4.16","Delta_Lambda2-0.02", "Delta_Lambda20.02",],
-                 no_flow=["ptVgen"], do_min=True) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, np_vars, True, ["ptVgen"]) if "vars" in h.axes.name else h},
        "resumNPOmegaUp" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^Omega-*\d+", x)],
-                 do_min=False) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^Omega-*\d+", x)], False) if "vars" in h.axes.name else h},
         "resumNPOmegaDown" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^Omega-*\d+", x)],
-                 do_min=True) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^Omega-*\d+", x)], True) if "vars" in h.axes.name else h},
        "resumNPomega_nuUp" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^omega_nu-*\d+", x)],
-                 do_min=False) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^omega_nu-*\d+", x)], False) if "vars" in h.axes.name else h},
         "resumNPomega_nuDown" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^omega_nu-*\d+", x)],
-                 do_min=True) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^omega_nu-*\d+", x)], True) if "vars" in h.axes.name else h},
        "resumNPc_nuUp" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^c_nu-*\d+", x)],
-                 do_min=False) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^c_nu-*\d+", x)], False) if "vars" in h.axes.name else h},
         "resumNPc_nuDown" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", 
-                [x for x in h.axes["vars"] if re.match("^c_nu-*\d+", x)],
-                 do_min=True) if "vars" in h.axes.name else h},
+            "action" : lambda h: envelope(h, [x for x in h.axes["vars"] if re.match("^c_nu-*\d+", x)], True) if "vars" in h.axes.name else h},
         "resumScaleMax" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", range(9,44), no_flow=["ptVgen"], do_min=False)},
+            "action" : lambda h: envelope(h, range(9,44), False, ["ptVgen"])},
         "resumScaleMin" : {
-            "action" : lambda h: hh.syst_min_or_max_env_hist(h, projAx(hist_name), "vars", range(9,44), no_flow=["ptVgen"], do_min=True)},
+            "action" : lambda h: envelope(h, range(9,44), True, ["ptVgen"])},
     })
     for k in ['gamma_cusp+5', 'gamma_mu_q+5', 'gamma_nu+5', 's+5', 'b_qqV+5', 'b_qqbarV+5', 'b_qqS+5', 'b_qqDS+5', 'b_qg+5']:
         transforms[k.replace("+5", "-5")] = {"action" : lambda h,v=k: h if "vars" not in h.axes.name else hh.mirrorHist(h[{"vars" : v}], h[{"vars" : "pdf0"}])}
@@ -257,8 +242,7 @@ def hist_to_variations(hist_in, gen_axes = [], sum_axes = [], rebin_axes=[], reb
     return variation_hist
 
 def uncertainty_hist_from_envelope(h, proj_ax, entries):
-    hdown = hh.syst_min_or_max_env_hist(h, proj_ax, "vars", entries, no_flow=["ptVgen"], do_min=True)
-    hup = hh.syst_min_or_max_env_hist(h, proj_ax, "vars", entries, no_flow=["ptVgen"], do_min=False)
+    hdown, hup = hh.syst_env_hists(h, proj_ax, "vars", entries, no_flow=["ptVgen"], do_min=[True, False])
     hnew = hist.Hist(*h.axes[:-1], common.down_up_axis, storage=h._storage_type())
     hnew[...,0] = hdown.view(flow=True)
     hnew[...,1] = hup.view(flow=True)
@@ -281,14 +265,13 @@ def add_massweights_hist(results, df, axes, cols, base_name="nominal", proc="",
     if addhelicity:
         massweightHelicity, massWeight_axes = make_massweight_helper_helicity(mass_axis)
         df = df.Define("massWeight_tensor_wnom_helicity", massweightHelicity, ['massWeight_tensor_wnom', 'helWeight_tensor'])
-        massWeight = df.HistoBoost(name, axes, [*cols, "massWeight_tensor_wnom_helicity"],
-                                   tensor_axes=massWeight_axes,
-                                   storage=hist.storage.Double())
+        book_hist(results, df, name, axes, [*cols, "massWeight_tensor_wnom_helicity"],
+                  tensor_axes=massWeight_axes,
+                  storage=hist.storage.Double())
     else:
-        massWeight = df.HistoBoost(name, axes, [*cols, "massWeight_tensor_wnom"], 
-                                   tensor_axes=[mass_axis], 
-                                   storage=hist.storage.Double())
-    results.append(massWeight)
+        book_hist(results, df, name, axes, [*cols, "massWeight_tensor_wnom"], 
+                  tensor_axes=[mass_axis], 
+                  storage=hist.storage.Double())
 
 def massWeightNames(matches=None, proc="", exclude=[]):
     if isinstance(exclude, (int, float)):
@@ -314,10 +297,9 @@ def define_width_weights(df, proc):
 
 def add_widthweights_hist(results, df, axes, cols, base_name="nominal", proc=""):
     name = Datagroups.histName(base_name, syst="widthWeight"+(proc[0] if len(proc) else proc))
-    widthWeight = df.HistoBoost(name, axes, [*cols, "widthWeight_tensor_wnom"], 
-                    tensor_axes=[hist.axis.StrCategory(widthWeightNames(proc=proc), name="width")], 
-                    storage=hist.storage.Double())
-    results.append(widthWeight)
+    book_hist(results, df, name, axes, [*cols, "widthWeight_tensor_wnom"], 
+              tensor_axes=[hist.axis.StrCategory(widthWeightNames(proc=proc), name="width")], 
+              storage=hist.storage.Double())
 
 def widthWeightNames(matches=None, proc=""):
     central=3
@@ -366,13 +348,13 @@ def add_pdf_hists(results, df, dataset, axes, cols, pdfs, base_name="nominal", a
         if addhelicity:
             pdfHeltensor, pdfHeltensor_axes =  make_pdfweight_helper_helicity(npdf, pdf_ax)
             df = df.Define(f'{tensorName}_helicity', pdfHeltensor, [tensorName, "helWeight_tensor"])
-            pdfHist = df.HistoBoost(pdfHistName, axes, [*cols, f'{tensorName}_helicity'], tensor_axes=pdfHeltensor_axes, storage=hist.storage.Double())
+            book_hist(results, df, pdfHistName, axes, [*cols, f'{tensorName}_helicity'], tensor_axes=pdfHeltensor_axes, storage=hist.storage.Double())
             alphaSHeltensor, alphaSHeltensor_axes =  make_pdfweight_helper_helicity(3, as_ax)
             df = df.Define(f'{tensorASName}_helicity', alphaSHeltensor, [tensorASName, "helWeight_tensor"])
-            alphaSHist = df.HistoBoost(alphaSHistName, axes, [*cols, f'{tensorASName}_helicity'], tensor_axes=alphaSHeltensor_axes, storage=hist.storage.Double())
+            book_hist(results, df, alphaSHistName, axes, [*cols, f'{tensorASName}_helicity'], tensor_axes=alphaSHeltensor_axes, storage=hist.storage.Double())
         else:
-            pdfHist = df.HistoBoost(pdfHistName, axes, [*cols, tensorName], tensor_axes=[pdf_ax], storage=hist.storage.Double())
-            alphaSHist = df.HistoBoost(alphaSHistName, axes, [*cols, tensorASName], tensor_axes=[as_ax], storage=hist.storage.Double())
+            book_hist(results, df, pdfHistName, axes, [*cols, tensorName], tensor_axes=[pdf_ax], storage=hist.storage.Double())
+            book_hist(results, df, alphaSHistName, axes, [*cols, tensorASName], tensor_axes=[as_ax], storage=hist.storage.Double())
 
             if propagateToHelicity:
 
@@ -380,11 +362,9 @@ def add_pdf_hists(results, df, dataset, axes, cols, pdfs, base_name="nominal", a
                 df = df.Define(f"helicity_moments_{tensorName}_tensor", pdfhelper, ["csSineCosThetaPhi", f"{tensorName}", "unity"])
                 alphahelper = ROOT.wrem.makeHelicityMomentPdfTensor[3]()
                 df = df.Define(f"helicity_moments_{tensorASName}_tensor", alphahelper, ["csSineCosThetaPhi", f"{tensorASName}", "unity"])
-                pdfHist_hel = df.HistoBoost(f"helicity_{pdfHistName}", axes, [*cols, f"helicity_moments_{tensorName}_tensor"], tensor_axes=[axis_helicity,pdf_ax], storage=hist.storage.Double())
-                alphaSHist_hel = df.HistoBoost(f"helicity_{alphaSHistName}", axes, [*cols, f"helicity_moments_{tensorASName}_tensor"], tensor_axes=[axis_helicity,as_ax], storage=hist.storage.Double())
-                results.extend([pdfHist_hel, alphaSHist_hel])
+                book_hist(results, df, f"helicity_{pdfHistName}", axes, [*cols, f"helicity_moments_{tensorName}_tensor"], tensor_axes=[axis_helicity,pdf_ax], storage=hist.storage.Double())
+                book_hist(results, df, f"helicity_{alphaSHistName}", axes, [*cols, f"helicity_moments_{tensorASName}_tensor"], tensor_axes=[axis_helicity,as_ax], storage=hist.storage.Double())
 
-        results.extend([pdfHist, alphaSHist])
     return df
 
 def add_qcdScale_hist(results, df, axes, cols, base_name="nominal", addhelicity=False):
@@ -392,10 +372,9 @@ def add_qcdScale_hist(results, df, axes, cols, base_name="nominal", addhelicity=
     if addhelicity:
         qcdbyHelicity, qcdbyHelicity_axes = make_qcdscale_helper_helicity(theory_tools.scale_tensor_axes)
         df = df.Define('scaleWeights_tensor_wnom_helicity', qcdbyHelicity, ['scaleWeights_tensor_wnom', 'helWeight_tensor'])
-        scaleHist = df.HistoBoost(name, axes, [*cols, "scaleWeights_tensor_wnom_helicity"], tensor_axes=qcdbyHelicity_axes, storage=hist.storage.Double())
+        book_hist(results, df, name, axes, [*cols, "scaleWeights_tensor_wnom_helicity"], tensor_axes=qcdbyHelicity_axes, storage=hist.storage.Double())
     else:
-        scaleHist = df.HistoBoost(name, axes, [*cols, "scaleWeights_tensor_wnom"], tensor_axes=theory_tools.scale_tensor_axes, storage=hist.storage.Double())
-    results.append(scaleHist)
+        book_hist(results, df, name, axes, [*cols, "scaleWeights_tensor_wnom"], tensor_axes=theory_tools.scale_tensor_axes, storage=hist.storage.Double())
 
 def add_qcdScaleByHelicityUnc_hist(results, df, helper, axes, cols, base_name="nominal", addhelicity=False):
     name = Datagroups.histName(base_name, syst="qcdScaleByHelicity")
@@ -404,10 +383,9 @@ def add_qcdScaleByHelicityUnc_hist(results, df, helper, axes, cols, base_name="n
     if addhelicity:
         qcdbyHelicity, qcdbyHelicity_axes = make_qcdscale_helper_helicity(helper.tensor_axes)
         df = df.Define('scaleWeights_tensor_wnom_helicity', qcdbyHelicity, ['helicityWeight_tensor', 'helWeight_tensor'])
-        qcdScaleByHelicityUnc = df.HistoBoost(name, axes, [*cols, "scaleWeights_tensor_wnom_helicity"], tensor_axes=qcdbyHelicity_axes, storage=hist.storage.Double())
+        book_hist(results, df, name, axes, [*cols, "scaleWeights_tensor_wnom_helicity"], tensor_axes=qcdbyHelicity_axes, storage=hist.storage.Double())
     else:
-        qcdScaleByHelicityUnc = df.HistoBoost(name, axes, [*cols,"helicityWeight_tensor"], tensor_axes=helper.tensor_axes, storage=hist.storage.Double())
-    results.append(qcdScaleByHelicityUnc)
+        book_hist(results, df, name, axes, [*cols,"helicityWeight_tensor"], tensor_axes=helper.tensor_axes, storage=hist.storage.Double())
 
 def add_QCDbkg_jetPt_hist(results, df, nominal_axes, nominal_cols, base_name="nominal", jet_pt=30):
     # branching the rdataframe to add special filter, no need to return dQCDbkGVar
@@ -423,12 +401,15 @@ def add_luminosity_unc_hists(results, df, args, axes, cols, addhelicity=False):
         pass
     else:
         df = df.Define("luminosityScaling", f"wrem::constantScaling(nominal_weight, {args.lumiUncertainty})")
-        luminosity = df.HistoBoost("nominal_luminosity", axes, [*cols, "luminosityScaling"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
-        results.append(luminosity)
+        book_hist(results, df, "nominal_luminosity", axes, [*cols, "luminosityScaling"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
     return df
     
-def add_muon_efficiency_unc_hists(results, df, helper_stat, helper_syst, axes, cols, base_name="nominal", what_analysis=ROOT.wrem.AnalysisType.Wmass, smooth3D=False, addhelicity=False):
+def add_muon_efficiency_unc_hists(results, df, helper_stat, helper_syst, axes, cols, base_name="nominal", what_analysis=None, smooth3D=False, addhelicity=False):
     # TODO: update for dilepton
+    if what_analysis is None:
+        # the enum is only available after declaring the headers
+        declare_headers()
+        what_analysis = ROOT.wrem.AnalysisType.Wmass
     if what_analysis == ROOT.wrem.AnalysisType.Wmass:
         muon_columns_stat = ["goodMuons_pt0", "goodMuons_eta0",
                              "goodMuons_uT0", "goodMuons_charge0"]
@@ -462,67 +443,64 @@ def add_muon_efficiency_unc_hists(results, df, helper_stat, helper_syst, axes, c
     # change variables for tracking, to use standalone variables
     muon_columns_stat_tracking = [x.replace("_pt0", "_SApt0").replace("_eta0", "_SAeta0") for x in muon_columns_stat]
         
-    for key,helper in helper_stat.items():
-        if "tracking" in key:
-            muon_columns_stat_step = muon_columns_stat_tracking
-        elif "iso" in key and what_analysis == ROOT.wrem.AnalysisType.Wmass:
-            muon_columns_stat_step = muon_columns_stat + ["passIso"]
-        else:
-            muon_columns_stat_step = muon_columns_stat
+    with merged_hists(results):
+        for key,helper in helper_stat.items():
+            if "tracking" in key:
+                muon_columns_stat_step = muon_columns_stat_tracking
+            elif "iso" in key and what_analysis == ROOT.wrem.AnalysisType.Wmass:
+                muon_columns_stat_step = muon_columns_stat + ["passIso"]
+            else:
+                muon_columns_stat_step = muon_columns_stat
             
-        df = df.Define(f"effStatTnP_{key}_tensor", helper, [*muon_columns_stat_step, "nominal_weight"])
-        name = Datagroups.histName(base_name, syst=f"effStatTnP_{key}")
+            df = df.Define(f"effStatTnP_{key}_tensor", helper, [*muon_columns_stat_step, "nominal_weight"])
+            name = Datagroups.histName(base_name, syst=f"effStatTnP_{key}")
+            if addhelicity:
+                helper_helicity, helper_helicity_axes = make_muon_eff_stat_helpers_helicity(helper)
+                df = df.Define(f"effStatTnP_{key}_ByHelicity_tensor", helper_helicity, [f"effStatTnP_{key}_tensor", "helWeight_tensor"])
+                book_hist(results, df, name, axes, [*cols, f"effStatTnP_{key}_ByHelicity_tensor"], tensor_axes = helper_helicity_axes, storage=hist.storage.Double())
+            else:
+                book_hist(results, df, name, axes, [*cols, f"effStatTnP_{key}_tensor"], tensor_axes = helper.tensor_axes, storage=hist.storage.Double())
+    
+        df = df.Define("effSystTnP_weight", helper_syst, [*muon_columns_syst, "nominal_weight"])
+        name = Datagroups.histName(base_name, syst=f"effSystTnP")
         if addhelicity:
-            helper_helicity, helper_helicity_axes = make_muon_eff_stat_helpers_helicity(helper)
-            df = df.Define(f"effStatTnP_{key}_ByHelicity_tensor", helper_helicity, [f"effStatTnP_{key}_tensor", "helWeight_tensor"])
-            effStatTnP = df.HistoBoost(name, axes, [*cols, f"effStatTnP_{key}_ByHelicity_tensor"], tensor_axes = helper_helicity_axes, storage=hist.storage.Double())
+            helper_syst_helicity, helper_syst_helicity_axes = make_muon_eff_syst_helper_helicity(helper_syst)
+            df = df.Define("effSystTnP_weight_ByHelicity_tensor", helper_syst_helicity, ["effSystTnP_weight", "helWeight_tensor"])
+            book_hist(results, df, name, axes, [*cols, "effSystTnP_weight_ByHelicity_tensor"], tensor_axes = helper_syst_helicity_axes, storage=hist.storage.Double())
         else:
-            effStatTnP = df.HistoBoost(name, axes, [*cols, f"effStatTnP_{key}_tensor"], tensor_axes = helper.tensor_axes, storage=hist.storage.Double())
-        results.append(effStatTnP)
-    
-    df = df.Define("effSystTnP_weight", helper_syst, [*muon_columns_syst, "nominal_weight"])
-    name = Datagroups.histName(base_name, syst=f"effSystTnP")
-    if addhelicity:
-        helper_syst_helicity, helper_syst_helicity_axes = make_muon_eff_syst_helper_helicity(helper_syst)
-        df = df.Define("effSystTnP_weight_ByHelicity_tensor", helper_syst_helicity, ["effSystTnP_weight", "helWeight_tensor"])
-        effSystTnP = df.HistoBoost(name, axes, [*cols, "effSystTnP_weight_ByHelicity_tensor"], tensor_axes = helper_syst_helicity_axes, storage=hist.storage.Double())
-    else:
-        effSystTnP = df.HistoBoost(name, axes, [*cols, "effSystTnP_weight"], tensor_axes = helper_syst.tensor_axes, storage=hist.storage.Double())
-    results.append(effSystTnP)
+            book_hist(results, df, name, axes, [*cols, "effSystTnP_weight"], tensor_axes = helper_syst.tensor_axes, storage=hist.storage.Double())
     
     return df
 
 def add_L1Prefire_unc_hists(results, df, helper_stat, helper_syst, axes, cols, base_name="nominal", addhelicity=False):
-    df = df.Define("muonL1PrefireStat_tensor", helper_stat, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId", "nominal_weight"])
-    name = Datagroups.histName(base_name, syst=f"muonL1PrefireStat")    
+    with merged_hists(results):
+        df = df.Define("muonL1PrefireStat_tensor", helper_stat, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId", "nominal_weight"])
+        name = Datagroups.histName(base_name, syst=f"muonL1PrefireStat")    
 
-    if addhelicity:
-        prefirebyhelicity_stat, prefire_axes_stat = make_muon_prefiring_helper_stat_byHelicity(helper_stat)
-        df = df.Define("muonL1PrefireStatByHelicity_tensor", prefirebyhelicity_stat, ["muonL1PrefireStat_tensor", "helWeight_tensor"])
-        muonL1PrefireStat = df.HistoBoost(name, axes, [*cols, "muonL1PrefireStatByHelicity_tensor"], tensor_axes = prefire_axes_stat, storage=hist.storage.Double())
-    else:
-        muonL1PrefireStat = df.HistoBoost(name, axes, [*cols, "muonL1PrefireStat_tensor"], tensor_axes = helper_stat.tensor_axes, storage=hist.storage.Double())
-    results.append(muonL1PrefireStat)
+        if addhelicity:
+            prefirebyhelicity_stat, prefire_axes_stat = make_muon_prefiring_helper_stat_byHelicity(helper_stat)
+            df = df.Define("muonL1PrefireStatByHelicity_tensor", prefirebyhelicity_stat, ["muonL1PrefireStat_tensor", "helWeight_tensor"])
+            book_hist(results, df, name, axes, [*cols, "muonL1PrefireStatByHelicity_tensor"], tensor_axes = prefire_axes_stat, storage=hist.storage.Double())
+        else:
+            book_hist(results, df, name, axes, [*cols, "muonL1PrefireStat_tensor"], tensor_axes = helper_stat.tensor_axes, storage=hist.storage.Double())
 
-    df = df.Define("muonL1PrefireSyst_tensor", helper_syst, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId", "nominal_weight"])
-    name = Datagroups.histName(base_name, syst=f"muonL1PrefireSyst")
-    prefirebyhelicity_syst, prefire_axes_syst = make_muon_prefiring_helper_syst_byHelicity()
-    if addhelicity:
-        df = df.Define("muonL1PrefireSystByHelicity_tensor", prefirebyhelicity_syst, ["muonL1PrefireSyst_tensor", "helWeight_tensor"])
-        muonL1PrefireSyst = df.HistoBoost(name, axes, [*cols, "muonL1PrefireSystByHelicity_tensor"], tensor_axes = prefire_axes_syst, storage=hist.storage.Double())
-    else:
-        muonL1PrefireSyst = df.HistoBoost(name, axes, [*cols, "muonL1PrefireSyst_tensor"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
-    results.append(muonL1PrefireSyst)
+        df = df.Define("muonL1PrefireSyst_tensor", helper_syst, ["Muon_correctedEta", "Muon_correctedPt", "Muon_correctedPhi", "Muon_correctedCharge", "Muon_looseId", "nominal_weight"])
+        name = Datagroups.histName(base_name, syst=f"muonL1PrefireSyst")
+        prefirebyhelicity_syst, prefire_axes_syst = make_muon_prefiring_helper_syst_byHelicity()
+        if addhelicity:
+            df = df.Define("muonL1PrefireSystByHelicity_tensor", prefirebyhelicity_syst, ["muonL1PrefireSyst_tensor", "helWeight_tensor"])
+            book_hist(results, df, name, axes, [*cols, "muonL1PrefireSystByHelicity_tensor"], tensor_axes = prefire_axes_syst, storage=hist.storage.Double())
+        else:
+            book_hist(results, df, name, axes, [*cols, "muonL1PrefireSyst_tensor"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
 
-    df = df.Define("ecalL1Prefire_tensor", f"wrem::twoPointScaling(nominal_weight/L1PreFiringWeight_ECAL_Nom, L1PreFiringWeight_ECAL_Dn, L1PreFiringWeight_ECAL_Up)")
-    name = Datagroups.histName(base_name, syst=f"ecalL1Prefire")
-    if addhelicity:
-        #can reuse the same helper since it's the tensor multiplication of same types
-        df = df.Define("ecalL1PrefireByHelicity_tensor", prefirebyhelicity_syst, ["ecalL1Prefire_tensor", "helWeight_tensor"])
-        ecalL1Prefire = df.HistoBoost(name, axes, [*cols, "ecalL1PrefireByHelicity_tensor"], tensor_axes = prefire_axes_syst, storage=hist.storage.Double())
-    else:
-        ecalL1Prefire = df.HistoBoost(name, axes, [*cols, "ecalL1Prefire_tensor"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
-    results.append(ecalL1Prefire)
+        df = df.Define("ecalL1Prefire_tensor", f"wrem::twoPointScaling(nominal_weight/L1PreFiringWeight_ECAL_Nom, L1PreFiringWeight_ECAL_Dn, L1PreFiringWeight_ECAL_Up)")
+        name = Datagroups.histName(base_name, syst=f"ecalL1Prefire")
+        if addhelicity:
+            #can reuse the same helper since it's the tensor multiplication of same types
+            df = df.Define("ecalL1PrefireByHelicity_tensor", prefirebyhelicity_syst, ["ecalL1Prefire_tensor", "helWeight_tensor"])
+            book_hist(results, df, name, axes, [*cols, "ecalL1PrefireByHelicity_tensor"], tensor_axes = prefire_axes_syst, storage=hist.storage.Double())
+        else:
+            book_hist(results, df, name, axes, [*cols, "ecalL1Prefire_tensor"], tensor_axes = [common.down_up_axis], storage=hist.storage.Double())
 
     return df
 
@@ -534,8 +512,7 @@ def add_muonscale_hist(results, df, netabins, mag, isW, axes, cols, base_name="n
     scale_etabins_axis = hist.axis.Regular(netabins, -2.4, 2.4, name="scaleEtaSlice", underflow=False, overflow=False)
     name = Datagroups.histName(base_name, syst=f"muonScaleSyst")
 
-    dummyMuonScaleSyst = df.HistoBoost(name, axes, [*cols, f"muonScaleDummy{netabins}Bins{muon_eta}"], tensor_axes=[common.down_up_axis, scale_etabins_axis], storage=hist.storage.Double())
-    results.append(dummyMuonScaleSyst)
+    book_hist(results, df, name, axes, [*cols, f"muonScaleDummy{netabins}Bins{muon_eta}"], tensor_axes=[common.down_up_axis, scale_etabins_axis], storage=hist.storage.Double())
 
     return df
 
@@ -547,8 +524,7 @@ def add_muonscale_smeared_hist(results, df, netabins, mag, isW, axes, cols, base
     scale_etabins_axis = hist.axis.Regular(netabins, -2.4, 2.4, name="scaleEtaSlice", underflow=False, overflow=False)
     name = Datagroups.histName(base_name, syst=f"muonScaleSyst_gen_smear")
 
-    dummyMuonScaleSyst_gen_smear = df.HistoBoost(name, axes, [*cols, f"muonScaleDummy{netabins}Bins{muon_eta}"], tensor_axes=[common.down_up_axis, scale_etabins_axis], storage=hist.storage.Double())
-    results.append(dummyMuonScaleSyst_gen_smear)
+    book_hist(results, df, name, axes, [*cols, f"muonScaleDummy{netabins}Bins{muon_eta}"], tensor_axes=[common.down_up_axis, scale_etabins_axis], storage=hist.storage.Double())
 
     return df
 
@@ -595,27 +571,28 @@ def add_theory_hists(results, df, args, dataset_name, corr_helpers, qcdScaleByHe
     if args.widthVariations:
         df = define_width_weights(df, dataset_name)
 
-    add_pdf_hists(results, df, dataset_name, axes, cols, args.pdfs, base_name=base_name, addhelicity=addhelicity)
-    add_qcdScale_hist(results, df, scale_axes, scale_cols, base_name=base_name, addhelicity=addhelicity)
-
     isZ = dataset_name in common.zprocs_all
 
-    if args.theoryCorr and dataset_name in corr_helpers:
-        results.extend(theory_tools.make_theory_corr_hists(df, base_name, axes, cols, 
-            corr_helpers[dataset_name], args.theoryCorr, modify_central_weight=not args.theoryCorrAltOnly, isW = not isZ)
-        )
+    with merged_hists(results):
+        add_pdf_hists(results, df, dataset_name, axes, cols, args.pdfs, base_name=base_name, addhelicity=addhelicity)
+        add_qcdScale_hist(results, df, scale_axes, scale_cols, base_name=base_name, addhelicity=addhelicity)
+
+        if args.theoryCorr and dataset_name in corr_helpers:
+            results.extend(theory_tools.make_theory_corr_hists(df, base_name, axes, cols, 
+                corr_helpers[dataset_name], args.theoryCorr, modify_central_weight=not args.theoryCorrAltOnly, isW = not isZ)
+            )
 
-    if for_wmass or isZ:
-        logger.debug(f"Make QCD scale histograms for {dataset_name}")
-        # there is no W backgrounds for the Wlike, make QCD scale histograms only for Z
-        # should probably remove the charge here, because the Z only has a single charge and the pt distribution does not depend on which charged lepton is selected
+        if for_wmass or isZ:
+            logger.debug(f"Make QCD scale histograms for {dataset_name}")
+            # there is no W backgrounds for the Wlike, make QCD scale histograms only for Z
+            # should probably remove the charge here, because the Z only has a single charge and the pt distribution does not depend on which charged lepton is selected
 
-        if not args.skipHelicity:
-            add_qcdScaleByHelicityUnc_hist(results, df, qcdScaleByHelicity_helper, scale_axes, scale_cols, base_name=base_name, addhelicity=addhelicity)
+            if not args.skipHelicity:
+                add_qcdScaleByHelicityUnc_hist(results, df, qcdScaleByHelicity_helper, scale_axes, scale_cols, base_name=base_name, addhelicity=addhelicity)
 
-        # TODO: Should have consistent order here with the scetlib correction function
-        add_massweights_hist(results, df, axes, cols, proc=dataset_name, base_name=base_name, addhelicity=addhelicity)
-        if args.widthVariations:
-            add_widthweights_hist(results, df, axes, cols, proc=dataset_name, base_name=base_name)
+            # TODO: Should have consistent order here with the scetlib correction function
+            add_massweights_hist(results, df, axes, cols, proc=dataset_name, base_name=base_name, addhelicity=addhelicity)
+            if args.widthVariations:
+                add_widthweights_hist(results, df, axes, cols, proc=dataset_name, base_name=base_name)
 
     return df
@@ -2,16 +2,18 @@ import os
 import ROOT
 import pathlib
 import hist
-import narf
 import numpy as np
 import lz4.frame
 import pickle
 import re
 import glob
 import h5py
+import tempfile
 from .correctionsTensor_helper import makeCorrectionsTensor
+from wremnants import declare_headers
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import input_tools
+from utilities.cache_tools import hash_object, file_fingerprint
 from wremnants import theory_tools
 
 logger = logging.child_logger(__name__)
@@ -21,7 +23,61 @@ def valid_theory_corrections():
     matches = [re.match("(^.*)Corr[W|Z]\.pkl\.lz4", os.path.basename(c)) for c in corr_files]
     return [m[1] for m in matches if m]
 
-def load_corr_helpers(procs, generators, make_tensor=True):
+class CorrHistCache(object):
+    # persistent cache of the correction histograms extracted from the (lz4 compressed) pickled correction files,
+    #   each histogram is stored as the raw array of its storage (with flow) in .npy format, which is memory mapped when loaded,
+    #   and the pickled axes and storage type, such that neither the decompression nor the unpickling of the full file is needed
+    # the entries are keyed by a hash of the file (path, size and modification time), the process and the histogram name
+    # bump the version if the layout of the entries changes
+    version = 1
+
+    def __init__(self, cachedir):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.cachedir = cachedir
+        logger.info(f"Use cache for theory correction histograms in {cachedir}")
+
+    def key(self, filename, proc, histname):
+        return hash_object({
+            "version" : CorrHistCache.version,
+            "file" : file_fingerprint(filename),
+            "proc" : proc,
+            "hist" : histname,
+        })[:32]
+
+    def paths(self, key):
+        return f"{self.cachedir}/corr_{key}.npy", f"{self.cachedir}/corr_{key}_axes.pkl"
+
+    def load(self, key):
+        data_path, axes_path = self.paths(key)
+        # the axes are written last, an entry is complete if they exist
+        if not os.path.isfile(axes_path):
+            return None
+        with open(axes_path, "rb") as f:
+            axes, storage = pickle.load(f)
+        h = hist.Hist(*axes, storage=storage)
+        h.view(flow=True)[...] = np.load(data_path, mmap_mode="r")
+        return h
+
+    def save(self, key, h):
+        # write to temporary files first such that concurrent writers never leave a partial entry
+        data_path, axes_path = self.paths(key)
+        for path, write in [
+            (data_path, lambda f: np.save(f, np.asarray(h.view(flow=True)))),
+            (axes_path, lambda f: pickle.dump((list(h.axes), h.storage_type()), f, protocol=pickle.HIGHEST_PROTOCOL)),
+        ]:
+            fd, tmppath = tempfile.mkstemp(prefix="corr_", suffix=".tmp", dir=self.cachedir)
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmppath, path)
+
+def load_corr_helpers(procs, generators, make_tensor=True, cache_dir=None):
+    # the processes of the same boson share the correction file, the histograms and helpers are only made once per file
+    #   with cache_dir, the correction histograms are read from the persistent cache (see CorrHistCache)
+    if make_tensor:
+        declare_headers("theory_corrections.h")
+    cache = CorrHistCache(cache_dir) if cache_dir else None
+    loaded = {}
     corr_helpers = {}
     for proc in procs:
         corr_helpers[proc] = {}
@@ -30,14 +86,18 @@ def load_corr_helpers(procs, generators, make_tensor=True):
             if not os.path.isfile(fname):
                 logger.warning(f"Did not find correction file for process {proc}, generator {generator}. No correction will be applied for this process!")
                 continue
+            if (fname, generator) in loaded:
+                corr_helpers[proc][generator] = loaded[(fname, generator)]
+                continue
             logger.debug(f"Make theory correction helper for file: {fname}")
-            corrh = load_corr_hist(fname, proc[0], get_corr_name(generator))
+            corrh = load_corr_hist(fname, proc[0], get_corr_name(generator), cache)
             if not make_tensor:
                 corr_helpers[proc][generator] = corrh
             elif "Helicity" in generator:
                 corr_helpers[proc][generator] = makeCorrectionsTensor(corrh, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
             else:
                 corr_helpers[proc][generator] = makeCorrectionsTensor(corrh)
+            loaded[(fname, generator)] = corr_helpers[proc][generator]
     for generator in generators:
         if not any([generator in corr_helpers[proc] for proc in procs]):
             raise ValueError(f"Did not find correction for generator {generator} for any processes!")
@@ -74,10 +134,20 @@ def make_corr_helper_fromnp(filename=f"{common.data_dir}/N3LLCorrections/inclusi
 
     return makeCorrectionsTensor(corrh)
 
-def load_corr_hist(filename, proc, histname):
+def load_corr_hist(filename, proc, histname, cache=None):
+    if cache is not None:
+        key = cache.key(filename, proc, histname)
+        corrh = cache.load(key)
+        if corrh is not None:
+            logger.debug(f"Read correction histogram {histname} for {proc} from the cache")
+            return corrh
+
     with lz4.frame.open(filename) as f:
         corr = pickle.load(f)
         corrh = corr[proc][histname]
+
+    if cache is not None:
+        cache.save(key, corrh)
     return corrh
 
 def get_corr_name(generator):
@@ -171,6 +241,7 @@ def make_qcd_uncertainty_helper_by_helicity(is_w_like = False, filename=None):
         filename = f"{common.data_dir}/angularCoefficients/w_z_moments.hdf5"
 
     # load moments from file
+    import narf.ioutils
     with h5py.File(filename, "r") as h5file:
         results = narf.ioutils.pickle_load_h5py(h5file["results"])
         moments = results["Z"] if is_w_like else results["W"]
@@ -212,6 +283,7 @@ def make_qcd_uncertainty_helper_by_helicity(is_w_like = False, filename=None):
         corr_coeffs.values()[..., ihel+1, 1, var_names.index(downvar)] = moments_min[..., ihel+1]
         corr_coeffs.values()[..., ihel+1, 1, var_names.index(upvar)] = moments_max[..., ihel+1]
 
+    declare_headers("theory_corrections.h")
     helper = makeCorrectionsTensor(corr_coeffs, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
 
     # override tensor_axes since the output is different here
@@ -222,6 +294,7 @@ def make_qcd_uncertainty_helper_by_helicity(is_w_like = False, filename=None):
 def make_helicity_test_corrector(is_w_like = False, filename = None):
 
     # load moments from file
+    import narf.ioutils
     with h5py.File(filename, "r") as h5file:
         results = narf.ioutils.pickle_load_h5py(h5file["results"])
         moments = results["Z"] if is_w_like else results["W"]
@@ -255,6 +328,7 @@ def make_helicity_test_corrector(is_w_like = False, filename = None):
 
     print("corr_coeffs", corr_coeffs)
 
+    declare_headers("theory_corrections.h")
     helper = makeCorrectionsTensor(corr_coeffs, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
 
     # override tensor_axes since the output is different here
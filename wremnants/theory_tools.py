@@ -4,13 +4,11 @@ import numpy as np
 import copy
 from math import pi
 from utilities import boostHistHelpers as hh,common,logging
-from wremnants import theory_corrections
+from wremnants import theory_corrections, declare_headers
 from scipy import ndimage
-import narf.clingutils
 from math import sqrt
 
 logger = logging.child_logger(__name__)
-narf.clingutils.Declare('#include "theoryTools.h"')
 
 # integer axis for -1 through 7
 axis_helicity = hist.axis.Integer(
@@ -153,6 +151,7 @@ theory_corr_weight_map = {
 }
 
 def define_prefsr_vars(df):
+    declare_headers("theoryTools.h")
     if "prefsrLeps" in df.GetColumnNames():
         logger.debug("PreFSR leptons are already defined, do nothing here.")
         return df
@@ -179,6 +178,7 @@ def define_prefsr_vars(df):
     return df
 
 def define_scale_tensor(df):
+    declare_headers("theoryTools.h")
     if "scaleWeights_tensor" in df.GetColumnNames():
         logger.debug("scaleWeight_tensor already defined, do nothing here.")
         return df
@@ -189,6 +189,7 @@ def define_scale_tensor(df):
     return df
 
 def define_ew_vars(df):
+    declare_headers("theoryTools.h")
     df = df.Define("ewLeptons", "wrem::ewLeptons(GenPart_status, GenPart_statusFlags, GenPart_pdgId, GenPart_pt, GenPart_eta, GenPart_phi)")
     df = df.Define("ewPhotons", "wrem::ewPhotons(GenPart_status, GenPart_statusFlags, GenPart_pdgId, GenPart_pt, GenPart_eta, GenPart_phi)")
     df = df.Define('ewGenV', 'wrem::ewGenVPhos(ewLeptons, ewPhotons)')
@@ -234,6 +235,7 @@ def pdf_info_map(dataset, pdfset):
     return infoMap[pdfset]
 
 def define_pdf_columns(df, dataset_name, pdfs, noAltUnc):
+    declare_headers("theoryTools.h")
     if dataset_name not in common.vprocs_all or \
             "horace" in dataset_name or \
             "winhac" in dataset_name or \
@@ -501,51 +503,111 @@ def pdfNamesAsymHessian(entries, pdfset=""):
 def pdfNamesSymHessian(entries, pdfset=""):
     return [f"pdf{i+1}{pdfset.replace('pdf', '')}" for i in range(entries)]
 
-def pdfSymmetricShifts(hdiff, axis_name):
-    sq = hh.multiplyHists(hdiff, hdiff)
-    ss = sq[{axis_name : hist.sum}]
-    rss = hh.sqrtHist(ss)
-    return rss, rss
+def hessianMembers(ax, uncType="symHessian"):
+    # indices (including the underflow bin) of the members entering the up and down shifts along a Hessian PDF axis
+    underflow = int(ax.traits.underflow)
+    if uncType == "symHessian":
+        # all members, the overflow is not included, the central member does not contribute
+        members = np.arange(ax.size+underflow)
+        return members, members
 
-def pdfAsymmetricShifts(hdiff, axis_name):
-    # Assuming that the last axis is the syst axis
-    # TODO: add some check to verify this
-    def shiftHist(vals, hdiff, axis_name):
-        hnew = hdiff[{axis_name : 0}]
-        vals = vals*vals
-        hnew[...] = np.sum(vals, axis=-1)
-        return hh.sqrtHist(hnew)
-
-    ax = hdiff.axes[axis_name] 
-    underflow = hdiff.axes[axis_name].traits.underflow
-    overflow = hdiff.axes[axis_name].traits.overflow
     if type(ax) == hist.axis.StrCategory and all(["Up" in x or "Down" in x for x in ax][1:]):
-        # Remove the overflow from the categorical axis
         end = int((ax.size-1)/2)
-        upvals = hdiff[{axis_name : [x for x in ax if "Up" in x]}].values(flow=True)[...,:end]
-        downvals = hdiff[{axis_name : [x for x in ax if "Down" in x]}].values(flow=True)[...,:end]
-        if upvals.shape != downvals.shape:
+        upMembers = [i for i,x in enumerate(ax) if "Up" in x][:end]
+        downMembers = [i for i,x in enumerate(ax) if "Down" in x][:end]
+        if len(upMembers) != len(downMembers):
             raise ValueError("Malformed PDF uncertainty hist! Expect equal number of up and down vars")
-    else:
-        end = ax.size+underflow
-        upvals = hdiff.values(flow=True)[...,1+underflow:end:2]
-        downvals = hdiff.values(flow=True)[...,2+underflow:end:2]
+        return np.array(upMembers, dtype=int), np.array(downMembers, dtype=int)
 
     # The error sets are ordered up,down,up,down...
-    upshift = shiftHist(upvals, hdiff, axis_name)
-    downshift = shiftHist(downvals, hdiff, axis_name)
-    return upshift, downshift 
+    end = ax.size+underflow
+    return np.arange(1+underflow, end, 2), np.arange(2+underflow, end, 2)
+
+def rssShifts(diff, diff_vars=None, cutoff=1e-5):
+    # root of the sum of squares of the shifts along the last axis, computed in place in the input arrays, 
+    #   the variances are propagated in the same way as by hh.multiplyHists and hh.sqrtHist
+    sq = np.multiply(diff, diff, out=diff)
+    rss = np.sum(sq, axis=-1)
+    rss_vars = None
+    if diff_vars is not None:
+        # var(d^2) = d^4 * 2 var(d)/d^2
+        np.multiply(diff_vars, 2., out=diff_vars)
+        np.divide(diff_vars, np.maximum(sq, cutoff), out=diff_vars)
+        np.multiply(diff_vars, sq, out=diff_vars)
+        np.multiply(diff_vars, sq, out=diff_vars)
+        rss_vars = np.sum(diff_vars, axis=-1)
+        # var(sqrt(s)) = 0.5 * s * var(s)/s^2
+        np.multiply(rss_vars, 0.5*rss/np.maximum(rss*rss, cutoff), out=rss_vars)
+    np.sqrt(rss, out=rss)
+    return rss, rss_vars
+
+def hessianShifts(h, axis_name, members, nominal=None, scale=1.):
+    # rss of the shifts of each list of members (of the axis axis_name) with respect to the nominal member,
+    #   computed from a single view of the histogram, lists which are the same object are only computed once
+    with_variance = h.storage_type == hist.storage.Weight
+    idx = h.axes.name.index(axis_name)
+    vals, varis = hh.viewArrays(h)
+    vals = np.moveaxis(vals, idx, -1)
+    varis = np.moveaxis(varis, idx, -1) if with_variance else None
+
+    shifts = {}
+    for m in members:
+        if id(m) in shifts:
+            continue
+        diff = vals[..., m]
+        diff_vars = varis[..., m] if with_variance else None
+        if nominal is not None:
+            diff -= vals[..., nominal, np.newaxis]
+            if with_variance:
+                diff_vars += varis[..., nominal, np.newaxis]
+        if scale != 1.:
+            diff *= scale
+            if with_variance:
+                diff_vars *= scale*scale
+        shifts[id(m)] = rssShifts(diff, diff_vars)
+
+    return [shifts[id(m)] for m in members]
+
+def shiftHist(axes, storage, shift, shift_vars, nominal=None, nominal_vars=None, sign=1.):
+    # histogram with the values nominal+sign*shift (the shift only if no nominal is given), the variances are summed
+    hnew = hist.Hist(*axes, storage=storage)
+    out, out_vars = hh.outputArrays(hnew)
+    if nominal is None:
+        out[...] = shift
+    else:
+        np.add(nominal, sign*shift, out=out)
+    if out_vars is not None:
+        out_vars[...] = shift_vars if nominal_vars is None else nominal_vars + shift_vars
+    return hnew
+
+def pdfSymmetricShifts(hdiff, axis_name):
+    members = np.arange(hdiff.axes[axis_name].extent)
+    axes = [ax for ax in hdiff.axes if ax.name != axis_name]
+    rss = shiftHist(axes, hdiff.storage_type(), *hessianShifts(hdiff, axis_name, [members])[0])
+    return rss, rss
+
+def pdfAsymmetricShifts(hdiff, axis_name):
+    upMembers, downMembers = hessianMembers(hdiff.axes[axis_name], uncType="asymHessian")
+    axes = [ax for ax in hdiff.axes if ax.name != axis_name]
+    upshift, downshift = hessianShifts(hdiff, axis_name, [upMembers, downMembers])
+    return shiftHist(axes, hdiff.storage_type(), *upshift), shiftHist(axes, hdiff.storage_type(), *downshift)
 
 def hessianPdfUnc(h, axis_name="pdfVar", uncType="symHessian", scale=1.):
-    underflow = h.axes[axis_name].traits.underflow
-    symmetric = uncType == "symHessian"
-    diff = hh.addHists(h, -1*h[{axis_name : 0}])*scale
-    if diff.axes[axis_name].traits.overflow:
-        diff[...,hist.overflow] = np.zeros_like(diff[{axis_name : 0}].view(flow=True))
-    shiftFunc = pdfSymmetricShifts if symmetric else pdfAsymmetricShifts
-    rssUp, rssDown = shiftFunc(diff, axis_name)
-    hUp = hh.addHists(h[{axis_name : 0}], 1*rssUp)
-    hDown = hh.addHists(h[{axis_name : 0}], -1*rssDown)
+    # up and down variations from the shifts of the error sets with respect to the central member, 
+    #   both are derived in one pass over the values of the histogram, without intermediate histograms
+    ax = h.axes[axis_name]
+    nominal = int(ax.traits.underflow)
+    upMembers, downMembers = hessianMembers(ax, uncType)
+    upshift, downshift = hessianShifts(h, axis_name, [upMembers, downMembers], nominal=nominal, scale=scale)
+
+    idx = h.axes.name.index(axis_name)
+    vals, varis = hh.viewArrays(h)
+    nominal_vals = np.take(vals, nominal, axis=idx)
+    nominal_vars = np.take(varis, nominal, axis=idx) if h.storage_type == hist.storage.Weight else None
+
+    axes = [a for a in h.axes if a.name != axis_name]
+    hUp = shiftHist(axes, h.storage_type(), *upshift, nominal_vals, nominal_vars, sign=1.)
+    hDown = shiftHist(axes, h.storage_type(), *downshift, nominal_vals, nominal_vars, sign=-1.)
     return hUp, hDown
 
 def pdfBugfixMSHT20(df , tensorPDFName):
@@ -6,14 +6,14 @@ import numpy as np
 import boost_histogram as bh
 from utilities import common
 from utilities import common, logging
-
-narf.clingutils.Declare('#include "vertex.h"')
+from wremnants import declare_headers
 
 logger = logging.child_logger(__name__)
 
 data_dir = common.data_dir
 
 def make_vertex_helper(era = None, filename = None):
+    declare_headers("vertex.h")
 
     eradict = { "2016PreVFP" :  "BtoF",
                 "2016PostVFP" : "GtoH",